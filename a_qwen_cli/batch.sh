@@ -1,12 +1,24 @@
 #!/bin/bash
 
 
+# batch 条目：输入是请求体，用到 $id $url 两个变量
+BATCH_ITEM_FILTER='
+    {
+      custom_id: $id,
+      method: "POST",
+      url: $url,
+      body: (
+        . 
+        | del(.stream, .stream_options)
+      )
+    }'
+
 # 构造单个 batch 请求条目
+# body 可以作为第三个参数传入，不传时从 stdin 读（大请求体走文件，不占命令行）
 construct_batch_item() {
     local custom_id="$1"
     local url="$2"
     #local model="$3"
-    local body="$3"
 
     #jq -c --arg id "$custom_id" --arg url "$url" --argjson body "$body" '
     #{
@@ -16,16 +28,11 @@ construct_batch_item() {
     #  body: $body
     #}' <<< "{}"
 
-    jq -c --arg id "$custom_id" --arg url "$url" '
-    {
-      custom_id: $id,
-      method: "POST",
-      url: $url,
-      body: (
-        . 
-        | del(.stream, .stream_options)
-      )
-    }' <<< "$body"
+    if [ $# -ge 3 ]; then
+        jq -c --arg id "$custom_id" --arg url "$url" "$BATCH_ITEM_FILTER" <<< "$3"
+    else
+        jq -c --arg id "$custom_id" --arg url "$url" "$BATCH_ITEM_FILTER"
+    fi
 
 }
 
@@ -39,6 +46,182 @@ get_next_custom_id() {
     fi
 }
 
+# ======================
+# = 按清单批量生成 batch 文件 =
+# ======================
+# 清单每行一个请求：prompt（问题）、files（文件或目录，多个用 ; 隔开）、
+# model（可选，不填用 -m 指定的模型）、id（可选，作为 custom_id）
+# 支持 CSV（首行是表头）和 JSONL，JSONL 里 files 也可以直接写成数组
+# custom_id 优先用 id 列，没有就用行号（从 1 开始），同一份清单重复生成结果不变
+
+# CSV 转 JSONL：awk 逐字符处理引号（字段里可以有逗号、换行和 "" 转义），
+# 字段之间用 \x1f、记录之间用 \x1e 分隔，再由 jq 按表头拼成对象
+batch_manifest_csv_to_jsonl() {
+    local manifest="$1"
+
+    awk '
+    function end_field() { rec = rec (nf ? "\037" : "") field; nf++; field = "" }
+    {
+        sub(/\r$/, "")
+        if (inq) field = field "\n"
+        n = length($0)
+        for (p = 1; p <= n; p++) {
+            c = substr($0, p, 1)
+            if (inq) {
+                if (c == "\"") {
+                    if (substr($0, p + 1, 1) == "\"") { field = field "\""; p++ }
+                    else inq = 0
+                } else field = field c
+            } else if (c == "\"") inq = 1
+            else if (c == ",") end_field()
+            else field = field c
+        }
+        if (!inq) { end_field(); printf "%s\036", rec; rec = ""; nf = 0 }
+    }' "$manifest" | jq -c -R -s '
+        split("\u001e") | map(select(length > 0) | split("\u001f"))
+        | (.[0] // [] | map(ascii_downcase | sub("^\\s+"; "") | sub("\\s+$"; ""))) as $header
+        | .[1:][]
+        | . as $fields
+        | reduce range(0; $header | length) as $k ({}; .[$header[$k]] = ($fields[$k] // ""))
+    '
+}
+
+# 清单统一成每行 {row, id, prompt, model, files}
+batch_manifest_rows() {
+    local manifest="$1"
+    local default_model="$2"
+
+    case "$manifest" in
+        *.csv|*.CSV) batch_manifest_csv_to_jsonl "$manifest" ;;
+        *) jq -c . "$manifest" ;;
+    esac | jq -c -s --arg model "$default_model" '
+        to_entries[]
+        | (.key + 1) as $row
+        | .value
+        | {
+            row: $row,
+            id: ((.id // .custom_id // "") | tostring | if . == "" then ($row | tostring) else . end),
+            prompt: ((.prompt // .question // "") | tostring),
+            model: ((.model // "") | if . == "" then $model else . end),
+            files: ((.files // [])
+                | if type == "string" then split(";") else . end
+                | map(tostring | sub("^\\s+"; "") | sub("\\s+$"; "") | select(length > 0)))
+          }
+    '
+}
+
+# 按清单一次生成完整的 batch 文件
+# 所有行引用的文件合在一起只上传一次（并发、按内容去重、走上传缓存），
+# 请求体和 batch 条目都由一个 jq 进程逐行写出，与 --batch 单条追加的内容一致
+# 参数: 清单文件 batch 文件 默认模型
+build_batch_from_manifest() {
+    local manifest="$1"
+    local batch_file="$2"
+    local default_model="$3"
+
+    if [ ! -f "$manifest" ]; then
+        error "❌ 清单文件不存在: $manifest"
+        return 1
+    fi
+
+    local work_dir=$(mktemp -d "${TMPDIR:-/tmp}/qwen_buildbatch.XXXXXX")
+    local rows="$work_dir/rows.jsonl"
+
+    if ! batch_manifest_rows "$manifest" "$default_model" > "$rows"; then
+        error "❌ 清单解析失败: $manifest"
+        rm -rf "$work_dir"
+        return 1
+    fi
+    info "清单共 $(wc -l < "$rows" | tr -d ' ') 行: $manifest"
+
+    # 展开文件和目录引用，每个 (模型, 引用) 只展开一次，结果是 模型 -> 引用 -> [文件路径]
+    # 目录按该行模型的扩展名、.qwenignore 和大小上限展开，同一个目录在不同模型的行里可能收到不同的文件
+    # 每条记录 "模型\x1f引用\x1f路径"，以 \0 结尾；空目录记一条没有路径的，说明引用存在
+    # 输入按模型排好序，每个模型的遍历配置只取一次
+    local ref="" path="" exts="" max_bytes="" m="" config_model=""
+    while IFS=$'\x1f' read -r -d '' m ref; do
+        if [ "$m" != "$config_model" ]; then
+            IFS=$'\t' read -r exts max_bytes < <(model_walk_config "$m")
+            config_model="$m"
+        fi
+        if [ -f "$ref" ]; then
+            printf '%s\037%s\037%s\0' "$m" "$ref" "$ref"
+        elif [ -d "$ref" ]; then
+            printf '%s\037%s\037\0' "$m" "$ref"
+            while IFS= read -r -d '' path; do
+                printf '%s\037%s\037%s\0' "$m" "$ref" "$path"
+            done < <(walk_dir "$ref" "$max_bytes" $exts)
+        fi
+    done < <(jq -j -s '[.[] | .model as $m | .files[] | [$m, .]] | unique[] | join("\u001f") + "\u0000"' "$rows") |
+    jq -c -R -s '
+        reduce (split("\u0000")[] | select(length > 0) | split("\u001f")) as $r ({};
+            .[$r[0]][$r[1]] += (if ($r[2] // "") == "" then [] else [$r[2]] end))
+    ' > "$work_dir/expand.json"
+
+    # 所有文件合并后一次上传
+    local all_files=$(jq -c '[.[][][]] | unique' "$work_dir/expand.json")
+    upload_files "$all_files" | jq -c '[.files[] | {key: .filepath, value: .id}] | from_entries' > "$work_dir/ids.json"
+
+    # 每个模型的 endpoint 只算一次
+    local endpoint=""
+    while IFS= read -r m; do
+        if ! endpoint=$(get_endpoint_by_model "$m") || [ -z "$endpoint" ]; then
+            error "❌ 清单里的模型无效: $m"
+            rm -rf "$work_dir"
+            return 1
+        fi
+        printf '%s\t%s\n' "$m" "$endpoint"
+    done < <(jq -r -s 'map(.model) | unique[]' "$rows") |
+    jq -c -R -s 'split("\n") | map(select(length > 0) | split("\t") | {key: .[0], value: .[1]}) | from_entries' \
+        > "$work_dir/endpoints.json"
+
+    jq -r -n \
+        --slurpfile expand "$work_dir/expand.json" \
+        --slurpfile ids "$work_dir/ids.json" \
+        --slurpfile endpoints "$work_dir/endpoints.json" \
+        --argjson configs "$MODEL_CONFIG" "
+        def request_body(\$msg; \$model; \$model_config): $REQUEST_BODY_FILTER;
+        def batch_item(\$id; \$url): $BATCH_ITEM_FILTER;
+        "'
+        $expand[0] as $expand | $ids[0] as $ids | $endpoints[0] as $endpoints
+        | inputs
+        | . as $row
+        | ($expand[.model] // {}) as $expand
+        | (.files | map(select($expand[.] == null))) as $missing
+        | [.files[] | $expand[.][]?] as $paths
+        | ($paths | map(select($ids[.] == null))) as $failed
+        | if .prompt == "" then "skip\t\(.row)\t问题为空"
+          elif ($missing | length) > 0 then "skip\t\(.row)\t文件不存在: \($missing | join(", "))"
+          elif ($failed | length) > 0 then "skip\t\(.row)\t文件上传失败: \($failed | join(", "))"
+          else
+            {files: [$paths[] | {id: $ids[.]}]}
+            | request_body($row.prompt; $row.model; ($configs[$row.model] // {}))
+            | batch_item($row.id; $endpoints[$row.model])
+            | tojson
+          end
+        ' "$rows" > "$work_dir/items"
+
+    local row="" reason=""
+    while IFS=$'\t' read -r _ row reason; do
+        warn "⚠️ 清单第 $row 行已跳过: $reason"
+    done < <(grep '^skip	' "$work_dir/items" || true)
+
+    local count=$(grep -vc '^skip	' "$work_dir/items" || true)
+    if [ "${count:-0}" -eq 0 ]; then
+        error "❌ 清单没有生成任何 batch 条目"
+        rm -rf "$work_dir"
+        return 1
+    fi
+
+    # 先在同一目录写临时文件再改名，中途失败不会留下半个 batch 文件
+    [ -f "$batch_file" ] && warn "batch 文件已存在，将被覆盖: $batch_file"
+    grep -v '^skip	' "$work_dir/items" > "$batch_file.tmp.$$"
+    mv "$batch_file.tmp.$$" "$batch_file"
+    rm -rf "$work_dir"
+
+    info "✅ 已生成 batch 文件: $batch_file，共 $count 条"
+}
+
 : '
 if [ -n "$batch_file" ]; then
     next_id=$(get_next_custom_id "$batch_file")
@@ -58,12 +241,23 @@ else
 fi
 '
 
+# 调 batch 相关的接口，响应体输出到 stdout
+# 经 http_request 发出，和其他请求共用限速、并发上限和重试
+# 参数: curl 参数...（方法、url、数据）
+batch_api() {
+    local body_file=$(mktemp "${TMPDIR:-/tmp}/qwen_batch_api.XXXXXX")
+    local rc=0
+    http_request "$body_file" -H "Authorization: Bearer $DASHSCOPE_API_KEY" "$@" > /dev/null || rc=$?
+    cat "$body_file"
+    rm -f "$body_file"
+    return $rc
+}
+
 # 1. 上传文件
 upload_batch_file() {
     local FILE_PATH="$1"
     echo "🔄 正在上传文件: $FILE_PATH" >&2
-    local UPLOAD_RESPONSE=$(curl -s -X POST "https://dashscope.aliyuncs.com/compatible-mode/v1/files" \
-        -H "Authorization: Bearer $DASHSCOPE_API_KEY" \
+    local UPLOAD_RESPONSE=$(batch_api -X POST "$API_BASE_URL/files" \
         --form "file=@$FILE_PATH" \
         --form "purpose=batch")
 
@@ -90,23 +284,11 @@ create_batch_job() {
     local endpoint="$2"
     echo "🔄 正在创建 Batch 任务，使用文件 ID: $input_file_id" >&2
 
-    local json_data=$(jq -n \
-  --arg input_file_id "$input_file_id" \
-  --arg endpoint "$endpoint" \
-  '{
-    input_file_id: $input_file_id,
-    endpoint: $endpoint,
-    completion_window: "24h",
-    metadata: {
-      ds_name: "MyBatchTask",
-      ds_description: "Test Batch Task"
-    }
-  }')
+    local json_data=$(batch_job_body "$input_file_id" "$endpoint")
 
-local CREATE_RESPONSE=$(curl -s -X POST "https://dashscope.aliyuncs.com/compatible-mode/v1/batches"  \
-    -H "Authorization: Bearer $DASHSCOPE_API_KEY" \
-    -H "Content-Type: application/json" \
-    -d "$json_data")
+    local CREATE_RESPONSE=$(batch_api -X POST "$API_BASE_URL/batches" \
+        -H "Content-Type: application/json" \
+        -d "$json_data")
 
     local BATCH_ID=$(echo "$CREATE_RESPONSE" | jq -r '.id')
 
@@ -125,10 +307,8 @@ poll_job_status_once() {
     local batch_id="$1"
     echo "正在询任务状态: $batch_id" >&2
 
-    local STATUS=$(curl -s -X GET "https://dashscope.aliyuncs.com/compatible-mode/v1/batches/$batch_id" \
-        -H "Authorization: Bearer $DASHSCOPE_API_KEY" | jq -r '.status')
-    sleep 10
-    
+    local STATUS=$(batch_api -X GET "$API_BASE_URL/batches/$batch_id" | jq -r '.status')
+
     echo "📊 当前状态: $STATUS" >&2
     echo "$STATUS"
 }
@@ -148,8 +328,7 @@ poll_job_status() {
         elif [ "$STATUS" = "failed" ]; then
             echo "❌ 任务失败" >&2
             echo "获取错误信息..." >&2
-            local ERROR_DETAILS=$(curl -s -X GET "https://dashscope.aliyuncs.com/compatible-mode/v1/batches/$batch_id" \
-                -H "Authorization: Bearer $DASHSCOPE_API_KEY" | jq .)
+            local ERROR_DETAILS=$(batch_api -X GET "$API_BASE_URL/batches/$batch_id" | jq .)
             echo "Error Details: $ERROR_DETAILS" >&2
             exit 1
         elif [ "$STATUS" = "expired" ] || [ "$STATUS" = "cancelled" ]; then
@@ -177,8 +356,7 @@ poll_job_status() {
 get_output_file_id() {
     local batch_id="$1"
     echo "🔄 正在获取输出文件 ID for 任务: $batch_id" >&2
-    local OUTPUT_FILE_ID=$(curl -s -X GET "https://dashscope.aliyuncs.com/compatible-mode/v1/batches/$batch_id" \
-        -H "Authorization: Bearer $DASHSCOPE_API_KEY" | jq -r '.output_file_id' )
+    local OUTPUT_FILE_ID=$(batch_api -X GET "$API_BASE_URL/batches/$batch_id" | jq -r '.output_file_id' )
 
     if [ -z "$OUTPUT_FILE_ID" ] || [ "$OUTPUT_FILE_ID" = "null" ]; then
         echo "❌ 未找到输出文件" >&2
@@ -202,12 +380,15 @@ download_results() {
     fi
 
     # URL 编码（可选）
-    local url="https://dashscope.aliyuncs.com/compatible-mode/v1/files/${output_file_id}/content" 
+    local url="$API_BASE_URL/files/${output_file_id}/content"
 
     echo "🌐 请求地址: $url" >&2
-    curl -s -X GET "$url" \
-        -H "Authorization: Bearer $DASHSCOPE_API_KEY" \
-        -o $output_file_path
+    local status
+    if ! status=$(http_request "$output_file_path" -X GET "$url" \
+        -H "Authorization: Bearer $DASHSCOPE_API_KEY"); then
+        echo "❌ 下载失败 (HTTP $status)" >&2
+        exit 1
+    fi
 
     # 检查文件是否为空
     if [ ! -s "$output_file_path" ]; then
@@ -219,32 +400,555 @@ download_results() {
 }
 
 
+# 超过单个 batch 文件上限（BATCH_MAX_ITEMS 条或 BATCH_MAX_BYTES 字节）时按行拆成多个分片
+# 输出每个分片一行: 路径<TAB>条数<TAB>字节数
+split_batch_file() {
+    local batch_file="$1"
+    local out_dir="$2"
+    local base=$(basename "$batch_file")
+    base="${base%.*}"
+
+    LC_ALL=C awk -v max_items="$BATCH_MAX_ITEMS" -v max_bytes="$BATCH_MAX_BYTES" \
+        -v prefix="$out_dir/$base" '
+    function finish() { if (n > 0) { close(out); printf "%s\t%d\t%d\n", out, n, bytes } }
+    NF == 0 { next }
+    {
+        len = length($0) + 1
+        if (n > 0 && (n >= max_items || bytes + len > max_bytes)) { finish(); n = 0; bytes = 0 }
+        if (n == 0) { shard++; out = sprintf("%s.part%03d.jsonl", prefix, shard) }
+        if (len > max_bytes) printf "⚠️ 第 %d 行有 %d 字节，超过单个分片上限\n", NR, len > "/dev/stderr"
+        print > out
+        n++
+        bytes += len
+    }
+    END { finish() }' "$batch_file"
+}
+
+# 创建 batch 任务的请求体
+batch_job_body() {
+    local input_file_id="$1"
+    local endpoint="$2"
+
+    jq -n \
+  --arg input_file_id "$input_file_id" \
+  --arg endpoint "$endpoint" \
+  '{
+    input_file_id: $input_file_id,
+    endpoint: $endpoint,
+    completion_window: "24h",
+    metadata: {
+      ds_name: "MyBatchTask",
+      ds_description: "Test Batch Task"
+    }
+  }'
+}
+
+# 提交 batch 文件：必要时拆成分片，所有分片一起上传、一起创建任务，
+# 每个分片的 file_id 和 batch_id 都记在 .run 文件的 shards 里
 run_batch() { 
 
     local batch_file="$1"
     local run_batch_file="$batch_file.run"
-# testing run
-    # jq -n '{}'
-    local json=$(jq -n --arg bfile1 "$batch_file" '{"batch_file": $bfile1}')
-
-    file_id=$(upload_batch_file "$1")
-    
-    json=$(jq --arg fid1 "$file_id" '.input_file_id=$fid1' <<< "$json")
 
-    batch_id=$(create_batch_job "$file_id" "/v1/chat/completions")
+    if [ ! -s "$batch_file" ]; then
+        echo "❌ batch 文件不存在或为空: $batch_file" >&2
+        exit 1
+    fi
+    if [ -f "$run_batch_file" ]; then
+        echo "❌ 该 batch 文件已经提交过，运行文件已存在: $run_batch_file" >&2
+        exit 1
+    fi
 
-    json=$(jq --arg bid1 "$batch_id" '.batch_id=$bid1' <<< "$json")
+    # endpoint 要和条目里的 url 一致
+    local endpoint=$(head -n 1 "$batch_file" | jq -r '.url // empty')
+    endpoint="${endpoint:-/v1/chat/completions}"
+
+    local work_dir=$(mktemp -d "${TMPDIR:-/tmp}/qwen_runbatch.XXXXXX")
+    local -a shard_files=() shard_items=() shard_bytes=() file_ids=() batch_ids=()
+    local path items bytes
+    while IFS=$'\t' read -r path items bytes; do
+        shard_files+=("$path")
+        shard_items+=("$items")
+        shard_bytes+=("$bytes")
+    done < <(split_batch_file "$batch_file" "$work_dir")
+
+    local count=${#shard_files[@]}
+    if [ "$count" -eq 0 ]; then
+        echo "❌ batch 文件里没有请求: $batch_file" >&2
+        rm -rf "$work_dir"
+        exit 1
+    fi
+    # 不用拆的时候直接上传原文件
+    [ "$count" -eq 1 ] && shard_files[0]="$batch_file"
+    echo "🔄 共 $(( $(IFS=+; echo "${shard_items[*]}") )) 条请求，分成 $count 个 batch 任务提交" >&2
+
+    # 1. 上传所有分片
+    local i
+    local batch=$(transport_begin)
+    for i in "${!shard_files[@]}"; do
+        echo "🔄 正在上传文件: ${shard_files[$i]}" >&2
+        transport_add "$batch" "$i" POST "${API_BASE_URL}/files" "file=@${shard_files[$i]}" "purpose=batch"
+    done
+    transport_run "$batch" "$UPLOAD_JOBS"
+    for i in "${!shard_files[@]}"; do
+        file_ids[$i]=$(jq -r '.id // empty' "$(transport_body "$batch" "$i")" 2>/dev/null || true)
+        if [ -z "${file_ids[$i]}" ]; then
+            echo "❌ 文件上传失败: ${shard_files[$i]}" >&2
+            echo "Response: $(cat "$(transport_body "$batch" "$i")" 2>/dev/null)" >&2
+        fi
+    done
+    transport_end "$batch"
+
+    # 2. 每个分片创建一个 batch 任务
+    batch=$(transport_begin)
+    for i in "${!shard_files[@]}"; do
+        [ -n "${file_ids[$i]}" ] || continue
+        batch_job_body "${file_ids[$i]}" "$endpoint" > "$work_dir/create_$i.json"
+        transport_add_json "$batch" "$i" POST "${API_BASE_URL}/batches" "$work_dir/create_$i.json"
+    done
+    transport_run "$batch" "$UPLOAD_JOBS"
+    local failed=0
+    for i in "${!shard_files[@]}"; do
+        batch_ids[$i]=""
+        if [ -n "${file_ids[$i]}" ]; then
+            batch_ids[$i]=$(jq -r '.id // empty' "$(transport_body "$batch" "$i")" 2>/dev/null || true)
+        fi
+        if [ -z "${batch_ids[$i]}" ]; then
+            [ -n "${file_ids[$i]}" ] && echo "Response: $(cat "$(transport_body "$batch" "$i")" 2>/dev/null)" >&2
+            echo "❌ 第 $((i + 1)) 个分片创建 Batch 任务失败" >&2
+            failed=$((failed + 1))
+        else
+            echo "✅ Batch 任务创建成功，batch_id: ${batch_ids[$i]}" >&2
+        fi
+    done
+    transport_end "$batch"
+
+    # 3. 写运行文件，只有一个分片时顶层也保留 input_file_id / batch_id
+    for i in "${!shard_files[@]}"; do
+        printf '%s\t%s\t%s\t%s\t%s\n' "$i" "${shard_items[$i]}" "${shard_bytes[$i]}" "${file_ids[$i]}" "${batch_ids[$i]}"
+    done | jq -R -s --arg bfile1 "$batch_file" --arg endpoint "$endpoint" --arg tag "$LEDGER_TAG" '
+        split("\n") | map(select(length > 0) | split("\t")
+            | {
+                index: (.[0] | tonumber),
+                items: (.[1] | tonumber),
+                bytes: (.[2] | tonumber),
+                input_file_id: (if (.[3] // "") == "" then null else .[3] end),
+                batch_id: (if (.[4] // "") == "" then null else .[4] end)
+              }) as $shards
+        | {batch_file: $bfile1, endpoint: $endpoint, shards: $shards}
+        | if $tag != "" then .tag = $tag else . end
+        | if ($shards | length) == 1 then .input_file_id = $shards[0].input_file_id | .batch_id = $shards[0].batch_id else . end
+    ' > "$run_batch_file"
+    rm -rf "$work_dir"
+    # 任务结束前，按 LRU 淘汰服务器文件时不删它的输入文件和请求引用的文件
+    remote_pin_run "$run_batch_file"
 
-    echo "$json" > "$run_batch_file"
     echo "✅ 运行文件已保存到 $run_batch_file" >&2
+    if [ "$failed" -gt 0 ]; then
+        echo "❌ 有 $failed 个分片没有提交成功，见 $run_batch_file；其余分片照常用 --trackbatch 跟踪、收结果" >&2
+        exit 1
+    fi
     echo "Running batch job..."    
 }
 
+# 下次检查的间隔（秒）：按状态和任务已运行的时间退避
+# validating 刚提交，半分钟看一次；in_progress 按已运行时间的 1/10 退避，快完成时缩短；
+# finalizing 马上就有结果，勤看；结果夹在 BATCH_POLL_MIN 和 BATCH_POLL_MAX 之间
+# 参数: 状态 已运行秒数 总条数 已完成条数
+batch_poll_interval() {
+    local status="$1"
+    local age="$2"
+    local total="$3"
+    local completed="$4"
+    local interval
+
+    case "$status" in
+        validating) interval=30 ;;
+        in_progress)
+            interval=$((age / 10))
+            if [ "$total" -gt 0 ] && [ $((completed * 10)) -ge $((total * 9)) ]; then
+                interval=$((interval / 4))
+            fi
+            ;;
+        finalizing) interval=$BATCH_POLL_MIN ;;
+        *) interval=60 ;;
+    esac
+
+    [ "$interval" -lt "$BATCH_POLL_MIN" ] && interval=$BATCH_POLL_MIN
+    [ "$interval" -gt "$BATCH_POLL_MAX" ] && interval=$BATCH_POLL_MAX
+    echo "$interval"
+}
+
+# 合并多个分片的结果，按 custom_id 排序（纯数字的 custom_id 按数值排序）
+# 参数: 输出文件 分片结果文件...
+merge_batch_outputs() {
+    local output_file="$1"
+    shift
+
+    jq -R -r '
+        select(length > 0)
+        | ((fromjson? | .custom_id // "") | tostring
+           | if test("^[0-9]+$") then ([range(length; 20)] | map("0") | join("")) + . else . end)
+          + "\t" + .
+    ' "$@" | LC_ALL=C sort -s -t "$(printf '\t')" -k1,1 | cut -f2- > "$output_file.tmp.$$"
+    mv "$output_file.tmp.$$" "$output_file"
+}
+
+# 抢一个 .run 的处理权，别的 --trackbatch 正在处理时返回 1
+# 锁是 .run 旁边的 .lock 目录，持锁进程已经不在了（或者建了锁一分钟还没写 pid）视为残留锁
+batch_run_lock() {
+    local lock_dir="$1.lock"
+    if ! mkdir "$lock_dir" 2>/dev/null; then
+        local holder=$(cat "$lock_dir/pid" 2>/dev/null || true)
+        if [ -n "$holder" ]; then
+            kill -0 "$holder" 2>/dev/null && return 1
+        elif [ -z "$(find "$lock_dir" -maxdepth 0 -mmin +1 2>/dev/null)" ]; then
+            return 1
+        fi
+        warn "清理残留的 batch 锁: $lock_dir"
+        rm -rf "$lock_dir"
+        mkdir "$lock_dir" 2>/dev/null || return 1
+    fi
+    echo "${BASHPID:-$$}" > "$lock_dir/pid"
+}
+
+batch_run_unlock() {
+    rm -rf "$1.lock"
+}
+
+# 一轮检查多个 .run 文件
+# 每个 .run 先抢锁，别的进程正在处理的跳过，重叠的 crontab 不会重复下载、重复记账；
+# 所有到期的分片一次查状态；分片都有了结果（完成、失败、过期或取消）的 .run 一起下载已完成分片的结果，
+# 合并写好 .output 后改名为 .run.done；有分片没完成的，.output 里是其余分片的结果，
+# 没完成的分片（包括提交时就没建成任务、batch_id 为空的）记在 .run 的 failed_shards 里，改名为 .run.failed。都是原子的 mv，不会重复处理；
+# 其余的把下次检查时间写回 .run 的 track 字段
+# 参数: force(1 则不管下次检查时间) .run 文件...
+# 结果: TRACK_PENDING 仍在等待的 .run 数，TRACK_NEXT_CHECK 其中最早的下次检查时间
+TRACK_PENDING=0
+TRACK_NEXT_CHECK=0
+track_batch_runs() {
+    local force="$1"
+    shift
+
+    TRACK_PENDING=0
+    TRACK_NEXT_CHECK=0
+
+    local now=$(now_epoch)
+    local -a runs=() run_due=() run_shards=() run_next=() run_state=() run_locked=()
+    local -a sh_run=() sh_key=() sh_bid=() sh_status=() sh_out=()
+    local run_file r=0 key bid next
+
+    # 读出每个 .run 的分片，老的运行文件只有顶层 batch_id，当成一个分片
+    for run_file in "$@"; do
+        runs[$r]="$run_file"
+        run_shards[$r]=0
+        run_due[$r]=0
+        run_next[$r]=0
+        run_state[$r]=pending
+        run_locked[$r]=0
+        if ! batch_run_lock "$run_file"; then
+            echo "⏭️ $run_file 正在被另一个进程处理，跳过" >&2
+            run_state[$r]=busy
+            run_next[$r]=$((now + BATCH_POLL_MIN))
+            r=$((r + 1))
+            continue
+        fi
+        run_locked[$r]=1
+        # 抢到锁之前别的进程可能已经处理完、改了名
+        if [ ! -f "$run_file" ]; then
+            run_state[$r]=gone
+            r=$((r + 1))
+            continue
+        fi
+        # 字段用 \x1f 分隔，可能为空的 batch_id 放最后（tab 是空白分隔符，连续的会被合并）
+        while IFS=$'\x1f' read -r key next bid; do
+            run_next[$r]="$next"
+            local k=${#sh_run[@]}
+            sh_run[$k]=$r
+            sh_key[$k]="$key"
+            sh_bid[$k]="$bid"
+            sh_status[$k]=""
+            # 提交时上传或创建失败的分片没有 batch_id，不用查，当作失败；其余分片照常跟踪、收结果
+            [ -n "$bid" ] && [ "$bid" != null ] || sh_status[$k]=not_submitted
+            sh_out[$k]=""
+            run_shards[$r]=$((run_shards[$r] + 1))
+        done < <(jq -r '
+            (.track.next_check // 0) as $next
+            | (.shards // [{index: 0, batch_id: .batch_id}])[]
+            | [(.index | tostring), ($next | tostring), (.batch_id // "" | tostring)] | join("\u001f")
+        ' "$run_file" 2>/dev/null || true)
+
+        if [ "${run_shards[$r]}" -eq 0 ]; then
+            run_state[$r]=invalid
+        fi
+        if [ "${run_state[$r]}" = invalid ]; then
+            echo "❌ 运行文件格式错误: $run_file" >&2
+        elif [ "$force" = 1 ] || [ "${run_next[$r]}" -le "$now" ]; then
+            run_due[$r]=1
+        fi
+        r=$((r + 1))
+    done
+
+    # 1. 到期的分片一次查完
+    local k batch=$(transport_begin)
+    for k in "${!sh_run[@]}"; do
+        [ "${run_due[${sh_run[$k]}]}" = 1 ] && [ "${sh_status[$k]}" != not_submitted ] || continue
+        transport_add "$batch" "$k" GET "${API_BASE_URL}/batches/${sh_bid[$k]}"
+    done
+    transport_run "$batch" "$UPLOAD_JOBS"
+
+    local status output_file_id created_at total completed interval
+    for k in "${!sh_run[@]}"; do
+        r=${sh_run[$k]}
+        [ "${run_due[$r]}" = 1 ] && [ "${sh_status[$k]}" != not_submitted ] || continue
+        local body_file=$(transport_body "$batch" "$k")
+        local info=$(jq -r '[.status // "unknown", .created_at // 0, .request_counts.total // 0,
+                    .request_counts.completed // 0, .output_file_id // ""] | map(tostring) | join("\u001f")' \
+            "$body_file" 2>/dev/null || true)
+        [ -n "$info" ] || info=$'unknown\x1f0\x1f0\x1f0\x1f'
+        IFS=$'\x1f' read -r status created_at total completed output_file_id <<< "$info"
+        sh_status[$k]="$status"
+        sh_out[$k]="$output_file_id"
+
+        case "$status" in
+            completed)
+                [ -n "$output_file_id" ] || sh_status[$k]=finalizing
+                ;;
+            failed|expired|cancelled)
+                echo "❌ ${runs[$r]} 分片 ${sh_key[$k]} 的任务 ${sh_bid[$k]} 状态: $status" >&2
+                echo "Error Details: $(jq -c . "$body_file" 2>/dev/null)" >&2
+                ;;
+        esac
+
+        case "${sh_status[$k]}" in
+            completed|failed|expired|cancelled) ;;
+            *)
+                [ "$created_at" -gt 0 ] 2>/dev/null || created_at=$now
+                interval=$(batch_poll_interval "${sh_status[$k]}" $((now - created_at)) "$total" "$completed")
+                if [ "${run_next[$r]}" -le "$now" ] || [ $((now + interval)) -lt "${run_next[$r]}" ]; then
+                    run_next[$r]=$((now + interval))
+                fi
+                ;;
+        esac
+    done
+    transport_end "$batch"
+
+    # 2. 全部分片都有了结果的 .run 一起下载已完成分片的结果
+    for r in "${!runs[@]}"; do
+        [ "${run_due[$r]}" = 1 ] && [ "${run_state[$r]}" = pending ] || continue
+        run_state[$r]=finished
+        for k in "${!sh_run[@]}"; do
+            [ "${sh_run[$k]}" = "$r" ] || continue
+            case "${sh_status[$k]}" in
+                completed|failed|expired|cancelled|not_submitted) ;;
+                *) run_state[$r]=pending ;;
+            esac
+        done
+    done
+
+    batch=$(transport_begin)
+    for k in "${!sh_run[@]}"; do
+        [ "${run_state[${sh_run[$k]}]}" = finished ] && [ "${sh_status[$k]}" = completed ] || continue
+        echo "📥 开始下载文件 ID: ${sh_out[$k]}" >&2
+        transport_add "$batch" "$k" GET "${API_BASE_URL}/files/${sh_out[$k]}/content"
+    done
+    transport_run "$batch" "$UPLOAD_JOBS"
+
+    for r in "${!runs[@]}"; do
+        run_file="${runs[$r]}"
+        if [ "${run_state[$r]}" = finished ]; then
+            local -a result_files=()
+            local failed_shards=""
+            for k in "${!sh_run[@]}"; do
+                [ "${sh_run[$k]}" = "$r" ] || continue
+                if [ "${sh_status[$k]}" != completed ]; then
+                    failed_shards+="${sh_key[$k]}"$'\t'"${sh_bid[$k]:-null}"$'\t'"${sh_status[$k]}"$'\n'
+                    continue
+                fi
+                local result_file=$(transport_body "$batch" "$k")
+                if [ ! -s "$result_file" ] || [ "$(transport_status "$batch" "$k")" != 200 ]; then
+                    echo "❌ 下载结果为空，请检查 API 返回或权限设置: ${sh_out[$k]}" >&2
+                    run_state[$r]=pending
+                    run_next[$r]=$((now + BATCH_POLL_MIN))
+                    break
+                fi
+                result_files+=("$result_file")
+            done
+        fi
+        if [ "${run_state[$r]}" = finished ]; then
+            if [ ${#result_files[@]} -gt 0 ]; then
+                merge_batch_outputs "${run_file%.run}.output" "${result_files[@]}"
+                echo "✅ 文件已保存到 ${run_file%.run}.output" >&2
+                # 每条结果的 usage 记进账本，标签用提交时的
+                ledger_record batch "${run_file%.run}" "$(jq -r '.tag // ""' "$run_file" 2>/dev/null || true)" \
+                    < "${run_file%.run}.output" > /dev/null
+                if [ -n "${MARKDOWN_PATH:-}" ]; then
+                    batch_output_to_md "${run_file%.run}" "${run_file%.run}.output" "$MARKDOWN_PATH" || true
+                fi
+            fi
+            # 改名，下次运行时不执行
+            if [ -z "$failed_shards" ]; then
+                mv "$run_file" "$run_file.done"
+            else
+                printf '%s' "$failed_shards" | jq -R -s --slurpfile run "$run_file" '
+                    $run[0] + {failed_shards: (split("\n") | map(select(length > 0) | split("\t")
+                        | {index: (.[0] | tonumber), batch_id: (if .[1] == "null" then null else .[1] end), status: .[2]}))}
+                ' > "$run_file.tmp.$$" && mv "$run_file.tmp.$$" "$run_file"
+                mv "$run_file" "$run_file.failed"
+                if [ ${#result_files[@]} -gt 0 ]; then
+                    echo "❌ ${#result_files[@]} 个分片的结果已保存，其余分片没有完成，运行文件已改名为 $run_file.failed" >&2
+                else
+                    echo "❌ 任务失败，运行文件已改名为 $run_file.failed" >&2
+                fi
+            fi
+        fi
+
+        case "${run_state[$r]}" in
+            pending|busy) ;;
+            *) continue ;;
+        esac
+        TRACK_PENDING=$((TRACK_PENDING + 1))
+        if [ "$TRACK_NEXT_CHECK" -eq 0 ] || [ "${run_next[$r]}" -lt "$TRACK_NEXT_CHECK" ]; then
+            TRACK_NEXT_CHECK=${run_next[$r]}
+        fi
+        [ "${run_due[$r]}" = 1 ] || continue
+
+        # 记下这次的状态和下次检查时间
+        local done_count=0 failed_count=0 shard_total=0
+        for k in "${!sh_run[@]}"; do
+            [ "${sh_run[$k]}" = "$r" ] || continue
+            shard_total=$((shard_total + 1))
+            case "${sh_status[$k]}" in
+                completed) done_count=$((done_count + 1)) ;;
+                failed|expired|cancelled|not_submitted) failed_count=$((failed_count + 1)) ;;
+            esac
+        done
+        echo "📊 $run_file: $done_count/$shard_total 个分片已完成，$failed_count 个失败，$((run_next[$r] - now)) 秒后再查" >&2
+        jq --argjson now "$now" --argjson next "${run_next[$r]}" \
+            --argjson done "$done_count" --argjson failed "$failed_count" --argjson total "$shard_total" '
+            .track = {
+                checks: ((.track.checks // 0) + 1),
+                last_check: $now,
+                next_check: $next,
+                shards_completed: $done,
+                shards_failed: $failed,
+                shards_total: $total
+            }' "$run_file" > "$run_file.tmp.$$" && mv "$run_file.tmp.$$" "$run_file"
+    done
+    transport_end "$batch"
+
+    for r in "${!runs[@]}"; do
+        [ "${run_locked[$r]}" = 1 ] && batch_run_unlock "${runs[$r]}"
+    done
+    return 0
+}
+
+# 跟踪目录里所有未完成的 .run 文件，适合放在 crontab 里跑
+# 不加 watch 只检查一轮（还没到下次检查时间的跳过）；加 watch 则一直等到全部完成
+track_batch_dir() {
+    local dir="$1"
+    local watch="${2:-}"
+
+    if [ ! -d "$dir" ]; then
+        echo "❌ 目录不存在: $dir" >&2
+        exit 1
+    fi
+
+    local -a run_files=()
+    local run_file wait_seconds
+    while true; do
+        run_files=()
+        while IFS= read -r -d '' run_file; do
+            run_files+=("$run_file")
+        done < <(find "$dir" -maxdepth 1 -type f -name '*.run' -print0)
+
+        if [ "${#run_files[@]}" -eq 0 ]; then
+            echo "✅ 没有待处理的 batch 任务: $dir" >&2
+            break
+        fi
+
+        track_batch_runs 0 "${run_files[@]}"
+        [ "$TRACK_PENDING" -gt 0 ] || break
+
+        wait_seconds=$((TRACK_NEXT_CHECK - $(now_epoch)))
+        [ "$wait_seconds" -lt 1 ] && wait_seconds=1
+        echo "⏳ 还有 $TRACK_PENDING 个 batch 在等待，${wait_seconds} 秒后再查" >&2
+        [ "$watch" = watch ] || break
+        sleep "$wait_seconds"
+    done
+}
+
+# batch 结果里的一行，join 上原请求后渲染成一篇笔记
+# 输入: custom_id<TAB>请求条目<TAB>结果，请求条目可能为空（batch 文件里找不到）
+BATCH_MD_FILTER='
+split("\t") as [$key, $req, $out]
+| ($req | fromjson? // {}) as $item
+| ($out | fromjson? // {}) as $res
+| ($item.body // {}) as $body
+| ($res.response.body // {}) as $rb
+| ([$body.messages[]? | select(.role == "user") | .content][0] | md_title) as $title
+| (if ($res.error // null) != null then "❌ 请求失败: \($res.error.message // ($res.error | tojson))"
+   elif ($res.response.status_code // 200) != 200 then "❌ 请求失败: \($rb.error.message // ($rb | tojson))"
+   else ($rb.choices[0].message.content // "") end) as $content
+| [$body.messages[]? | select(.role == "system") | .content | tostring
+   | select(startswith("fileid://")) | ltrimstr("fileid://")] as $file_ids
+| md_record(
+    (($rb.created // now) | md_time) + "_" + ($key | md_safe_name) + "_" + ($title | .[0:50] | md_safe_name) + ".md";
+    md_note($title; $content; [
+        "模型名称：\($rb.model // $body.model // "无")",
+        "custom_id：\($key)",
+        "文件ID：\(if ($file_ids | length) > 0 then $file_ids | join(", ") else "无" end)"
+    ]))
+'
+
+# batch 结果转成 markdown，每个请求一篇笔记，写进 md 目录
+# 结果和 batch 文件各自按 custom_id 外部排序后 join，内存占用和文件大小无关；
+# join 好的行切成 RENDER_JOBS 份，每份一个 jq + awk 并行渲染
+# 参数: batch 文件 结果文件 md 目录
+batch_output_to_md() {
+    local batch_file="$1"
+    local output_file="$2"
+    local md_dir="$3"
+
+    if [ ! -s "$output_file" ]; then
+        error "❌ batch 结果文件不存在或为空: $output_file"
+        return 1
+    fi
+    mkdir -p "$md_dir"
+
+    local work_dir=$(mktemp -d "${TMPDIR:-/tmp}/qwen_batchmd.XXXXXX")
+    local tab=$(printf '\t')
+    local key_filter='select(length > 0) | ((fromjson? | .custom_id // "") | tostring) + "\t" + .'
+
+    if [ -f "$batch_file" ]; then
+        jq -R -r "$key_filter" "$batch_file" | LC_ALL=C sort -t "$tab" -k1,1 > "$work_dir/requests"
+    else
+        warn "找不到 batch 文件 $batch_file，笔记里只有结果"
+        : > "$work_dir/requests"
+    fi
+    jq -R -r "$key_filter" "$output_file" | LC_ALL=C sort -t "$tab" -k1,1 > "$work_dir/outputs"
+    LC_ALL=C join -t "$tab" -a 2 -e '' -o 0,1.2,2.2 "$work_dir/requests" "$work_dir/outputs" > "$work_dir/joined"
+
+    local total=$(wc -l < "$work_dir/joined" | tr -d ' ')
+    local jobs="${RENDER_JOBS:-1}"
+    local chunk=$(( (total + jobs - 1) / jobs ))
+    [ "$chunk" -lt 1 ] && chunk=1
+    (cd "$work_dir" && split -l "$chunk" joined chunk.)
+
+    export MD_JQ_DEFS BATCH_MD_FILTER
+    export -f md_split_records
+    local count=$(find "$work_dir" -name 'chunk.*' -print0 |
+        xargs -0 -n 1 -P "$jobs" bash -c 'jq -r -R "$MD_JQ_DEFS $BATCH_MD_FILTER" "$2" | md_split_records "$1"' _ "$md_dir" |
+        wc -l | tr -d ' ')
+    rm -rf "$work_dir"
+
+    info "✅ 已生成 $count 篇 markdown 笔记: $md_dir"
+}
+
 output_batch() {
-    # 本函数可以放在crontab中去跑
+    # 本函数可以放在crontab中去跑，多个 batch 文件可以用 --trackbatch 一起跑
     local batch_file="$1"
     local run_batch_file="$batch_file.run"
-    local output_batch_file="$batch_file.output"
     local done_batch_file="$run_batch_file.done"
 
     if [ -f "$done_batch_file" ]; then
@@ -257,32 +961,12 @@ output_batch() {
         exit 1
     fi
 
-    if ! jq -e '.batch_id' "$run_batch_file" >/dev/null 2>&1; then
-        echo "❌ 运行文件格式错误" >&2
-        exit 1
-    fi
-
-    local output_file="output_$batch_file"
-
-    local batch_id=$(jq -r '.batch_id' "$run_batch_file")
+    track_batch_runs 1 "$run_batch_file"
 
-    # 执行5次查询
-    local job_status=$(poll_job_status "$batch_id" 5)
-
-    if [ "$job_status" != "completed" ]; then
+    if [ ! -f "$done_batch_file" ]; then
         echo "❌ 任务未完成" >&2
         exit 1
     fi
-    
-    local output_file_id=$(get_output_file_id "$batch_id")
-
-    sleep 5
-
-    download_results "$output_file_id" "$output_batch_file"
-
-    # 改名，下次运行时不执行
-    mv "$run_batch_file" "$run_batch_file.done"
-
 }
 
 # testing run
@@ -0,0 +1,453 @@
+#!/usr/bin/env python3
+# 本地模拟的 DashScope 服务，测性能、做回归时不花真的额度
+# 只用标准库。模拟 qwen / qwenvl.sh 用到的接口：
+#   /compatible-mode/v1/files            上传（multipart）、分页列表、查询、删除、下载内容
+#   /compatible-mode/v1/chat/completions 流式 SSE（带 usage 分片）和非流式
+#   /compatible-mode/v1/batches          创建、查询、取消，状态按时间推进 validating -> in_progress -> finalizing -> completed
+#   /api/v1/uploads?action=getPolicy     qwen-vl 的上传凭证，upload_host 指回本服务的 /oss
+#   /oss                                 OSS 表单上传
+#   /__stats                             各接口的请求数、收发字节数，?reset=1 顺便清零
+#   /__config                            POST 一个 JSON 在运行中改参数，如 {"tokens": 20000, "token_rate": 0}
+# 可以配置延迟、出字速度和错误注入，例如:
+#   python3 mock_dashscope.py --port 18080 --latency 50 --token-rate 200 --error-rate 0.05
+
+import argparse
+import hashlib
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+COMPAT = "/compatible-mode/v1"
+NATIVE = "/api/v1"
+
+# batch 状态推进：创建后经过 --batch-seconds 的这些比例进入下一个状态
+BATCH_PHASES = [(0.0, "validating"), (0.1, "in_progress"), (0.9, "finalizing"), (1.0, "completed")]
+
+
+class State:
+    def __init__(self):
+        # get_batch 持锁调用 batch_view，到期时 finish_batch 还要再拿一次，所以要可重入
+        self.lock = threading.RLock()
+        self.files = {}       # id -> 文件信息，按插入顺序，列表时倒序（新的在前）
+        self.contents = {}    # id -> 内容，只存 batch 用的文件和 batch 结果
+        self.batches = {}
+        self.prefixes = set()  # 见过的对话前缀，用来模拟缓存命中
+        self.stats = {}
+
+    def count(self, route, up, down):
+        with self.lock:
+            s = self.stats.setdefault(route, {"requests": 0, "up_bytes": 0, "down_bytes": 0})
+            s["requests"] += 1
+            s["up_bytes"] += up
+            s["down_bytes"] += down
+
+
+STATE = State()
+ARGS = None
+
+
+def new_id(prefix):
+    return prefix + uuid.uuid4().hex[:16]
+
+
+def token_count(text):
+    # 粗略按 4 个字符一个 token
+    return max(1, len(text) // 4)
+
+
+def parse_multipart(content_type, body):
+    """multipart/form-data 解析成 {字段名: (文件名, 内容)}"""
+    msg = BytesParser(policy=HTTP).parsebytes(
+        b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+    fields = {}
+    for part in msg.iter_parts():
+        name = part.get_param("name", header="content-disposition")
+        if name:
+            fields[name] = (part.get_filename(), part.get_payload(decode=True) or b"")
+    return fields
+
+
+def batch_view(batch):
+    """按创建以来的时间算出当前状态，到 completed 时生成结果文件"""
+    if batch["status"] in ("completed", "cancelled", "failed"):
+        return batch
+    elapsed = time.time() - batch["created_at_f"]
+    total = ARGS.batch_seconds
+    status = "validating"
+    for frac, name in BATCH_PHASES:
+        if elapsed >= frac * total:
+            status = name
+    n = batch["request_counts"]["total"]
+    if status == "in_progress" and total > 0:
+        batch["request_counts"]["completed"] = min(n, int(n * elapsed / total))
+    if status == "completed":
+        finish_batch(batch)
+    batch["status"] = status
+    return batch
+
+
+def finish_batch(batch):
+    lines = []
+    source = STATE.contents.get(batch["input_file_id"], b"").decode("utf-8", "replace")
+    for line in source.splitlines():
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError:
+            continue
+        body = item.get("body", {})
+        prompt = json.dumps(body.get("messages", []), ensure_ascii=False)
+        lines.append(json.dumps({
+            "id": new_id("req-"),
+            "custom_id": item.get("custom_id"),
+            "response": {
+                "status_code": 200,
+                "request_id": new_id(""),
+                "body": {
+                    "id": new_id("chatcmpl-"),
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": body.get("model", "qwen-long"),
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": "answer " + str(item.get("custom_id"))}}],
+                    "usage": {"prompt_tokens": token_count(prompt), "completion_tokens": 8,
+                              "total_tokens": token_count(prompt) + 8},
+                },
+            },
+            "error": None,
+        }, ensure_ascii=False))
+    # 真服务的结果不保证顺序
+    random.shuffle(lines)
+    out_id = new_id("file-batch_output-")
+    data = ("\n".join(lines) + "\n").encode() if lines else b""
+    with STATE.lock:
+        STATE.contents[out_id] = data
+        STATE.files[out_id] = {"id": out_id, "object": "file", "bytes": len(data), "created_at": int(time.time()),
+                               "filename": out_id + ".jsonl", "purpose": "batch_output", "status": "processed"}
+    batch["output_file_id"] = out_id
+    batch["completed_at"] = int(time.time())
+    batch["request_counts"]["completed"] = len(lines)
+    batch["status"] = "completed"
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "mock-dashscope"
+
+    def log_message(self, fmt, *args):
+        if ARGS.verbose:
+            sys.stderr.write("%s %s\n" % (self.command, self.path))
+
+    # ---- 输出 ----
+
+    def send_json(self, obj, code=200, headers=None):
+        data = json.dumps(obj, ensure_ascii=False).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+        self.sent += len(data)
+
+    def send_error_json(self, code, message, err_code):
+        headers = {"Retry-After": str(ARGS.retry_after)} if code == 429 else None
+        self.send_json({"error": {"message": message, "type": err_code, "code": err_code}}, code, headers)
+
+    def chunk(self, text):
+        data = text.encode()
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+        self.sent += len(data)
+
+    # ---- 分发 ----
+
+    def handle_any(self):
+        self.sent = 0
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        url = urlparse(self.path)
+        route = self.route_name(url.path)
+        # /__stats、/__config 不算延迟、不注入错误、不计数
+        if url.path.startswith("/__"):
+            return self.dispatch(route, url, body)
+        try:
+            if ARGS.latency:
+                time.sleep(ARGS.latency / 1000.0)
+            if ARGS.error_rate and random.random() < ARGS.error_rate:
+                if ARGS.error_status == 429:
+                    self.send_error_json(429, "Requests rate limit exceeded, please try again later.", "Throttling.RateQuota")
+                else:
+                    self.send_error_json(ARGS.error_status, "Injected server error", "InternalError")
+            else:
+                self.dispatch(route, url, body)
+        finally:
+            STATE.count(route, length, self.sent)
+
+    def route_name(self, path):
+        for prefix in (COMPAT, NATIVE):
+            if path.startswith(prefix):
+                path = path[len(prefix):]
+                break
+        parts = path.strip("/").split("/")
+        # 资源 id 换成 {id}，统计按接口归类
+        if len(parts) >= 2 and parts[0] in ("files", "batches"):
+            parts[1] = "{id}"
+        return "%s /%s" % (self.command, "/".join(parts))
+
+    def dispatch(self, route, url, body):
+        query = parse_qs(url.query)
+        fid = url.path.rstrip("/").split("/")
+        handlers = {
+            "POST /files": lambda: self.upload_file(body),
+            "GET /files": lambda: self.list_files(query),
+            "GET /files/{id}": lambda: self.get_file(fid[-1]),
+            "GET /files/{id}/content": lambda: self.file_content(fid[-2]),
+            "DELETE /files/{id}": lambda: self.delete_file(fid[-1]),
+            "POST /chat/completions": lambda: self.chat(body),
+            "POST /batches": lambda: self.create_batch(body),
+            "GET /batches/{id}": lambda: self.get_batch(fid[-1]),
+            "POST /batches/{id}/cancel": lambda: self.cancel_batch(fid[-2]),
+            "GET /uploads": lambda: self.upload_policy(query),
+            "POST /oss": lambda: self.oss_upload(body),
+            "GET /__stats": lambda: self.get_stats(query),
+            "POST /__config": lambda: self.set_config(body),
+        }
+        handler = handlers.get(route)
+        if handler is None:
+            self.send_error_json(404, "Not found: " + route, "NotFound")
+        else:
+            handler()
+
+    do_GET = do_POST = do_DELETE = handle_any
+
+    # ---- files ----
+
+    def upload_file(self, body):
+        try:
+            fields = parse_multipart(self.headers.get("Content-Type", ""), body)
+        except Exception:
+            fields = {}
+        if "file" not in fields:
+            return self.send_error_json(400, "Missing file", "InvalidParameter")
+        filename, data = fields["file"]
+        purpose = fields.get("purpose", (None, b"file-extract"))[1].decode() or "file-extract"
+        fid = new_id("file-batch-" if purpose == "batch" else "file-fe-")
+        info = {"id": fid, "object": "file", "bytes": len(data), "created_at": int(time.time()),
+                "filename": filename or "upload", "purpose": purpose, "status": "processed"}
+        with STATE.lock:
+            STATE.files[fid] = info
+            if purpose == "batch":
+                STATE.contents[fid] = data
+        self.send_json(info)
+
+    def list_files(self, query):
+        limit = int(query.get("limit", ["20"])[0])
+        after = query.get("after", [None])[0]
+        with STATE.lock:
+            items = list(reversed(list(STATE.files.values())))
+        if after:
+            ids = [f["id"] for f in items]
+            items = items[ids.index(after) + 1:] if after in ids else []
+        self.send_json({"object": "list", "data": items[:limit], "has_more": len(items) > limit})
+
+    def get_file(self, fid):
+        info = STATE.files.get(fid)
+        if info is None:
+            return self.send_error_json(404, "File not found", "NotFound")
+        self.send_json(info)
+
+    def file_content(self, fid):
+        data = STATE.contents.get(fid)
+        if data is None:
+            return self.send_error_json(404, "File not found", "NotFound")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        self.sent += len(data)
+
+    def delete_file(self, fid):
+        with STATE.lock:
+            found = STATE.files.pop(fid, None)
+            STATE.contents.pop(fid, None)
+        if found is None:
+            return self.send_error_json(404, "File not found", "NotFound")
+        self.send_json({"id": fid, "object": "file", "deleted": True})
+
+    # ---- chat ----
+
+    def chat(self, body):
+        try:
+            req = json.loads(body or b"{}")
+        except ValueError:
+            return self.send_error_json(400, "Invalid JSON", "InvalidParameter")
+        model = req.get("model", "qwen-long")
+        messages = req.get("messages", [])
+        prompt_tokens = token_count(json.dumps(messages, ensure_ascii=False))
+        # 除最后一条以外的前缀见过，就算这部分命中缓存
+        prefix = json.dumps(messages[:-1], ensure_ascii=False)
+        key = hashlib.sha1(prefix.encode()).hexdigest()
+        with STATE.lock:
+            cached = token_count(prefix) if len(messages) > 1 and key in STATE.prefixes else 0
+            STATE.prefixes.add(key)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": ARGS.tokens,
+                 "total_tokens": prompt_tokens + ARGS.tokens,
+                 "prompt_tokens_details": {"cached_tokens": min(cached, prompt_tokens)}}
+        cid = new_id("chatcmpl-")
+        created = int(time.time())
+
+        if not req.get("stream"):
+            if ARGS.token_rate:
+                time.sleep(ARGS.tokens / float(ARGS.token_rate))
+            text = "".join("tok%d " % i for i in range(ARGS.tokens))
+            return self.send_json({"id": cid, "object": "chat.completion", "created": created, "model": model,
+                                   "choices": [{"index": 0, "finish_reason": "stop",
+                                                "message": {"role": "assistant", "content": text}}],
+                                   "usage": usage})
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        delay = 1.0 / ARGS.token_rate if ARGS.token_rate else 0
+        base = {"id": cid, "object": "chat.completion.chunk", "created": created, "model": model}
+        for i in range(ARGS.tokens):
+            chunk = dict(base, choices=[{"index": 0, "delta": {"content": "tok%d " % i}, "finish_reason": None}])
+            self.chunk("data: " + json.dumps(chunk) + "\n\n")
+            if delay:
+                time.sleep(delay)
+        self.chunk("data: " + json.dumps(dict(base, choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}])) + "\n\n")
+        if (req.get("stream_options") or {}).get("include_usage"):
+            self.chunk("data: " + json.dumps(dict(base, choices=[], usage=usage)) + "\n\n")
+        self.chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    # ---- batches ----
+
+    def create_batch(self, body):
+        try:
+            req = json.loads(body or b"{}")
+        except ValueError:
+            return self.send_error_json(400, "Invalid JSON", "InvalidParameter")
+        input_id = req.get("input_file_id")
+        if input_id not in STATE.contents:
+            return self.send_error_json(400, "input_file_id not found", "InvalidParameter")
+        total = sum(1 for line in STATE.contents[input_id].splitlines() if line.strip())
+        now = time.time()
+        bid = new_id("batch_")
+        batch = {"id": bid, "object": "batch", "endpoint": req.get("endpoint"), "input_file_id": input_id,
+                 "completion_window": req.get("completion_window", "24h"), "status": "validating",
+                 "output_file_id": None, "error_file_id": None, "created_at": int(now), "created_at_f": now,
+                 "completed_at": None, "metadata": req.get("metadata"),
+                 "request_counts": {"total": total, "completed": 0, "failed": 0}}
+        with STATE.lock:
+            STATE.batches[bid] = batch
+        self.send_json(self.public_batch(batch_view(batch)))
+
+    def get_batch(self, bid):
+        batch = STATE.batches.get(bid)
+        if batch is None:
+            return self.send_error_json(404, "Batch not found", "NotFound")
+        with STATE.lock:
+            batch_view(batch)
+        self.send_json(self.public_batch(batch))
+
+    def cancel_batch(self, bid):
+        batch = STATE.batches.get(bid)
+        if batch is None:
+            return self.send_error_json(404, "Batch not found", "NotFound")
+        if batch["status"] not in ("completed", "failed"):
+            batch["status"] = "cancelled"
+        self.send_json(self.public_batch(batch))
+
+    @staticmethod
+    def public_batch(batch):
+        return {k: v for k, v in batch.items() if k != "created_at_f"}
+
+    # ---- qwen-vl 的 OSS 上传 ----
+
+    def upload_policy(self, query):
+        if query.get("action", [""])[0] != "getPolicy":
+            return self.send_error_json(400, "Unknown action", "InvalidParameter")
+        host = "http://%s:%d/oss" % self.server.server_address[:2]
+        model = query.get("model", ["qwen-vl-max"])[0]
+        self.send_json({"request_id": new_id(""), "data": {
+            "policy": "bW9jay1wb2xpY3k=", "signature": "mock-signature",
+            "upload_dir": "dashscope-instant/mock/%s/%s" % (model, time.strftime("%Y-%m-%d")),
+            "upload_host": host, "expire_in_seconds": 300, "max_file_size_mb": 100, "capacity_limit_mb": 999999,
+            "oss_access_key_id": "mock-access-key", "x_oss_object_acl": "private", "x_oss_forbid_overwrite": "true"}})
+
+    def oss_upload(self, body):
+        try:
+            fields = parse_multipart(self.headers.get("Content-Type", ""), body)
+        except Exception:
+            fields = {}
+        if "file" not in fields or "key" not in fields:
+            return self.send_error_json(400, "Missing key or file", "InvalidArgument")
+        status = int(fields.get("success_action_status", (None, b"204"))[1] or 204)
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    # ---- 统计 ----
+
+    def get_stats(self, query):
+        with STATE.lock:
+            stats = {k: dict(v) for k, v in STATE.stats.items()}
+            if query.get("reset", ["0"])[0] == "1":
+                STATE.stats.clear()
+        self.send_json(stats)
+
+    def set_config(self, body):
+        try:
+            changes = json.loads(body or b"{}")
+        except ValueError:
+            return self.send_error_json(400, "Invalid JSON", "InvalidParameter")
+        for key, value in changes.items():
+            if key in ("host", "port") or not hasattr(ARGS, key):
+                return self.send_error_json(400, "Unknown option: " + key, "InvalidParameter")
+            setattr(ARGS, key, type(getattr(ARGS, key))(value) if getattr(ARGS, key) is not None else value)
+        self.send_json({k: v for k, v in vars(ARGS).items()})
+
+
+def main():
+    global ARGS
+    parser = argparse.ArgumentParser(description="本地模拟的 DashScope 服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18080, help="0 则随机选一个空闲端口")
+    parser.add_argument("--latency", type=float, default=0, help="每个请求先等这么多毫秒")
+    parser.add_argument("--tokens", type=int, default=200, help="每次对话输出多少个 token")
+    parser.add_argument("--token-rate", type=float, default=0, help="每秒输出多少个 token，0 不限")
+    parser.add_argument("--error-rate", type=float, default=0, help="这个比例的请求直接返回错误")
+    parser.add_argument("--error-status", type=int, default=429, help="注入的错误状态码，429 时带 Retry-After")
+    parser.add_argument("--retry-after", type=int, default=1, help="429 的 Retry-After 秒数")
+    parser.add_argument("--batch-seconds", type=float, default=0, help="batch 从创建到完成的秒数")
+    parser.add_argument("--seed", type=int, default=None, help="错误注入的随机种子")
+    parser.add_argument("-v", "--verbose", action="store_true", help="每个请求打一行日志")
+    ARGS = parser.parse_args()
+    if ARGS.seed is not None:
+        random.seed(ARGS.seed)
+
+    server = ThreadingHTTPServer((ARGS.host, ARGS.port), Handler)
+    server.daemon_threads = True
+    # 第一行输出实际端口，--port 0 时调用者从这里读
+    print("listening on http://%s:%d" % server.server_address[:2], flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
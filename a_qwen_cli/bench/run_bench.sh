@@ -0,0 +1,262 @@
+#!/bin/bash
+
+# 端到端性能测试，全部打到本地的 mock_dashscope.py，不花额度
+# 把 qwen 复制一份到临时目录（缓存、账本、日志都在脚本目录下，不碰正在用的那份），
+# 用 QWEN_API_BASE_URL / QWEN_DASHSCOPE_API_URL 指向模拟服务，逐个场景跑，每个场景一行：
+#   墙钟时间、起了多少个进程、发了多少请求和收发字节数（模拟服务统计）、吞吐
+# 进程数：有 strace 时数 execve，精确；没有时看 /proc/loadavg 里最新的 pid 前后差多少，是整机的近似值（带 ~）
+#
+# 用法: run_bench.sh [选项] [场景...]
+#   场景: cold_dir warm_dir long_stream batch vl，默认全部，按这个顺序跑
+#   --files N      cold_dir / warm_dir 的文件数，默认 500
+#   --items N      batch 的条数，默认 10000
+#   --tokens N     long_stream 输出的 token 数，默认 20000
+#   --images N     vl 的图片数，默认 10
+#   --latency MS   模拟服务每个请求的延迟，默认 20
+#   --token-rate N 模拟服务每秒出多少 token，默认 0 不限
+#   --error-rate F 注入错误的比例，默认 0
+#   --rps N        传给 qwen 的 --rps，默认 0 不限速，只看脚本自身的开销
+#   --json FILE    每个场景再追加一行 JSON，带 git 版本，方便前后对比
+#   --keep         保留临时目录，看日志
+
+set -u
+set -o pipefail
+
+BENCH_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+CLI_DIR="$(dirname "$BENCH_DIR")"
+
+FILES=500
+ITEMS=10000
+STREAM_TOKENS=20000
+IMAGES=10
+LATENCY=20
+TOKEN_RATE=0
+ERROR_RATE=0
+RPS=0
+JSON_OUT=""
+KEEP=""
+SCENARIOS=()
+
+while [ $# -gt 0 ]; do
+    case "$1" in
+        --files) FILES="$2"; shift 2 ;;
+        --items) ITEMS="$2"; shift 2 ;;
+        --tokens) STREAM_TOKENS="$2"; shift 2 ;;
+        --images) IMAGES="$2"; shift 2 ;;
+        --latency) LATENCY="$2"; shift 2 ;;
+        --token-rate) TOKEN_RATE="$2"; shift 2 ;;
+        --error-rate) ERROR_RATE="$2"; shift 2 ;;
+        --rps) RPS="$2"; shift 2 ;;
+        --json) JSON_OUT="$2"; shift 2 ;;
+        --keep) KEEP=1; shift ;;
+        -h|--help)
+            sed -n '3,21p' "${BASH_SOURCE[0]}" | sed 's/^# \{0,1\}//'
+            exit 0
+            ;;
+        cold_dir|warm_dir|long_stream|batch|vl) SCENARIOS+=("$1"); shift ;;
+        *)
+            echo "❌ 未知参数: $1" >&2
+            exit 1
+            ;;
+    esac
+done
+[ ${#SCENARIOS[@]} -gt 0 ] || SCENARIOS=(cold_dir warm_dir long_stream batch vl)
+
+for cmd in python3 curl jq; do
+    if ! command -v "$cmd" > /dev/null; then
+        echo "❌ 缺少依赖: $cmd" >&2
+        exit 1
+    fi
+done
+
+WORK_DIR=$(mktemp -d "${TMPDIR:-/tmp}/qwen_bench.XXXXXX")
+MOCK_PID=""
+cleanup() {
+    [ -n "$MOCK_PID" ] && kill "$MOCK_PID" 2>/dev/null
+    if [ -n "$KEEP" ]; then
+        echo "临时目录保留在: $WORK_DIR" >&2
+    else
+        rm -rf "$WORK_DIR"
+    fi
+}
+trap cleanup EXIT
+
+# ==================
+# = 准备 =
+# ==================
+
+# qwen 复制一份，假的 API key
+mkdir -p "$WORK_DIR/cli" "$WORK_DIR/data" "$WORK_DIR/logs"
+cp "$CLI_DIR"/qwen "$CLI_DIR"/*.sh "$CLI_DIR"/config.json "$WORK_DIR/cli/"
+[ -f "$CLI_DIR/.qwenignore" ] && cp "$CLI_DIR/.qwenignore" "$WORK_DIR/cli/"
+printf '{"api_key": "%s"}\n' "$(printf 'sk-bench' | base64)" > "$WORK_DIR/cli/apikey.json"
+QWEN="$WORK_DIR/cli/qwen"
+
+# 模拟服务，随机端口，第一行输出实际地址
+python3 "$BENCH_DIR/mock_dashscope.py" --port 0 --latency "$LATENCY" --token-rate "$TOKEN_RATE" \
+    --error-rate "$ERROR_RATE" > "$WORK_DIR/mock.out" 2> "$WORK_DIR/mock.err" &
+MOCK_PID=$!
+MOCK_URL=""
+for _ in $(seq 1 50); do
+    read -r _ _ MOCK_URL < "$WORK_DIR/mock.out" 2>/dev/null
+    [ -n "$MOCK_URL" ] && break
+    sleep 0.1
+done
+if [ -z "$MOCK_URL" ]; then
+    echo "❌ 模拟服务没有启动" >&2
+    cat "$WORK_DIR/mock.err" >&2
+    exit 1
+fi
+
+# 限速的令牌桶也单独一份，不和正在跑的 qwen 抢
+export QWEN_API_BASE_URL="$MOCK_URL/compatible-mode/v1"
+export QWEN_DASHSCOPE_API_URL="$MOCK_URL/api/v1"
+export RATE_LIMIT_DIR="$WORK_DIR/ratelimit"
+export QWEN_NO_SERVE=1
+unset QWEN_PROFILE QWEN_TAG
+
+mock_config() {
+    curl -sS -X POST -d "$1" "$MOCK_URL/__config" > /dev/null
+}
+
+# ==================
+# = 计时和计数 =
+# ==================
+
+STRACE=""
+command -v strace > /dev/null && STRACE=yes
+
+now_us() {
+    if [ -n "${EPOCHREALTIME:-}" ]; then
+        local t="${EPOCHREALTIME//[!0-9]/}"
+        echo $((10#$t))
+    else
+        echo $(( $(date +%s) * 1000000 ))
+    fi
+}
+
+last_pid() {
+    local a b c d pid=""
+    [ -r /proc/loadavg ] && read -r a b c d pid < /proc/loadavg
+    echo "$pid"
+}
+
+GIT_REV=$(git -C "$CLI_DIR" rev-parse --short HEAD 2>/dev/null || echo unknown)
+
+printf '%-14s %4s %9s %8s %9s %11s %11s  %s\n' scenario rc wall_s procs requests up_KB down_KB throughput
+
+# 跑一个场景
+# 参数: 名字 吞吐单位 数量 命令...
+bench_run() {
+    local name="$1"
+    local unit="$2"
+    local count="$3"
+    shift 3
+
+    curl -sS "$MOCK_URL/__stats?reset=1" > /dev/null
+    local log="$WORK_DIR/logs/$name.log"
+    local rc=0 procs start end pid0 pid1
+    pid0=$(last_pid)
+    start=$(now_us)
+    if [ -n "$STRACE" ]; then
+        strace -f -qq -e trace=execve -o "$WORK_DIR/logs/$name.strace" "$@" > "$log" 2>&1 < /dev/null || rc=$?
+    else
+        "$@" > "$log" 2>&1 < /dev/null || rc=$?
+    fi
+    end=$(now_us)
+    pid1=$(last_pid)
+
+    if [ -n "$STRACE" ]; then
+        procs=$(grep -c 'execve(' "$WORK_DIR/logs/$name.strace")
+    elif [ -n "$pid0" ] && [ -n "$pid1" ] && [ "$pid1" -ge "$pid0" ]; then
+        procs="~$((pid1 - pid0))"
+    else
+        procs="-"
+    fi
+
+    local requests up down
+    IFS=$'\t' read -r requests up down < <(curl -sS "$MOCK_URL/__stats" |
+        jq -r '[(map(.requests) | add // 0), (map(.up_bytes) | add // 0), (map(.down_bytes) | add // 0)] | @tsv')
+
+    local wall=$(awk -v us="$((end - start))" 'BEGIN { printf "%.3f", us / 1000000 }')
+    local rate=$(awk -v n="$count" -v us="$((end - start))" 'BEGIN { printf "%.1f", (us > 0 ? n * 1000000 / us : 0) }')
+    printf '%-14s %4s %9s %8s %9s %11.1f %11.1f  %s %s/s\n' "$name" "$rc" "$wall" "$procs" "$requests" \
+        "$(awk -v b="$up" 'BEGIN { print b / 1024 }')" "$(awk -v b="$down" 'BEGIN { print b / 1024 }')" "$rate" "$unit"
+    [ "$rc" -eq 0 ] || echo "   ⚠️  退出码 $rc，日志: $log" >&2
+
+    if [ -n "$JSON_OUT" ]; then
+        jq -n -c --arg scenario "$name" --arg rev "$GIT_REV" --arg procs "$procs" --arg unit "$unit" \
+            --argjson rc "$rc" --argjson wall "$wall" --argjson count "$count" --argjson rate "$rate" \
+            --argjson requests "$requests" --argjson up "$up" --argjson down "$down" \
+            '{time: (now | floor), rev: $rev, scenario: $scenario, rc: $rc, wall_s: $wall, procs: $procs,
+              requests: $requests, up_bytes: $up, down_bytes: $down, count: $count, unit: $unit, rate: $rate}' >> "$JSON_OUT"
+    fi
+}
+
+# ==================
+# = 场景 =
+# ==================
+
+# 内容各不相同的小文件，一个 awk 写完
+make_docs() {
+    local dir="$WORK_DIR/data/docs"
+    [ -d "$dir" ] && return 0
+    mkdir -p "$dir"
+    awk -v dir="$dir" -v n="$FILES" 'BEGIN {
+        for (i = 1; i <= n; i++) {
+            f = sprintf("%s/doc_%05d.txt", dir, i)
+            printf "bench document %d\n%s\n", i, "lorem ipsum dolor sit amet " i > f
+            close(f)
+        }
+    }'
+}
+
+scenario_cold_dir() {
+    make_docs
+    rm -rf "$WORK_DIR/cli/qwenlong_cache.d" "$WORK_DIR/cli/qwenlong_cache.json"
+    bench_run cold_dir files "$FILES" bash "$QWEN" --rps "$RPS" --echo off "$WORK_DIR/data/docs" "总结这些文档"
+}
+
+scenario_warm_dir() {
+    make_docs
+    # 单独跑 warm_dir 时先把缓存填上
+    [ -d "$WORK_DIR/cli/qwenlong_cache.d" ] ||
+        bash "$QWEN" --rps "$RPS" --echo off "$WORK_DIR/data/docs" "预热" > "$WORK_DIR/logs/warm_prime.log" 2>&1 < /dev/null
+    bench_run warm_dir files "$FILES" bash "$QWEN" --rps "$RPS" --echo off "$WORK_DIR/data/docs" "总结这些文档"
+}
+
+scenario_long_stream() {
+    mock_config "{\"tokens\": $STREAM_TOKENS}"
+    bench_run long_stream tokens "$STREAM_TOKENS" bash "$QWEN" --rps "$RPS" --echo off "写一篇很长的文章"
+    mock_config '{"tokens": 200}'
+}
+
+scenario_batch() {
+    local dir="$WORK_DIR/data/batch"
+    rm -rf "$dir"
+    mkdir -p "$dir"
+    awk -v n="$ITEMS" 'BEGIN { for (i = 1; i <= n; i++) printf "{\"id\": \"%d\", \"prompt\": \"第 %d 个问题\"}\n", i, i }' \
+        > "$WORK_DIR/data/manifest.jsonl"
+    mock_config '{"batch_seconds": 0}'
+    bench_run batch_build items "$ITEMS" bash "$QWEN" -m qwen-long --buildbatch "$WORK_DIR/data/manifest.jsonl" "$dir/bench.jsonl"
+    bench_run batch_submit items "$ITEMS" bash "$QWEN" --rps "$RPS" --runbatch "$dir/bench.jsonl"
+    bench_run batch_collect items "$ITEMS" bash "$QWEN" --rps "$RPS" --trackbatch "$dir"
+}
+
+scenario_vl() {
+    local dir="$WORK_DIR/data/images"
+    mkdir -p "$dir"
+    local -a images=()
+    local i
+    for ((i = 1; i <= IMAGES; i++)); do
+        # 模拟服务不看图片内容，PNG 文件头加上编号就够了
+        printf '\x89PNG\r\n\x1a\nbench image %d\n' "$i" > "$dir/img_$i.png"
+        images+=("$dir/img_$i.png")
+    done
+    rm -f "$WORK_DIR/cli/qwenvl_cache.json"
+    bench_run vl images "$IMAGES" bash "$QWEN" -m qwen-vl-max "${images[@]}" "描述这些图片"
+}
+
+for scenario in "${SCENARIOS[@]}"; do
+    "scenario_$scenario"
+done
@@ -0,0 +1,410 @@
+#!/bin/bash
+
+# qwen-long 上传缓存
+# 以前是一个 qwenlong_cache.json，每次查询都 jq 整个文件，每次更新都整个重写，
+# 多个 qwen 同时跑时还会互相覆盖。现在改成目录存储：
+#   $CACHE_DIR/<hash前两位>/<hash>_<size>   内容为一行: file_id<TAB>timestamp
+# 查询就是读一个小文件（纯 bash，不 fork），写入只写自己那一个文件，
+# 不同条目之间互不影响；需要遍历全部条目的操作（迁移、清理、按 id 删除）才加锁。
+
+# 条目有效期（秒），20 天
+# 旧版 json 缓存写的是 1728000000，把毫秒当成了秒，等于永不过期；文件是否还在服务器上现在由 remote.sh 的镜像校验
+CACHE_TTL="${CACHE_TTL:-1728000}"
+# 自动整理的间隔（天）
+CACHE_COMPACT_DAYS=1
+
+# ==================
+# = 锁（mkdir 是原子的，各平台都能用） =
+# ==================
+# 整理、淘汰大缓存时会持锁较久；持锁进程已经不在了，
+# 或者锁已经放了 CACHE_LOCK_STALE 秒以上（进程被挂起、pid 被复用），才当残留锁清掉。
+# 锁的年龄看目录的 mtime，每等 1 秒才查一次
+CACHE_LOCK_STALE=600
+cache_lock() {
+    local lock_dir="$CACHE_DIR/.lock"
+    local waited=0 holder mtime stale
+    until mkdir "$lock_dir" 2>/dev/null; do
+        holder=$(cat "$lock_dir/pid" 2>/dev/null || true)
+        stale=0
+        if [ -n "$holder" ] && ! kill -0 "$holder" 2>/dev/null; then
+            stale=1
+        elif [ "$waited" -ge 10 ]; then
+            waited=0
+            mtime=$(stat -c %Y "$lock_dir" 2>/dev/null || stat -f %m "$lock_dir" 2>/dev/null || true)
+            if [ -n "$mtime" ] && [ $(( $(date +%s) - mtime )) -ge "$CACHE_LOCK_STALE" ]; then
+                stale=1
+            fi
+        fi
+        # 清之前再看一眼，锁已经换了主人（别的进程刚清掉并重新拿到）就不动
+        if [ "$stale" = 1 ] && [ "$(cat "$lock_dir/pid" 2>/dev/null || true)" = "$holder" ]; then
+            warn "清理残留的缓存锁: $lock_dir"
+            rm -rf "$lock_dir"
+            waited=0
+            continue
+        fi
+        sleep 0.1
+        waited=$((waited + 1))
+    done
+    echo "${BASHPID:-$$}" > "$lock_dir/pid"
+}
+
+# 只放自己的锁：锁被当成残留锁清掉、换了主人时不去删别人的
+cache_unlock() {
+    local holder=""
+    read -r holder < "$CACHE_DIR/.lock/pid" 2>/dev/null || true
+    if [ "$holder" = "${BASHPID:-$$}" ]; then
+        rm -rf "$CACHE_DIR/.lock"
+    fi
+}
+
+# ==================
+# = 读写单个条目 =
+# ==================
+
+# 查询缓存，命中时把 file_id 放进 CACHE_HIT_ID
+# 不走命令替换，在调用者的 shell 里直接执行，查一次不 fork
+cache_lookup() {
+    local file_hash="$1"
+    local file_size="$2"
+    local entry="$CACHE_DIR/${file_hash:0:2}/${file_hash}_${file_size}"
+
+    CACHE_HIT_ID=""
+    [ -f "$entry" ] || return 1
+
+    local file_id="" timestamp="" now=""
+    IFS=$'\t' read -r file_id timestamp < "$entry" || true
+    # 写了一半或者损坏的条目当作未命中
+    [[ -n "$file_id" && $timestamp =~ ^[0-9]+$ ]] || return 1
+
+    printf -v now '%(%s)T' -1 2>/dev/null || now=$(date +%s)
+    if (( timestamp + CACHE_TTL <= now )); then
+        return 1
+    fi
+
+    CACHE_HIT_ID="$file_id"
+    return 0
+}
+
+# 查询缓存，命中时输出 file_id
+cache_get() {
+    cache_lookup "$1" "$2" || return 1
+    echo "$CACHE_HIT_ID"
+}
+
+# 写入单个条目
+# 条目只有一行，一次 write 写完，读到空文件的一方当作未命中即可，
+# 所以不需要 tmp + mv，也省掉每个条目一次 fork
+cache_put() {
+    local file_hash="$1"
+    local file_size="$2"
+    local file_id="$3"
+    local timestamp="${4:-$(now_epoch)}"
+
+    if [ -z "$file_hash" ] || [ "$file_hash" = "null" ] || [ -z "$file_id" ]; then
+        return 1
+    fi
+
+    local shard="$CACHE_DIR/${file_hash:0:2}"
+    [ -d "$shard" ] || mkdir -p "$shard"
+    printf '%s\t%s\n' "$file_id" "$timestamp" > "$shard/${file_hash}_${file_size}"
+}
+
+# 删除单个条目
+cache_delete() {
+    local file_hash="$1"
+    local file_size="$2"
+    rm -f "$CACHE_DIR/${file_hash:0:2}/${file_hash}_${file_size}"
+}
+
+# 批量写入，stdin 每行: hash<TAB>size<TAB>file_id[<TAB>timestamp]
+cache_put_batch() {
+    local now=$(now_epoch)
+    local count=0
+    local file_hash file_size file_id timestamp
+    while IFS=$'\t' read -r file_hash file_size file_id timestamp; do
+        cache_put "$file_hash" "$file_size" "$file_id" "${timestamp:-$now}" || continue
+        count=$((count + 1))
+    done
+    debug "缓存批量写入 $count 条"
+}
+
+# 列出全部条目，每行: file_id<TAB>timestamp<TAB>条目路径
+cache_list_entries() {
+    [ -d "$CACHE_DIR" ] || return 0
+    find "$CACHE_DIR" -mindepth 2 -maxdepth 2 -type f -name '*_*' \
+        -exec awk -F'\t' '{print $1 "\t" $2 "\t" FILENAME}' {} +
+}
+
+# 删除 stdin 中列出的条目路径，输出删除的数量
+cache_remove_entries() {
+    local list=$(cat)
+    if [ -z "$list" ]; then
+        echo 0
+        return 0
+    fi
+    printf '%s\n' "$list" | xargs rm -f
+    printf '%s\n' "$list" | wc -l | tr -d ' '
+}
+
+# ==================
+# = 初始化与迁移 =
+# ==================
+cache_init() {
+    [ -d "$CACHE_DIR" ] || mkdir -p "$CACHE_DIR"
+
+    # 旧版 qwenlong_cache.json 一次性迁移
+    if [ -f "$CACHE_FILE" ] && [ ! -f "$CACHE_DIR/.migrated" ]; then
+        cache_lock
+        if [ ! -f "$CACHE_DIR/.migrated" ]; then
+            info "正在迁移旧缓存: $CACHE_FILE -> $CACHE_DIR"
+            if jq -r 'to_entries[]
+                    | select(.value.id != null)
+                    | [.key, (.value.size | tostring), .value.id, ((.value.timestamp // 0) | floor | tostring)]
+                    | @tsv' "$CACHE_FILE" | cache_put_batch; then
+                mv "$CACHE_FILE" "${CACHE_FILE}.migrated"
+                touch "$CACHE_DIR/.migrated" "$CACHE_DIR/.last_compact"
+            else
+                error "❌ 旧缓存迁移失败，保留 $CACHE_FILE"
+            fi
+        fi
+        cache_unlock
+    fi
+
+    # 定期整理
+    if [ ! -f "$CACHE_DIR/.last_compact" ]; then
+        touch "$CACHE_DIR/.last_compact"
+    elif [ -n "$(find "$CACHE_DIR/.last_compact" -mtime +$((CACHE_COMPACT_DAYS - 1)) 2>/dev/null)" ]; then
+        cache_compact
+    fi
+}
+
+# ==================
+# = 整理与淘汰 =
+# ==================
+
+# 删掉过期和损坏的条目、空的分片目录
+cache_compact() {
+    [ -d "$CACHE_DIR" ] || return 0
+    cache_lock
+
+    local expire=$(( $(now_epoch) - CACHE_TTL ))
+    local removed=$(cache_list_entries | awk -F'\t' -v expire="$expire" '
+        $1 == "" || $2 !~ /^[0-9]+$/ || $2 <= expire { print $3 }' | cache_remove_entries)
+    find "$CACHE_DIR" -mindepth 2 -maxdepth 2 -type f -empty -delete 2>/dev/null || true
+    find "$CACHE_DIR" -mindepth 1 -maxdepth 1 -type d -empty ! -name '.lock' -exec rmdir {} + 2>/dev/null || true
+    touch "$CACHE_DIR/.last_compact"
+
+    cache_unlock
+    hash_memo_compact
+    remote_usage_compact
+    debug "缓存整理完成，删除 $removed 个条目"
+}
+
+# 只保留最新的 max_entries 个条目
+cache_evict() {
+    local max_entries="$1"
+    [ -d "$CACHE_DIR" ] || return 0
+    cache_lock
+
+    local removed=$(cache_list_entries | sort -t$'\t' -k2,2nr | awk -F'\t' -v max="$max_entries" '
+        NR > max { print $3 }' | cache_remove_entries)
+
+    cache_unlock
+    info "✅ 已淘汰 $removed 个缓存条目，保留最多 $max_entries 个"
+}
+
+# 删除缓存中指定 id 的条目（输入为 JSON 数组）
+delete_cache_by_ids() {
+    local ids_json="$1"
+
+    # 检查是否是合法 JSON 数组
+    if ! jq -e 'type == "array"' >/dev/null 2>&1 <<< "$ids_json"; then
+        error "❌ 输入不是合法的 JSON 数组"
+        return 1
+    fi
+
+    if [ ! -d "$CACHE_DIR" ]; then
+        error "❌ 缓存目录不存在"
+        return 1
+    fi
+
+    local ids_file=$(mktemp "${TMPDIR:-/tmp}/qwen_ids.XXXXXX")
+    jq -r '.[] | sub("^fileid://"; "")' <<< "$ids_json" > "$ids_file"
+
+    cache_lock
+    local removed=0
+    if [ -s "$ids_file" ]; then
+        removed=$(cache_list_entries | awk -F'\t' 'NR == FNR { want[$1]; next } ($1 in want) { print $3 }' \
+            "$ids_file" - | cache_remove_entries)
+    fi
+    cache_unlock
+    rm -f "$ids_file"
+
+    info "✅ 已删除 $removed 个缓存条目"
+}
+
+# 删除指定天数前的缓存条目
+delete_cache_by_time() {
+    local days="$1"
+    local expire_time=$(( $(now_epoch) - days * 86400 ))
+
+    if [ ! -d "$CACHE_DIR" ]; then
+        error "❌ 缓存目录不存在"
+        return 1
+    fi
+
+    cache_lock
+    cache_list_entries | awk -F'\t' -v expire="$expire_time" '$2 < expire { print $3 }' | cache_remove_entries > /dev/null
+    cache_unlock
+
+    info "✅ 已删除 $days 天前的缓存条目"
+}
+
+# ==================
+# = xxhash 备忘 =
+# ==================
+# 按 路径 + 设备:inode + 大小 + mtime 记住算过的 xxhash，文件没变就不再读一遍。
+# mtime 取到纳秒，同一秒里原地改写、大小不变的文件也认得出来；文件系统时间戳粗（只到秒）时，
+# 最近两秒内改过的文件不进备忘，免得之后同一秒里的改写被当成没变。
+# 备忘文件每行: 设备:inode<TAB>size<TAB>mtime<TAB>hash<TAB>绝对路径，只追加，过大时去重重写。
+HASH_MEMO_FILE="${HASH_MEMO_FILE:-$CACHE_DIR/hash_memo.tsv}"
+
+# 批量计算 xxhash
+# stdin: NUL 分隔的文件路径
+# stdout: 每个输入一行 hash<TAB>size，顺序与输入一致
+# HASH_JOBS > 1 时需要计算的文件分给多个 xxhsum 并行算
+hash_files_batch() {
+    local jobs="${HASH_JOBS:-1}"
+    local work_dir=$(mktemp -d "${TMPDIR:-/tmp}/qwen_hash.XXXXXX")
+    local -a paths=() hashes=() sizes=()
+    local p abs i
+
+    [ -d "$CACHE_DIR" ] || mkdir -p "$CACHE_DIR"
+    [ -f "$HASH_MEMO_FILE" ] || : > "$HASH_MEMO_FILE"
+
+    # 待查列表: 下标<TAB>绝对路径；路径里有换行或制表符的不进备忘，单独算
+    : > "$work_dir/list"
+    : > "$work_dir/abs"
+    while IFS= read -r -d '' p; do
+        i=${#paths[@]}
+        paths[$i]="$p"
+        hashes[$i]=""
+        sizes[$i]=""
+        [[ $p == /* ]] && abs="$p" || abs="$PWD/$p"
+        if [[ $abs == *$'\n'* || $abs == *$'\t'* ]]; then
+            continue
+        fi
+        printf '%s\t%s\n' "$i" "$abs" >> "$work_dir/list"
+        printf '%s\0' "$abs" >> "$work_dir/abs"
+    done
+
+    if [ ${#paths[@]} -eq 0 ]; then
+        rm -rf "$work_dir"
+        return 0
+    fi
+
+    # 一次 stat 取全部文件的 设备:inode、大小、mtime
+    local -a stat_args
+    if stat --version >/dev/null 2>&1; then
+        stat_args=(--printf '%d:%i\t%s\t%.9Y\t%n\n')
+    else
+        stat_args=(-f '%d:%i%t%z%t%Fm%t%N')
+    fi
+    if [ -s "$work_dir/abs" ]; then
+        xargs -0 stat "${stat_args[@]}" < "$work_dir/abs" > "$work_dir/stat" 2>/dev/null || true
+    else
+        : > "$work_dir/stat"
+    fi
+
+    # 和备忘对比: 命中输出 hash，没命中输出 ?，stat 不到的输出 -
+    awk -F'\t' -v OFS='\t' '
+        function tail(s, n) { while (n-- > 0) s = substr(s, index(s, "\t") + 1); return s }
+        FILENAME == ARGV[1] { path = tail($0, 4); memo[path] = $1 SUBSEP $2 SUBSEP $3; mh[path] = $4; next }
+        FILENAME == ARGV[2] { path = tail($0, 3); st[path] = $1 SUBSEP $2 SUBSEP $3; sz[path] = $2; next }
+        {
+            path = tail($0, 1)
+            if (!(path in st)) print $1, "-", "-"
+            else if ((path in memo) && memo[path] == st[path]) print $1, mh[path], sz[path]
+            else print $1, "?", sz[path]
+        }' "$HASH_MEMO_FILE" "$work_dir/stat" "$work_dir/list" > "$work_dir/lookup"
+
+    local hit_count=0
+    local file_hash file_size
+    : > "$work_dir/miss"
+    while IFS=$'\t' read -r i file_hash file_size; do
+        case "$file_hash" in
+            -) ;;
+            \?)
+                sizes[$i]="$file_size"
+                printf '%s\0' "${paths[$i]}" >> "$work_dir/miss"
+                ;;
+            *)
+                hashes[$i]="$file_hash"
+                sizes[$i]="$file_size"
+                hit_count=$((hit_count + 1))
+                ;;
+        esac
+    done < "$work_dir/lookup"
+
+    # 没命中的交给 xxhsum，一次处理一批文件
+    if [ -s "$work_dir/miss" ]; then
+        xargs -0 -P "$jobs" -n 16 xxhsum < "$work_dir/miss" > "$work_dir/sums" 2>/dev/null || true
+
+        # 按路径把结果对回下标，同时生成新的备忘行
+        awk -F'\t' -v OFS='\t' -v memo_new="$work_dir/memo_new" -v pwd="$PWD" -v now="$(date +%s)" '
+            function tail(s, n) { while (n-- > 0) s = substr(s, index(s, "\t") + 1); return s }
+            FILENAME == ARGV[1] { path = tail($0, 3); st[path] = $1 OFS $2 OFS $3; mt[path] = int($3); next }
+            FILENAME == ARGV[2] { path = tail($0, 1); idx[path] = $1; next }
+            /^\\/ { next }
+            {
+                sep = index($0, "  ")
+                if (sep == 0) next
+                path = substr($0, sep + 2)
+                abs = (substr(path, 1, 1) == "/") ? path : pwd "/" path
+                if (!(abs in idx)) next
+                print idx[abs], substr($0, 1, sep - 1)
+                if ((abs in st) && mt[abs] < now - 1) print st[abs], substr($0, 1, sep - 1), abs > memo_new
+            }' "$work_dir/stat" "$work_dir/list" "$work_dir/sums" > "$work_dir/hashed"
+
+        while IFS=$'\t' read -r i file_hash; do
+            hashes[$i]="$file_hash"
+        done < "$work_dir/hashed"
+
+        if [ -s "$work_dir/memo_new" ]; then
+            cache_lock
+            cat "$work_dir/memo_new" >> "$HASH_MEMO_FILE"
+            cache_unlock
+        fi
+    fi
+
+    debug "hash 备忘命中 $hit_count/${#paths[@]}"
+
+    # 剩下的（特殊路径、批量没算出来的）逐个算
+    for i in "${!paths[@]}"; do
+        if [ -z "${hashes[$i]}" ]; then
+            hashes[$i]=$(calculate_xxhash "${paths[$i]}")
+        fi
+        if [ -z "${sizes[$i]}" ]; then
+            sizes[$i]=$(stat -f%z "${paths[$i]}" 2>/dev/null || stat -c%s "${paths[$i]}" 2>/dev/null || echo 0)
+        fi
+        printf '%s\t%s\n' "${hashes[$i]}" "${sizes[$i]}"
+    done
+
+    rm -rf "$work_dir"
+}
+
+# 备忘文件去重（同一路径只留最后一行），行数超过去重后的两倍才重写
+hash_memo_compact() {
+    [ -f "$HASH_MEMO_FILE" ] || return 0
+    cache_lock
+    local counts=$(awk -F'\t' '{ path = $0; for (n = 0; n < 4; n++) path = substr(path, index(path, "\t") + 1); if (!(path in seen)) u++; seen[path] } END { print NR + 0, u + 0 }' "$HASH_MEMO_FILE")
+    local total=${counts% *}
+    local unique=${counts#* }
+    if [ "$total" -gt $((unique * 2 + 1000)) ]; then
+        awk -F'\t' '{ path = $0; for (n = 0; n < 4; n++) path = substr(path, index(path, "\t") + 1); line[path] = $0; if (!(path in order)) { order[path] = ++k; keys[k] = path } }
+            END { for (n = 1; n <= k; n++) print line[keys[n]] }' "$HASH_MEMO_FILE" > "${HASH_MEMO_FILE}.tmp" && \
+        mv "${HASH_MEMO_FILE}.tmp" "$HASH_MEMO_FILE"
+        debug "hash 备忘去重: $total -> $unique"
+    fi
+    cache_unlock
+}
@@ -35,50 +35,40 @@ timestamp_to_date() {
 }
 
 
-process_stream_line() {
-    local line="$1"
-    local json_line="${line#data: }"
-    local cost=0.0001 
+# SSE 解析：整个回答只用这一个 jq 进程
+# 逐行读 curl 输出，只把 delta.content 原样输出（不加换行），其余行忽略
+SSE_CONTENT_FILTER='
+    select(startswith("data:"))
+    | ltrimstr("data:") | ltrimstr(" ")
+    | select(. != "[DONE]")
+    | (fromjson? // empty)
+    | .choices[0]?.delta.content // empty
+'
+
+# 从原始 SSE 里取最后一条 usage
+extract_stream_usage() {
+    local sse_file="$1"
+    grep '"usage"' "$sse_file" | tail -n 1 | sed 's/^data: *//'  || true
+}
 
-    #echo $line
+# 打印 usage 统计
+# 参数是 ledger_record 记下的账本行
+print_usage_stats() {
+    local row="$1"
+    [ -z "$row" ] && return 0
 
-    [ "$json_line" == "[DONE]" ] && return 0
+    local created source model tag prompt_tokens cached_tokens completion_tokens cost
+    IFS=$'\t' read -r created source model tag prompt_tokens cached_tokens completion_tokens cost _ <<< "$row"
 
-    if [[ $line == {\"error\":* ]]; then
-        handle_error_response "$line"
-        return 1
-    fi
+    # 转换时间戳为可读格式
+    local readable_time=$(timestamp_to_date "$created")
 
-    # 使用单个 jq 查询处理所有情况
-    local jq_output
-    jq_output=$(jq -r '
-        if .usage then
-            "USAGE:" + (.model|tostring) + "|" + 
-            (.usage.prompt_tokens|tostring) + "|" + 
-            (.usage.completion_tokens|tostring) + "|" + 
-            (.usage.total_tokens|tostring) + "|" + 
-            ((.usage.prompt_tokens_details.cached_tokens // 0)|tostring) + "|" + 
-            (.created|tostring)
-        elif .choices[0].delta.content then
-            "CONTENT:" + (.choices[0].delta.content // "")
-        else
-            empty
-        end
-    ' <<< "$json_line" 2>/dev/null)
-
-    # 处理 usage 情况
-    if [[ "$jq_output" == USAGE:* ]]; then
-        IFS='|' read -r model prompt_tokens completion_tokens total_tokens cached_tokens created <<< "${jq_output#USAGE:}"
-        
-        # 转换时间戳为可读格式
-        local readable_time=$(timestamp_to_date "$created")
-
-# 先计算 cost
-cost=$(awk -v prompt="$prompt_tokens" -v completion="$completion_tokens" \
-    'BEGIN {
-        cost = prompt * 0.0000005 + completion * 0.000002;
-        printf "%.4f", cost
-    }')
+# 费用按 config.json 里的 pricing 算，没有配价格的模型不估
+if [ "$cost" != "-" ]; then
+    cost="$(awk -v cost="$cost" 'BEGIN { printf "%.4f", cost }') 元"
+else
+    cost="未知（config.json 里 $model 没有 pricing）"
+fi
 
 echo -e "\n"
 info  "输出完成，以下为统计信息。"
@@ -89,206 +79,265 @@ cat <<EOF
 模型: $model
 用户输入: $prompt_tokens 个 tokens（其中缓存 $cached_tokens 个）
 模型输出: $completion_tokens 个 tokens
-总计: $total_tokens 个 tokens
-估算费用：$cost 元
+总计: $((prompt_tokens + completion_tokens)) 个 tokens
+估算费用：$cost
 创建时间: $readable_time
 EOF
-
-
-        return 0
-    fi
-
-    # 处理内容情况
-    if [[ "$jq_output" == CONTENT:* ]]; then
-        printf "%s" "${jq_output#CONTENT:}"
-    fi
-
-    return 0
 }
 
 
 # 处理原始响应
+# 请求体、回答、文件清单都已经在文件里，这里一次 jq 合并成日志 JSON
 process_raw_response() {
-    # 传入两个参数
-    local response_content="$1"
-    local json_data="$2"
-    debug "原始响应内容：$response_content eee" >&2
-    debug "JSON 数据：$json_data eee2" >&2
-    # 构建响应 JSON
+    local answer_file="$1"
+    local request_file="$2"
+    local response_file="$3"
+    local files_file="${4:-}"
+    debug "原始响应文件：$answer_file"
+    debug "请求文件：$request_file"
 
-    
-    local response_json=$(jq -n \
-        --arg content "$response_content" \
-        '{
-            choices: [{
-                message: {
-                    role: "assistant",
-                    content: $content
-                }
-            }]
-        }') || { error "❌ 响应JSON构造失败"; return 1; }
+    local files_args=(--argjson files null)
+    [ -s "$files_file" ] && files_args=(--slurpfile files "$files_file")
 
     # 将请求和响应合并为一个 JSON
-    local merged_json=$(jq -n \
-        --argjson request "$json_data" \
-        --argjson response "$response_json" \
+    jq -n \
+        --slurpfile request "$request_file" \
+        --rawfile content "$answer_file" \
+        "${files_args[@]}" \
         '{
-            request: $request,
-            response: $response
-        }') || { error "❌ JSON 合并失败"; return 1; }
-
-
-    # 构造响应文件
-    local response_file="${LOG_DIR}/api_response_$(date +%s).json"
-    > "$response_file"  # 清空文件    # 构造响应文件
+            request: ($request[0] + (if $files then {files: $files[0]} else {} end)),
+            response: {
+                choices: [{
+                    message: {
+                        role: "assistant",
+                        content: ($content | sub("\n+$"; ""))
+                    }
+                }]
+            }
+        }' > "$response_file" || { error "❌ JSON 合并失败"; return 1; }
 
-    # 写入合并后的内容
-    echo "$merged_json" > "$response_file"
+    # 回答已经写进日志 JSON，流式写入的临时回答可以删了
+    rm -f "$answer_file"
     echo -e "\n\n响应已保存到: $response_file"
 
-    exec bash "$SCRIPT_DIR/json2md.sh" "$response_file" "$MARKDOWN_PATH"
+    trace_begin render
+    bash "$SCRIPT_DIR/json2md.sh" "$response_file" "$MARKDOWN_PATH"
+    trace_end
+}
 
-    
-    return 0
+# 打印请求体，REQUEST_ECHO: full 完整格式化 / short 截断 / off 不打印
+echo_request_body() {
+    local request_file="$1"
+    local limit=2000
+
+    case "${REQUEST_ECHO:-short}" in
+        off)
+            return 0
+            ;;
+        full)
+            info "INFO: Post JSON Data:"
+            jq . "$request_file" >&2
+            ;;
+        *)
+            local size=$(wc -c < "$request_file" | tr -d ' ')
+            info "INFO: Post JSON Data ($size bytes):"
+            head -c "$limit" "$request_file" >&2
+            [ "$size" -gt "$limit" ] && echo -n " ...(已截断，--echo full 查看完整请求)" >&2
+            echo >&2
+            ;;
+    esac
 }
 
 # 调用 API
-call_api() {
-    local json_data="$1"
-    
-    local model="$2"
-    local files_json="${3:-}"
+# 请求体从文件发送（curl -d @file），不经过命令行参数，长提示词不会碰到 ARG_MAX
+# 流式对话请求，回答边到边输出到 stdout，同时写进回答文件
+# curl -N 不缓冲，原始 SSE 存一份，同时交给常驻的 jq 解析；
+# 解析出的内容直接输出到终端，同时 tee 到回答文件，不再每个分片起一次 jq
+# 还没输出任何内容就失败（429、5xx、没连上）的按 request.sh 的规则重试，
+# 已经输出了一部分的不重试，免得终端上的回答重复
+# 追踪时（trace.sh）curl 在流的最后加一行分段耗时，这一行不是 data: 开头，解析时会被忽略；
+# 回答的第一个字到达时记 ttft
+# 参数: 请求体文件 SSE 文件 回答文件 curl 参数（方法、url、认证 header）...
+# 结果放在 STREAM_STATUS（HTTP 状态码）和 STREAM_CURL_EXIT（curl 退出码）
+stream_chat() {
+    local request_file="$1"
+    local sse_file="$2"
+    local answer_file="$3"
+    shift 3
+
+    local rc_file="${sse_file%.sse}.rc"
+    local headers_file="${sse_file%.sse}.headers"
+    local attempt=0 status curl_exit_code delay sent_at=0
+    local -a trace_args=()
+    [ -n "$TRACE_FILE" ] && trace_args=(-w "\n#trace\t$TRACE_CURL_FORMAT\n")
+    trace_begin chat
+    while true; do
+        rm -f "$headers_file"
+        rate_limit_acquire
+        request_slots_acquire 1
+        [ -n "$TRACE_FILE" ] && trace_now && sent_at=$TRACE_NOW
+        {
+            curl -sS -N "$@" \
+                -H "Content-Type: application/json" \
+                -D "$headers_file" \
+                ${trace_args[@]+"${trace_args[@]}"} \
+                -d @"$request_file" 2> "${sse_file%/*}/curl_error.log"
+            echo "$?" > "$rc_file"
+        } | tee "$sse_file" | jq --unbuffered -Rrj "$SSE_CONTENT_FILTER" | trace_tee "$answer_file" "$sent_at" || true
+        request_slots_release
+        trace_curl_spans "$sse_file" "$sent_at"
+
+        curl_exit_code=$(cat "$rc_file" 2>/dev/null || echo 1)
+        status=$(http_status_from_headers "$headers_file")
+        [ -s "$answer_file" ] && break
+        is_retryable_status "$status" || break
+        [ "$attempt" -lt "$MAX_RETRIES" ] || break
+
+        delay=$(retry_delay_ms "$attempt" "$headers_file")
+        [ "$status" = 429 ] && rate_limit_penalize "$delay"
+        attempt=$((attempt + 1))
+        warn "请求失败 (HTTP $status)，${delay}ms 后第 $attempt 次重试"
+        sleep_ms "$delay"
+    done
+    trace_end status="$status" retries="$attempt"
+    rm -f "$rc_file" "$headers_file"
 
+    STREAM_STATUS="$status"
+    STREAM_CURL_EXIT="$curl_exit_code"
+}
 
+call_api() {
+    local request_file="$1"
+    local model="$2"
+    local files_file="${3:-}"
 
-    debug "zzzzzz01: ${json_data[@]}"
-    local model_config=$(jq --arg model "$model" 'getpath([$model])' <<< "$MODEL_CONFIG")
-    if [ "$(echo "$model_config" | jq -r '.override' || true)" = "1" ]; then
-        local params=$(echo "$model_config" | jq -r '.params')
-        if [ -n "$params" ]; then
-            json_data=$(jq --argjson params "$params" '. += $params' <<< "$json_data")
-        fi
-    fi
+    debug "zzzzzz01: $request_file"
 
-    # 使用临时文件存储原始响应
-    #local raw_response="${LOG_DIR}/raw_response_$(date +%s).txt"
-    #> "$raw_response"
-    
-    #local post_json_data=$(echo "$json_data" | jq -c '.messages |= unique_by(.content)')
-    #除虫，并不影响排序
-    #local post_json_data=$(jq -c '
-    #.messages |= (
-    #    . as $original | 
-    #    unique_by(.content) |
-    #    sort_by(
-    #    . as $item |
-    #    ($original | index($item))
-    #    )
-    #)
-    #' <<< "$json_data")
-
-    info "INFO: Post JSON Data:"
-    echo "$json_data" | jq . >&2
+    echo_request_body "$request_file"
 
     info "Calling API..."
 
-    local curl_exit_code
-    local response_content=""
-
-    # 使用命名管道处理流式响应（纯内存操作）
-    exec 3< <(
-        stdbuf -oL curl -sS -X POST "$API_BASE_URL/chat/completions" \
-            -H "Authorization: Bearer $DASHSCOPE_API_KEY" \
-            -H "Content-Type: application/json" \
-            -d "$json_data" 2> "${LOG_DIR}/curl_error.log"
-        echo "CURL_EXIT_CODE:$?" 
-    )
-
-    while IFS= read -r line <&3; do
-        # 检查是否是curl退出码
-        if [[ "$line" == "CURL_EXIT_CODE:"* ]]; then
-            curl_exit_code="${line#CURL_EXIT_CODE:}"
-            break
-        fi
-        
-        # 只在终端显示，不写入文件
-        #echo "$line"
-        
-        # 检查错误信息
-        if [[ "$line" == '{"error"'* ]]; then
-            error "API error detected: $line"
-            exec 3<&-
-            return 1
-        fi
-        
-        response_content+=$(process_stream_line "$line" | tee /dev/tty)
+    # 日志文件在开始时就定下来，回答边流式输出边写入
+    # 文件名里的时间戳只到秒，同一秒里并发的请求（常驻进程下很常见）往后顺延一秒，用 noclobber 占住名字
+    local ts=$(date +%s)
+    while [ -e "${LOG_DIR}/api_response_$ts.json" ] || ! ( set -C; : > "${LOG_DIR}/api_response_$ts.sse" ) 2>/dev/null; do
+        ts=$((ts + 1))
     done
-
-    exec 3<&-
+    local response_base="${LOG_DIR}/api_response_$ts"
+    local sse_file="${response_base}.sse"
+    local answer_file="${response_base}.answer"
+
+    stream_chat "$request_file" "$sse_file" "$answer_file" \
+        -X POST "$API_BASE_URL/chat/completions" \
+        -H "Authorization: Bearer $DASHSCOPE_API_KEY"
+    local curl_exit_code=$STREAM_CURL_EXIT
+
+    # 检查错误信息
+    local error_line=$(grep -m 1 -E '^(data: *)?\{"error"' "$sse_file" || true)
+    if [ -n "$error_line" ]; then
+        error "API error detected"
+        handle_error_response "${error_line#data: }" "$request_file" "${response_base}.json" || true
+        return 1
+    fi
 
     # 检查curl退出码
     if [[ "$curl_exit_code" != "0" ]]; then
         error "Curl failed with exit code: $curl_exit_code"
+        error "原始响应保留在: $sse_file"
         return 1
     fi
 
-    info "API call completed."
-
+    # usage 记进账本，统计信息按记下的那一行打印
+    print_usage_stats "$(extract_stream_usage "$sse_file" | ledger_record chat "${response_base##*/}")"
 
-    # 直接调用 curl 并捕获原始响应
-    
-    #info "Calling API..."
-
-    #while IFS= read -r -d '' line; do
-    #    echo "$line"
-    #    response_content+=$(process_stream_line "$line"|tee /dev/tty)
-    #done < <(stdbuf -oL curl -sS -X POST "$API_BASE_URL/chat/completions" \
-    #-H "Authorization: Bearer $DASHSCOPE_API_KEY" \
-    #-H "Content-Type: application/json" \
-    #-d "$json_data" 2> "${LOG_DIR}/curl_error.log")
-    #-d @- <<< "$json_data")      
-    #info "API call completed."
-    
-    # 处理响应
-    # [ -n "$files_json" ] && json_data=$(jq --argjson files "$files_json" '. += {files: ($files | unique_by(.id))}' <<< "$json_data") 
-    [ -n "$files_json" ] && json_data=$(jq --argjson files "$files_json" '. += {files: ($files )}' <<< "$json_data") 
+    info "API call completed."
 
-    process_raw_response "$response_content" "$json_data"
+    # 处理响应，usage 已经取出，原始 SSE 不再需要；等 JSON 写好再删，名字一直占着
+    local rc=0
+    process_raw_response "$answer_file" "$request_file" "${response_base}.json" "$files_file" || rc=$?
+    rm -f "$sse_file"
+    return $rc
 }
 
 # 错误处理函数
 handle_error_response() {
     local error_json="$1"
-    local request_json="${2:-}"
+    local request_file="${2:-}"
     local response_file="${3:-}"
     
     local error_message=$(echo "$error_json" | jq -r '.error.message')
     error "❌ 错误: $error_message"
     error "DEBUG: 完整错误信息: $error_json"
 
-    # 构建错误响应 JSON
-    local error_response_json=$(jq -n \
-        --argjson request "$request_json" \
+    [ -z "$response_file" ] && return 1
+
+    local request_args=(--argjson request null)
+    [ -s "$request_file" ] && request_args=(--slurpfile request "$request_file")
+
+    # 构建错误响应 JSON，写入合并后的内容
+    jq -n \
+        "${request_args[@]}" \
         --argjson error "$error_json" \
         '{
-            request: $request,
+            request: (if $request then $request[0] else null end),
             response: {
                 error: $error
             }
-        }') || { error "❌ 错误响应JSON构造失败"; return 1; }
-
-    # 写入合并后的内容
-    echo "$error_response_json" > "$response_file"
+        }' > "$response_file" || { error "❌ 错误响应JSON构造失败"; return 1; }
 
     echo -e "\n\n错误响应已保存到: $response_file"
     return 1
 }
 
 
+# 构造请求体
+# 文件清单从 stdin 读入，问题从文件读入，去重和 config.json 的参数覆盖在同一次 jq 里完成
+# 请求体：输入是 upload_files 的结果（.files），用到 $msg $model $model_config 三个变量
+# batch 清单批量生成时也用这一段，保证两边请求体一致
+REQUEST_BODY_FILTER='
+    {
+        model: $model ,
+        messages: ([
+        { role: "system", content: "You are a helpful assistant." }
+        ] + [
+        .files[] | { role: "system", content: ("fileid://" + .id) }
+        ] + [
+        { role: "user", content: ($msg | sub("\n+$"; "")) }
+        ]),
+        stream: true,
+        stream_options: { include_usage: true }
+    }
+    # 除虫，并不影响排序
+    | .messages |= (
+        . as $original |
+        unique_by(.content) |
+        sort_by(
+        . as $item |
+        ($original | index($item))
+        )
+    )
+    | if ($model_config.override | tostring) == "1" and ($model_config.params | type) == "object"
+      then . += $model_config.params else . end
+'
+
+build_request_body() {
+    local question_file="$1"
+    local model_name="$2"
+
+    local model_config=$(jq -c --arg model "$model_name" 'getpath([$model]) // {}' <<< "$MODEL_CONFIG")
+
+    jq -c \
+    --rawfile msg "$question_file" \
+    --arg model "$model_name" \
+    --argjson model_config "$model_config" "$REQUEST_BODY_FILTER"
+}
+
+
 # 与文件对话
+# 第二个参数是问题所在的文件，dryrun_messages 时把请求体输出到 stdout
 chat_with_files() {
     local file_paths_t=$1
-    local user_question=$2
+    local question_file=$2
     local model_name=$3
     local dry_run=${4:-}
 
@@ -298,72 +347,34 @@ chat_with_files() {
     debug "file_ids_t: ${file_ids_t}"
 
 
-    [ "$user_question" = "q" ] && return 0
-    [ -z "$user_question" ] && {
+    [ "$(head -c 2 "$question_file")" = "q" ] && return 0
+    if [ ! -s "$question_file" ]; then
         error "错误: 问题不能为空"
-        continue
-    }
+        return 1
+    fi
 
-    local messages_json=$(jq -n \
-    --arg msg "$user_question" \
-    --arg model "$model_name" \
-    --argjson input_json "$file_ids_t" '
-    {
-        model: $model ,
-        messages: ([
-        { role: "system", content: "You are a helpful assistant." }
-        ] + [
-        $input_json.files[] | { role: "system", content: ("fileid://" + .id) }
-        ] + [
-        { role: "user", content: $msg }
-        ]),
-        stream: true,
-        stream_options: { include_usage: true }
-    }
-    ')
-
-        debug "yyyyy011: ${messages_json}"
-        # 构造 files 数组
-        local files_json=$(jq '.files' <<< "$file_ids_t")
-        debug "yyyyy01: ${files_json}"
-        # 调用 call_api，这里要调整为api返回，增加一段再保存，call_api不应该干这个事
-        #r_path=$(call_api "$messages_json" "$model_name") #"$files_json"
-        #process_raw_response "$r_path" "$files_json" 
-
-        local post_json_data=$(jq -c '
-            .messages |= (
-            . as $original | 
-            unique_by(.content) |
-            sort_by(
-            . as $item |
-            ($original | index($item))
-            )
-        )
-        ' <<< "$messages_json")
-
-        local model_config=$(jq --arg model "$model_name" 'getpath([$model])' <<< "$MODEL_CONFIG")
-        if [ "$(echo "$model_config" | jq -r '.override' || true)" = "1" ]; then
-            local params=$(echo "$model_config" | jq -r '.params')
-        
-            if [ -n "$params" ]; then
-            post_json_data=$(jq --argjson params "$params" '. += $params' <<< "$post_json_data")
-            fi  
-        
-        fi
-
-        if [[ $dry_run == "dryrun_files" ]]; then
-            debug "dry_run: $files_json"
-            echo "$files_json"
-            #jq -r '.' <<< "${files_json}"a
-        elif [[ $dry_run == "dryrun_messages" ]]; then
-            debug "dry_run messages: $post_json_data"
-            echo "$post_json_data"
-        else
-            debug "nothing call: $dry_run"
-            #exit 1
-            call_api "$post_json_data" "$model_name" "$files_json"
-        fi
+    # 构造 files 数组
+    local files_json=$(jq -c '.files' <<< "$file_ids_t")
+    debug "yyyyy01: ${files_json}"
+
+    if [[ $dry_run == "dryrun_files" ]]; then
+        debug "dry_run: $files_json"
+        echo "$files_json"
+        return 0
+    fi
 
+    if [[ $dry_run == "dryrun_messages" ]]; then
+        build_request_body "$question_file" "$model_name" <<< "$file_ids_t"
+        return 0
+    fi
 
-}
+    local request_file="${question_file%.*}.request.json"
+    local files_file="${question_file%.*}.files.json"
+    trace_begin build_request
+    build_request_body "$question_file" "$model_name" <<< "$file_ids_t" > "$request_file"
+    trace_end
+    echo "$files_json" > "$files_file"
 
+    debug "nothing call: $dry_run"
+    call_api "$request_file" "$model_name" "$files_file"
+}
@@ -2,43 +2,12 @@
 
 # 获取缓存的URL
 get_cached_url() {
-    local file_hash="$1"
-    local file_size="$2"
-    local current_time=$(date +%s)
-
-    if [ ! -f "$CACHE_FILE" ]; then
-        echo "{}" > "$CACHE_FILE"
-        return 1
-    fi
-
-    local cached_data=$(jq -r --arg hash "$file_hash" --arg size "$file_size" \
-        '.[$hash] | select(.size == $size and (.timestamp + 1728000000) > now)' \
-        --argjson now "$current_time" "$CACHE_FILE")
-
-    if [ -n "$cached_data" ]; then
-        echo "$cached_data" | jq -r '.id'
-        return 0
-    fi
-    return 1
+    cache_get "$1" "$2"
 }
 
 # 更新缓存
 update_cache() {
-    local file_hash="$1"
-    local file_size="$2"
-    local file_id="$3"
-    local current_time=$(date +%s)
-
-    local new_entry="{\"id\": \"$file_id\", \"size\": \"$file_size\", \"timestamp\": $current_time}"
-
-    if [ -f "$CACHE_FILE" ]; then
-        jq --arg hash "$file_hash" --arg entry "$new_entry" \
-            'del(.[] | select(.timestamp + 1728000000 < now)) * . + {($hash): ($entry|fromjson)}' \
-            --argjson now "$current_time" "$CACHE_FILE" > "${CACHE_FILE}.tmp" && \
-        mv "${CACHE_FILE}.tmp" "$CACHE_FILE"
-    else
-        echo "{\"$file_hash\": $new_entry}" > "$CACHE_FILE"
-    fi
+    cache_put "$1" "$2" "$3"
 }
 
 upload_single_file() {
@@ -66,21 +35,46 @@ upload_single_file() {
     fi
 
 
-    # 使用 curl 上传并记录速度信息
-    local response=$(curl -X POST \
+    local file_id
+    if file_id=$(upload_file_to_server "$file"); then
+        update_cache "$file_hash" "$file_size" "$file_id"
+
+        debug "✅ 上传成功: $filename "
+        returnd "$file_id" "uploadok"
+        return 0
+    else
+        return 1
+    fi
+}
+
+# 只负责把文件传到服务器，成功时输出 file_id
+# 不碰缓存，可以放在后台并发执行
+upload_file_to_server() {
+    local file="$1"
+
+    # 经 http_request 上传，429、5xx 自动重试
+    local body_file=$(mktemp "${TMPDIR:-/tmp}/qwen_upload_body.XXXXXX")
+    http_request "$body_file" -X POST \
         -H "Authorization: Bearer $DASHSCOPE_API_KEY" \
         -H "Content-Type: multipart/form-data" \
         -F "file=@$file" \
         -F "purpose=file-extract" \
-        "${API_BASE_URL}/files")
-     
+        "${API_BASE_URL}/files" > /dev/null || true
+    local response=$(cat "$body_file")
+    rm -f "$body_file"
 
-    local file_id=$(echo "$response" | jq -r '.id')
-    if [ -n "$file_id" ] && [ "$file_id" != "null" ]; then
-        update_cache "$file_hash" "$file_size" "$file_id"
+    parse_upload_response "$response" "$file"
+}
 
-        debug "✅ 上传成功: $filename "
-        returnd "$file_id" "uploadok"
+# 解析 /files 上传的响应，成功时输出 file_id
+parse_upload_response() {
+    local response="$1"
+    local file="$2"
+    local filename=$(basename "$file")
+
+    local file_id=$(echo "$response" | jq -r '.id' 2>/dev/null)
+    if [ -n "$file_id" ] && [ "$file_id" != "null" ]; then
+        echo "$file_id"
         return 0
     else
         debug "❌ 上传成功但未获取到 file_id: $filename"
@@ -94,69 +88,240 @@ upload_single_file() {
 upload_files() {
     local file_array_t=$1  #传入的json数组
     local dryrun="${2:-}"
-    
+    local jobs="${UPLOAD_JOBS:-1}"
+
     # warn "dry run: $dryrun"
 
     local success_count=0
     local failed_count=0
     local cached_count=0
-    
-    local f_json=$(jq -n '{ files: [] }')  # 创建json
-    
-    info "对话文件的清单为: $file_array_t"
-    
+    local dryrun_count=0
+    # 各类文件的字节数，汇总到 UPLOAD_STATS
+    local success_bytes=0 cached_bytes=0 dryrun_bytes=0
+
+    info "对话文件共 $(jq 'length' <<< "$file_array_t") 个"
+    debug "对话文件的清单为: $file_array_t"
+
+    # 每个文件一个下标，状态和结果都按下标存，最后按输入顺序汇总
+    local -a paths=() hashes=() sizes=() states=() ids=()
+    local work_dir=$(mktemp -d "${TMPDIR:-/tmp}/qwen_upload.XXXXXX")
+
+    # 第一步：批量计算 hash（文件没变的直接用备忘）并查缓存，
+    # 缓存命中的直接定下来，不用等上传
     local filename=""
-    while IFS= read -r file_path; do
-        #filename=$(jq -r . <<< "$file_path")
-        filename=$(jq -r . <<< "$file_path") || filename=""
-        
+    local to_hash="$work_dir/to_hash"
+    : > "$to_hash"
+    while IFS= read -r -d '' filename; do
         if [[ -z "${filename:-}" ]]; then
-        warn "警告: 文件名为空"
-        continue
+            warn "警告: 文件名为空"
+            continue
         fi
-      
-        debug "上传文件111111: $filename 2222222"
 
-        if [[ ! -f "${filename:-}" ]]; then
-        error "错误: 文件 '$filename' 不存在"
-        ((failed_count++))
-        continue
-        fi
+        local i=${#paths[@]}
+        paths[$i]="$filename"
+        hashes[$i]=""
+        sizes[$i]=""
+        ids[$i]=""
 
-        #local filename=$file_path
-        debug "上传文件111: $file_path"
-	if [[ $dryrun ]]; then
-        	local response=$(upload_single_file "$filename" "dryrun")
+        if [[ ! -f "$filename" ]]; then
+            states[$i]="missing"
+            continue
+        fi
+        states[$i]="hashing"
+        printf '%s\0' "$filename" >> "$to_hash"
+    done < <(jq -j '.[] | tostring + "\u0000"' <<< "$file_array_t") #输入文件列表
+
+    # 内容相同（hash 和大小都一样）的文件只上传一次，awk 标出第一次出现的序号，
+    # 后面的记为 same，汇总时直接用第一个的 id
+    local file_hash file_size first_seen
+    local -a hashed=() same_as=()
+    local i=0
+    trace_begin hash
+    while IFS=$'\t' read -r file_hash file_size first_seen; do
+        # 结果按顺序对应 states 为 hashing 的文件
+        while [[ ${states[$i]} != hashing ]]; do
+            i=$((i + 1))
+        done
+        hashed+=("$i")
+        hashes[$i]="$file_hash"
+        sizes[$i]="$file_size"
+
+        # 内容重复的先认出来，不再查缓存，也不会单独上传
+        if [ -n "$first_seen" ]; then
+            states[$i]="same"
+            same_as[$i]="${hashed[$first_seen]}"
+        elif cache_lookup "$file_hash" "$file_size"; then
+            states[$i]="usecached"
+            ids[$i]="$CACHE_HIT_ID"
+        elif [[ $dryrun ]]; then
+            states[$i]="dryrun"
         else
-		local response=$(upload_single_file "$filename")
-        	debug "respon:  $response"
-	fi
-        if [[ $response == '{"error'* ]]; then
-            error "文件 $filename 上传错误 $response"
-            ((failed_count++))
-        elif [[ $(jqd "$response" "status") == "usecached" ]]; then
-            info "文件 $filename 已存在，没有上传,直接引用"
-            local new_id=$(jqd "$response")
-            f_json=$(add_file_to_json "$f_json" "$new_id" "$filename")
-            ((cached_count++))
-        elif [[ $(jqd "$response" "status") == "uploadok" ]]; then
-            info "上传成功: $filename"
-            local new_id=$(jqd "$response")
-            f_json=$(add_file_to_json "$f_json" "$new_id" "$filename")
-            ((success_count++))
-        elif [[ $(jqd "$response" "status") == "dryrun" ]]; then
-             info "dryrun 实际未上传: $filename"
-             #local new_id=$(jqd "$response")
-             #f_json=$(add_file_to_json "$f_json" "$new_id" "$filename")
-             #((success_count++))
-	else
-            debug "未知数"
+            states[$i]="pending"
         fi
-    done < <(jq -c '.[]' <<< "$file_array_t") #输入文件列表
-  
+        i=$((i + 1))
+    done < <(hash_files_batch < "$to_hash" |
+        awk -F'\t' '{ k = $1 "\t" $2; print $0 "\t" ((k in first) ? first[k] : ""); if (!(k in first)) first[k] = NR - 1 }')
+    trace_end files="${#hashed[@]}"
+
+    # 上传前对一下服务器文件清单（remote.sh）：
+    # 缓存命中但服务器上已经没有的文件改为重新上传；要上传的先看配额，超了按 LRU 删最久没用的
+    if [[ -z $dryrun ]]; then
+        trace_begin remote_check
+        local pending_count=0 pending_bytes=0
+        : > "$work_dir/cached"
+        for i in "${!paths[@]}"; do
+            case "${states[$i]}" in
+                usecached) printf '%s\t%s\n' "${ids[$i]}" "$i" >> "$work_dir/cached" ;;
+                pending) pending_count=$((pending_count + 1)); pending_bytes=$((pending_bytes + sizes[$i])) ;;
+            esac
+        done
+
+        if { [ -s "$work_dir/cached" ] || [ "$pending_count" -gt 0 ]; } && remote_sync; then
+            local stale_id
+            while IFS=$'\t' read -r stale_id i; do
+                warn "文件 ${paths[$i]} 缓存的 $stale_id 已不在服务器上，重新上传"
+                cache_delete "${hashes[$i]}" "${sizes[$i]}"
+                states[$i]="pending"
+                ids[$i]=""
+                pending_count=$((pending_count + 1))
+                pending_bytes=$((pending_bytes + sizes[$i]))
+            done < <(remote_missing_ids < "$work_dir/cached")
+
+            if [ "$pending_count" -gt 0 ]; then
+                cut -f1 "$work_dir/cached" > "$work_dir/keep"
+                remote_evict "$pending_count" "$pending_bytes" "$work_dir/keep"
+            fi
+        fi
+        trace_end
+    fi
+
+    # 第二步：未命中的文件上传
+    # curl 支持 --parallel 时整批交给一个 curl，复用同一个连接并发上传（HTTP/2 下多路复用）；
+    # 老版本 curl 退回到后台 worker，最多同时跑 $jobs 个
+    local i
+    trace_begin upload
+    if [ "$jobs" -le 1 ] || transport_can_parallel; then
+        local batch=$(transport_begin)
+        for i in "${!paths[@]}"; do
+            [[ ${states[$i]} == pending ]] || continue
+            debug "上传文件: ${paths[$i]}"
+            transport_add "$batch" "$i" POST "${API_BASE_URL}/files" \
+                "file=@${paths[$i]}" "purpose=file-extract"
+        done
+        transport_run "$batch" "$jobs"
+        for i in "${!paths[@]}"; do
+            [[ ${states[$i]} == pending ]] || continue
+            local body_file=$(transport_body "$batch" "$i")
+            local response=""
+            [ -f "$body_file" ] && response=$(< "$body_file")
+            parse_upload_response "$response" "${paths[$i]}" > "$work_dir/$i.id" || true
+        done
+        transport_end "$batch"
+    else
+        local -a running=()
+        for i in "${!paths[@]}"; do
+            [[ ${states[$i]} == pending ]] || continue
+
+            if [ "${#running[@]}" -ge "$jobs" ]; then
+                wait "${running[0]}" 2>/dev/null || true
+                running=("${running[@]:1}")
+            fi
+
+            debug "上传文件: ${paths[$i]}"
+            upload_file_to_server "${paths[$i]}" > "$work_dir/$i.id" &
+            running+=($!)
+        done
+        wait
+    fi
+    trace_end
+
+    # 第三步：按输入顺序汇总，新上传的文件最后一次性写入缓存
+    local records="$work_dir/records"
+    local new_entries="$work_dir/new_entries"
+    local used_ids="$work_dir/used_ids"
+    local now=$(now_epoch)
+    : > "$records"
+    : > "$new_entries"
+    : > "$used_ids"
+    for i in "${!paths[@]}"; do
+        filename="${paths[$i]}"
+        case "${states[$i]}" in
+            missing)
+                error "错误: 文件 '$filename' 不存在"
+                failed_count=$((failed_count + 1))
+                ;;
+            usecached)
+                info "文件 $filename 已存在，没有上传,直接引用"
+                printf '%s\0%s\0%s\0' "${ids[$i]}" "$filename" "${sizes[$i]}" >> "$records"
+                echo "${ids[$i]}" >> "$used_ids"
+                cached_count=$((cached_count + 1))
+                cached_bytes=$((cached_bytes + sizes[$i]))
+                ;;
+            dryrun)
+                info "dryrun 实际未上传: $filename"
+                dryrun_count=$((dryrun_count + 1))
+                dryrun_bytes=$((dryrun_bytes + sizes[$i]))
+                ;;
+            same)
+                local first=${same_as[$i]}
+                local same_id=""
+                if [[ ${states[$first]} == usecached ]]; then
+                    same_id="${ids[$first]}"
+                elif [ -f "$work_dir/$first.id" ]; then
+                    same_id=$(< "$work_dir/$first.id")
+                fi
+                if [ -n "$same_id" ]; then
+                    info "文件 $filename 与 ${paths[$first]} 内容相同，直接引用"
+                    printf '%s\0%s\0%s\0' "$same_id" "$filename" "${sizes[$i]}" >> "$records"
+                    cached_count=$((cached_count + 1))
+                    cached_bytes=$((cached_bytes + sizes[$i]))
+                elif [[ ${states[$first]} == dryrun ]]; then
+                    info "dryrun 实际未上传: $filename"
+                    dryrun_count=$((dryrun_count + 1))
+                    dryrun_bytes=$((dryrun_bytes + sizes[$i]))
+                else
+                    error "文件 $filename 上传错误"
+                    failed_count=$((failed_count + 1))
+                fi
+                ;;
+            pending)
+                local new_id=""
+                [ -f "$work_dir/$i.id" ] && new_id=$(< "$work_dir/$i.id")
+                if [ -n "$new_id" ]; then
+                    info "上传成功: $filename"
+                    printf '%s\t%s\t%s\n' "${hashes[$i]}" "${sizes[$i]}" "$new_id" >> "$new_entries"
+                    printf '%s\0%s\0%s\0' "$new_id" "$filename" "${sizes[$i]}" >> "$records"
+                    printf '%s\t%s\t%s\t%s\n' "$new_id" "${sizes[$i]}" "$now" "${filename##*/}" >> "$work_dir/mirror_new"
+                    echo "$new_id" >> "$used_ids"
+                    success_count=$((success_count + 1))
+                    success_bytes=$((success_bytes + sizes[$i]))
+                else
+                    error "文件 $filename 上传错误"
+                    failed_count=$((failed_count + 1))
+                fi
+                ;;
+        esac
+    done
+
+    cache_put_batch < "$new_entries"
+    [ -f "$work_dir/mirror_new" ] && remote_mirror_add < "$work_dir/mirror_new"
+    remote_touch < "$used_ids"
+
     info "上传完成：成功 $success_count 个，引用 $cached_count 个，失败 $failed_count 个"
-  
-    jq -c '.status="ok"' <<< $f_json
+    # 给 --prefetch 用的统计，dryrun 的算待上传
+    UPLOAD_STATS=$(printf '{"files":%d,"cached":%d,"cached_bytes":%d,"pending":%d,"pending_bytes":%d,"uploaded":%d,"uploaded_bytes":%d,"failed":%d}' \
+        "${#paths[@]}" "$cached_count" "$cached_bytes" "$dryrun_count" "$dryrun_bytes" \
+        "$success_count" "$success_bytes" "$failed_count")
+
+    # 一次 jq 生成结果，字段与 add_file_to_json 一致
+    jq -c -R -s '
+        split("\u0000") | map(select(length > 0)) as $r
+        | {files: [range(0; $r | length; 3) as $i
+            | {id: $r[$i], filepath: $r[$i + 1], filename: ($r[$i + 1] | split("/") | last), size: ($r[$i + 2] | tonumber)}],
+           status: "ok"}
+    ' < "$records"
+
+    rm -rf "$work_dir"
     return 0
 }
 
@@ -169,30 +334,17 @@ cleanup_orphaned_files() {
     local files_json="$1"
     debug "filejson: ${files_json}"
 
-    # 获取服务器文件列表
-    local server_response=$(curl -sS --max-time 30 -X GET "$API_BASE_URL/files" \
-        -H "Authorization: Bearer $DASHSCOPE_API_KEY")
-    
-    if ! validate_json "$server_response"; then
+    # 先全量同步服务器文件清单（分页拉全），再和本次命令里的文件对比
+    if ! remote_sync full; then
         error "❌ 获取服务器文件列表失败"
         return 1
-    fi 
-    
-    # 获取本地文件ID列表
-    # local local_ids=($(get_local_file_ids "$files_json"))
-    local local_ids=$(jq -r 'map(.id)' <<< "$files_json")
-    debug "localids: ${local_ids}"
-    # 找出需要删除的文件
-    #local orphaned_files=$(echo "$server_response" | jq -r --arg ids "${local_ids[*]}" '
-    #    .data[] | select(.id as $fid | ($ids | split(" ")) | index($fid) | not) | 
-    #    {id: .id, filename: .filename}
-    #')
-
-    local orphaned_files=$(echo "$server_response" | jq -c --argjson ids "$local_ids" '
-    .data[] 
-    | select(.id as $fid | $ids | index($fid) | not)
-    | {id: .id, filename: .filename}'
-    )
+    fi
+
+    local orphaned_files=$(jq -r '.[].id' <<< "$files_json" |
+        awk -F'\t' -v mirror="$REMOTE_MIRROR_FILE" '
+            FILENAME != mirror { keep[$1]; next }
+            !($1 in keep) { print $1 "\t" $4 }' - "$REMOTE_MIRROR_FILE" |
+        jq -R -c 'split("\t") | {id: .[0], filename: (.[1] // "")}')
     
     if [ -z "$orphaned_files" ]; then
         info "没有发现需要清理的文件"
@@ -204,25 +356,38 @@ cleanup_orphaned_files() {
     echo "$orphaned_files" > oo.out 
     read -p "是否删除这些文件？(y/n): " -r confirm
     if [[ "$confirm" =~ ^[Yy]$ ]]; then
-        echo "$orphaned_files" | jq -c '.' | while read -r file; do
-            local file_id=$(echo "$file" | jq -r '.id')
-            local filename=$(echo "$file" | jq -r '.filename')
-            echo -n "正在删除 $filename... "
-            
-            local response=$(curl -sS --max-time 30 -X DELETE "$API_BASE_URL/files/$file_id" \
-                -H "Authorization: Bearer $DASHSCOPE_API_KEY")
+        # 所有 DELETE 交给一个 curl，共用连接
+        local -a del_ids=() del_names=()
+        local batch=$(transport_begin)
+        local file_id filename
+        while IFS=$'\t' read -r file_id filename; do
+            transport_add "$batch" "${#del_ids[@]}" DELETE "$API_BASE_URL/files/$file_id"
+            del_ids+=("$file_id")
+            del_names+=("$filename")
+        done < <(echo "$orphaned_files" | jq -r '[.id, .filename] | @tsv')
+        transport_run "$batch" "${UPLOAD_JOBS:-4}"
+
+        local i
+        local deleted_file=$(mktemp "${TMPDIR:-/tmp}/qwen_deleted.XXXXXX")
+        for i in "${!del_ids[@]}"; do
+            echo -n "正在删除 ${del_names[$i]}... "
+            local response=$(cat "$(transport_body "$batch" "$i")" 2>/dev/null || true)
             
             if validate_json "$response" && jq -e '.deleted' <<<"$response" &>/dev/null; then
                 echo "成功"
+                echo "${del_ids[$i]}" >> "$deleted_file"
             else
-                echo "失败: $(jq -r '.error.message // "未知错误"' <<<"$response")"
+                echo "失败: $(jq -r '.error.message // "未知错误"' <<<"$response" 2>/dev/null || echo "未知错误")"
             fi
         done
+        transport_end "$batch"
+        remote_mirror_remove < "$deleted_file"
+        rm -f "$deleted_file"
     else
         echo "取消清理操作"
     fi
     
-    local clean_ids=$(jq -r 'map(.id)' <<< "$orphaned_files")
+    local clean_ids=$(jq -s -c 'map(.id)' <<< "$orphaned_files")
 
     delete_cache_by_ids "$clean_ids"
 
@@ -247,62 +412,41 @@ delete_files_by_json_ids() {
 
     local failed_count=0
 
+    # 所有 DELETE 交给一个 curl，共用连接
+    local -a del_ids=() codes=()
+    local batch=$(transport_begin)
+    local file_id
     while IFS= read -r file_id; do
         debug "🗑️ 正在删除远程文件: $file_id"
-        local status=$(curl -sS -w "%{http_code}" -X DELETE "$API_BASE_URL/files/$file_id" \
-            -H "Authorization: Bearer $DASHSCOPE_API_KEY" -o /dev/null)
-
+        transport_add "$batch" "${#del_ids[@]}" DELETE "$API_BASE_URL/files/$file_id"
+        del_ids+=("$file_id")
+    done < <(jq -r '.[]' <<< "$clean_ids")
+    transport_run "$batch" "${UPLOAD_JOBS:-4}"
+
+    local key code
+    while IFS=$'\t' read -r key code; do
+        codes[$key]="$code"
+    done < <(transport_statuses "$batch")
+    transport_end "$batch"
+
+    # 删掉的和服务器上本来就没有的（404）都从镜像里去掉
+    local i gone=""
+    for i in "${!del_ids[@]}"; do
+        local status="${codes[$i]:-000}"
         if [ "$status" -ge 200 ] && [ "$status" -lt 300 ]; then
-            debug "✅ 成功删除: $file_id"
+            debug "✅ 成功删除: ${del_ids[$i]}"
+            gone+="${del_ids[$i]}"$'\n'
+        elif [ "$status" = 404 ]; then
+            debug "服务器上已经没有: ${del_ids[$i]}"
+            gone+="${del_ids[$i]}"$'\n'
         else
-            debug "❌ 删除失败 (HTTP %d): %s" "$status" "$file_id"
-            ((failed_count++))
+            debug "❌ 删除失败 (HTTP $status): ${del_ids[$i]}"
+            failed_count=$((failed_count + 1))
         fi
-    done < <(jq -c '.[]' <<< "$clean_ids")
+    done
 
     delete_cache_by_ids "$clean_ids"
+    printf '%s' "$gone" | remote_mirror_remove
 
-    debug "✅ 已尝试删除 %d 个文件，其中 %d 个失败" "$num_ids" "$failed_count"
-}
-
-# 删除缓存中指定 id 的条目（输入为 JSON 数组）
-delete_cache_by_ids() {
-    local ids_json="$1"
-
-    # 检查是否是合法 JSON 数组
-    if ! jq -e . >/dev/null 2>&1 <<< "$ids_json"; then
-        error "❌ 输入不是合法的 JSON 数组"
-        return 1
-    fi
-
-    # 确保缓存文件存在
-    if [ ! -f "$CACHE_FILE" ]; then
-        error "❌ 缓存文件不存在"
-        return 1
-    fi
-
-    # 使用 jq 删除缓存中 id 在列表中的条目
-    jq --argjson ids "$ids_json" '
-        del( .[] | select(.id | IN($ids[]) )
-    ' "$CACHE_FILE" > "${CACHE_FILE}.tmp" && \
-    mv "${CACHE_FILE}.tmp" "$CACHE_FILE"
-
-    info "✅ 已删除 $(jq length <<< "$ids_json") 个缓存条目"
-}
-
-# 删除指定天数前的缓存条目
-delete_cache_by_time() {
-    local days="$1"
-    local current_time=$(date +%s)
-    local expire_time=$((current_time - days * 86400))
-
-    if [ ! -f "$CACHE_FILE" ]; then
-        error "❌ 缓存文件不存在"
-        return 1
-    fi
-
-    jq --argjson now "$expire_time" 'del(.[] | select(.timestamp < $now))' "$CACHE_FILE" > "${CACHE_FILE}.tmp" && \
-    mv "${CACHE_FILE}.tmp" "$CACHE_FILE"
-
-    info "✅ 已删除 $days 天前的缓存条目"
+    debug "✅ 已尝试删除 $num_ids 个文件，其中 $failed_count 个失败"
 }
@@ -0,0 +1,173 @@
+#!/bin/bash
+
+# 图片预处理：上传前缩小、重新压缩、去掉元数据（EXIF、GPS、色彩配置之外的注释等）
+# - 设置写成 "最长边[,质量[,格式]]"，例如 2048、1600,80、2048,85,webp；最长边 0 只压缩不缩小；off 关闭
+#   格式 keep 保持原格式（jpg/png/webp 之外的转成 jpg），jpg / webp 统一转换；qwen-long 只收 png/jpg，
+#   webp 只给 qwen-vl 用，别的模型设了 webp 时 qwen 改成 jpg
+# - 用 ImageMagick（magick 或 convert），没装就照原样上传
+# - 多张图片按 CPU 核数并行处理，每个进程里 ImageMagick 只开一个线程，免得互相抢核
+# - 结果缓存在 IMGPREP_CACHE_DIR/<原图md5>_<最长边>_<质量>_<格式>/<原文件名>，
+#   原图和设置都没变就直接用上次的结果；缓存里的文件写好后不再改，
+#   上传缓存按处理后文件的 hash 记，设置变了就是另一个文件、另一条上传缓存
+# - 超过 IMGPREP_KEEP_DAYS 天没用到的结果自动删除
+# imgprep_files 输入输出都是 \0 分隔的路径，顺序不变，不是图片的、处理失败的原样输出
+
+IMGPREP_ON=false
+IMGPREP_MAX_EDGE=2048
+IMGPREP_QUALITY=85
+IMGPREP_FORMAT=keep
+IMGPREP_JOBS=""       # 并行处理的图片数，空则取 CPU 核数
+IMGPREP_KEEP_DAYS=30
+IMGPREP_EXTS="jpg jpeg png webp bmp tif tiff heic heif"
+IMGPREP_CACHE_DIR="${IMGPREP_CACHE_DIR:-$SCRIPT_DIR/imgprep_cache.d}"
+IMGPREP_TOOL=""
+
+# 解析设置，成功返回 0；off 或空关闭预处理
+# 参数: 最长边[,质量[,格式]]
+imgprep_set() {
+    local spec="$1"
+    local edge quality format
+    case "$spec" in
+        ""|off)
+            IMGPREP_ON=false
+            return 0
+            ;;
+    esac
+    IFS=, read -r edge quality format <<< "$spec"
+    quality="${quality:-85}"
+    format="${format:-keep}"
+    [[ $format == jpeg ]] && format=jpg
+    if ! [[ $edge =~ ^[0-9]+$ ]] || ! [[ $quality =~ ^[0-9]+$ ]] || [ "$quality" -lt 1 ] || [ "$quality" -gt 100 ]; then
+        return 1
+    fi
+    case "$format" in
+        keep|jpg|webp) ;;
+        *) return 1 ;;
+    esac
+    IMGPREP_ON=true
+    IMGPREP_MAX_EDGE="$edge"
+    IMGPREP_QUALITY="$quality"
+    IMGPREP_FORMAT="$format"
+}
+
+# 找 ImageMagick，只找一次；Windows 自带的 convert.exe 不是它，要看版本输出
+imgprep_tool() {
+    if [ -z "$IMGPREP_TOOL" ]; then
+        if command -v magick > /dev/null 2>&1; then
+            IMGPREP_TOOL=magick
+        elif convert -version 2>/dev/null | grep -q ImageMagick; then
+            IMGPREP_TOOL=convert
+        else
+            IMGPREP_TOOL=none
+        fi
+    fi
+    [ "$IMGPREP_TOOL" != none ]
+}
+
+# 处理一张图片，在 xargs 起的子进程里跑，设置从环境变量拿
+# 参数: 下标 原图路径
+# 输出一行: 下标<TAB>状态(cached/done/failed)<TAB>原图字节<TAB>结果字节<TAB>结果路径
+imgprep_one() {
+    local idx="$1" src="$2"
+    local name="${src##*/}"
+    local format="$IMGPREP_FORMAT"
+    if [ "$format" = keep ]; then
+        format=$(printf '%s' "${name##*.}" | tr '[:upper:]' '[:lower:]')
+        # 模型不一定认的格式（bmp、tiff、heic）都转成 jpg
+        case "$format" in
+            png|webp) ;;
+            *) format=jpg ;;
+        esac
+    fi
+    name="${name%.*}.$format"
+
+    local sum=$(md5sum < "$src" 2>/dev/null || md5 -q < "$src")
+    local dir="$IMGPREP_CACHE_DIR/${sum%% *}_${IMGPREP_MAX_EDGE}_${IMGPREP_QUALITY}_${format}"
+    local out="$dir/$name"
+    local src_bytes=$(stat -c%s "$src" 2>/dev/null || stat -f%z "$src")
+    local state=cached
+
+    if [ -f "$out" ]; then
+        # 目录的 mtime 当作最后使用时间，清理时看它
+        touch "$dir"
+    else
+        mkdir -p "$dir"
+        local part="$dir/.$name.$$"
+        local -a resize=()
+        [ "$IMGPREP_MAX_EDGE" -gt 0 ] && resize=(-resize "${IMGPREP_MAX_EDGE}x${IMGPREP_MAX_EDGE}>")
+        # [0] 只取第一帧；png 不写时间块，同样的输入每次得到同样的字节
+        if "$IMGPREP_TOOL" "${src}[0]" -auto-orient -strip ${resize[@]+"${resize[@]}"} \
+            -quality "$IMGPREP_QUALITY" -define png:exclude-chunks=date,time \
+            "$format:$part" 2>/dev/null && mv -f "$part" "$out"; then
+            state=done
+        else
+            rm -f "$part"
+            rmdir "$dir" 2>/dev/null
+            printf '%s\tfailed\t%s\t%s\t%s\n' "$idx" "$src_bytes" "$src_bytes" "$src"
+            return 0
+        fi
+    fi
+    printf '%s\t%s\t%s\t%s\t%s\n' "$idx" "$state" "$src_bytes" \
+        "$(stat -c%s "$out" 2>/dev/null || stat -f%z "$out")" "$out"
+}
+
+# 批量预处理
+# stdin: \0 分隔的文件路径
+# stdout: \0 分隔的上传用路径，和输入一一对应
+imgprep_files() {
+    local -a paths=() results=()
+    local p i ext
+
+    while IFS= read -r -d '' p; do
+        paths+=("$p")
+    done
+    results=(${paths[@]+"${paths[@]}"})
+
+    if [ "$IMGPREP_ON" = true ] && [ ${#paths[@]} -gt 0 ] && ! imgprep_tool; then
+        warn "⚠️ 没有找到 ImageMagick（magick 或 convert），图片按原样上传"
+    elif [ "$IMGPREP_ON" = true ] && [ ${#paths[@]} -gt 0 ]; then
+        local work_file=$(mktemp "${TMPDIR:-/tmp}/qwen_imgprep.XXXXXX")
+        for i in "${!paths[@]}"; do
+            p="${paths[$i]}"
+            # 路径里有换行或制表符的不处理，结果行按制表符分隔
+            [[ $p == *$'\n'* || $p == *$'\t'* ]] && continue
+            [ -f "$p" ] || continue
+            ext=$(printf '%s' "${p##*.}" | tr '[:upper:]' '[:lower:]')
+            case " $IMGPREP_EXTS " in
+                *" $ext "*) printf '%s\0%s\0' "$i" "$p" >> "$work_file" ;;
+            esac
+        done
+
+        if [ -s "$work_file" ]; then
+            local jobs="${IMGPREP_JOBS:-$(nproc 2>/dev/null || sysctl -n hw.ncpu 2>/dev/null || echo 1)}"
+            local state src_bytes out_bytes out
+            local count=0 cached=0 done_count=0 failed=0 before=0 after=0
+            mkdir -p "$IMGPREP_CACHE_DIR"
+            trace_begin imgprep
+            while IFS=$'\t' read -r i state src_bytes out_bytes out; do
+                count=$((count + 1))
+                before=$((before + src_bytes))
+                after=$((after + out_bytes))
+                case "$state" in
+                    cached) cached=$((cached + 1)); results[$i]="$out" ;;
+                    done) done_count=$((done_count + 1)); results[$i]="$out" ;;
+                    *) failed=$((failed + 1)); warn "⚠️ 图片预处理失败，按原样上传: ${paths[$i]}" ;;
+                esac
+            done < <(
+                export -f imgprep_one
+                export IMGPREP_TOOL IMGPREP_FORMAT IMGPREP_MAX_EDGE IMGPREP_QUALITY IMGPREP_CACHE_DIR
+                MAGICK_THREAD_LIMIT=1 xargs -0 -n 2 -P "$jobs" bash -c 'imgprep_one "$@"' _ < "$work_file"
+            )
+            trace_end files="$count" cached="$cached" bytes_in="$before" bytes_out="$after"
+            info "🖼️ 图片预处理 $count 张（缓存 $cached，新处理 $done_count，失败 $failed），$((before / 1024))K → $((after / 1024))K"
+
+            # 很久没用到的结果删掉
+            find "$IMGPREP_CACHE_DIR" -mindepth 1 -maxdepth 1 -type d -mtime +"$IMGPREP_KEEP_DAYS" \
+                -exec rm -rf {} + 2>/dev/null || true
+        fi
+        rm -f "$work_file"
+    fi
+
+    [ ${#results[@]} -gt 0 ] && printf '%s\0' "${results[@]}"
+    return 0
+}
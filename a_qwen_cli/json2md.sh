@@ -2,13 +2,140 @@
 
 set -euo pipefail
 
+# 把 log_dir 里的响应 JSON 渲染成 markdown 笔记
+# 每个 JSON 只读一次：一个 jq 拿出标题、时间、模型、全部文件和回答，直接输出整篇笔记
+#
+# 用法：
+#   json2md.sh api_response_1749287843.json 笔记目录
+#   json2md.sh --reindex log_dir 笔记目录 [并发数]   批量重建，已是最新的跳过
+
+SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+source "$SCRIPT_DIR/mdrender.sh"
+
+# 模板版本，笔记格式改了就加一，--reindex 会把旧版本的笔记全部重建
+JSON2MD_VERSION=2
+
+# 每个笔记目录下的索引，每行: 模板版本<TAB>JSON 文件名<TAB>笔记文件名
+INDEX_NAME=".json2md_index"
+
+# 输入是 process_raw_response 生成的 {request, response}
+# 时间戳取自文件名 api_response_<时间戳>.json，取不到的跳过
+JSON2MD_FILTER='
+(input_filename // "" | split("/") | last) as $json_name
+| ($json_name | capture("(?<ts>[0-9]{10,})\\.json$") | .ts | tonumber) as $ts
+| ([.request.messages[]? | select(.role == "user") | .content][0] | md_title) as $title
+| (.request.files // []) as $files
+| def field($k): if ($files | length) > 0 then [$files[] | .[$k] // "" | tostring] | join(", ") else "无" end;
+  md_record(
+    ($ts | md_time) + "_" + ($title | md_safe_name) + ".md";
+    $json_name;
+    md_note($title; (.response.choices[0].message.content // "" | tostring); [
+        "模型名称：\(.request.model // "无")",
+        "文件ID：\(field("id"))",
+        "文件名：\(field("filename"))",
+        "文件路径：\(field("filepath"))"
+    ]))
+'
+
+# 渲染一组 JSON 到笔记目录，输出 笔记路径<TAB>JSON 文件名
+# 一组文件一个 jq；某个文件坏了 jq 会整组退出，这时退回逐个渲染，跳过坏的
+render_json_files() {
+    local md_path="$1"
+    shift
+
+    local records=$(mktemp "${TMPDIR:-/tmp}/json2md.XXXXXX")
+    if ! jq -r "$MD_JQ_DEFS $JSON2MD_FILTER" "$@" > "$records" 2>/dev/null; then
+        local json_file
+        : > "$records"
+        for json_file in "$@"; do
+            jq -r "$MD_JQ_DEFS $JSON2MD_FILTER" "$json_file" >> "$records" 2>/dev/null ||
+                echo "错误：无法解析 '$json_file'，已跳过。" >&2
+        done
+    fi
+    md_split_records "$md_path" < "$records"
+    rm -f "$records"
+}
+
+# 记进索引
+append_index() {
+    local md_path="$1"
+
+    awk -F'\t' -v ver="$JSON2MD_VERSION" '{ n = split($1, parts, "/"); print ver "\t" $2 "\t" parts[n] }' \
+        >> "$md_path/$INDEX_NAME"
+}
+
+# 批量重建 log_dir 下所有响应的笔记
+# 跳过: 索引里是当前模板版本、笔记还在、JSON 在上次建索引之后没改过的
+reindex() {
+    local log_dir="$1"
+    local md_path="$2"
+    local jobs="${3:-4}"
+
+    if [ ! -d "$log_dir" ]; then
+        echo "错误：目录 '$log_dir' 不存在。"
+        exit 1
+    fi
+    mkdir -p "$md_path"
+
+    local index="$md_path/$INDEX_NAME"
+    local work_dir=$(mktemp -d "${TMPDIR:-/tmp}/json2md_reindex.XXXXXX")
+    : > "$work_dir/changed"
+    : > "$work_dir/index"
+    if [ -f "$index" ]; then
+        find "$log_dir" -maxdepth 1 -type f -name 'api_response_*.json' -newer "$index" > "$work_dir/changed"
+        cp "$index" "$work_dir/index"
+    fi
+    find "$md_path" -maxdepth 1 -type f -name '*.md' > "$work_dir/notes"
+    find "$log_dir" -maxdepth 1 -type f -name 'api_response_*.json' > "$work_dir/all"
+
+    # 四个输入: 改过的 JSON、现有笔记、索引、全部 JSON，输出要渲染的
+    awk -F'\t' -v ver="$JSON2MD_VERSION" '
+        function base(p,   n, parts) { n = split(p, parts, "/"); return parts[n] }
+        FILENAME == ARGV[1] { changed[base($0)] = 1; next }
+        FILENAME == ARGV[2] { notes[base($0)] = 1; next }
+        FILENAME == ARGV[3] { indexed[$2] = ($1 == ver && ($3 in notes)); next }
+        {
+            name = base($0)
+            if ((name in changed) || !(name in indexed) || !indexed[name]) print
+        }
+    ' "$work_dir/changed" "$work_dir/notes" "$work_dir/index" "$work_dir/all" > "$work_dir/todo"
+
+    local total=$(wc -l < "$work_dir/all" | tr -d ' ')
+    local todo=$(wc -l < "$work_dir/todo" | tr -d ' ')
+    echo "共 $total 个响应，需要渲染 $todo 个，其余已是最新。"
+
+    if [ "$todo" -gt 0 ]; then
+        export MD_JQ_DEFS JSON2MD_FILTER
+        export -f md_split_records render_json_files
+        tr '\n' '\0' < "$work_dir/todo" |
+            xargs -0 -n 200 -P "$jobs" bash -c 'render_json_files "$@"' _ "$md_path" > "$work_dir/rendered"
+
+        # 索引重写一遍，同一个 JSON 只留最后一条
+        append_index "$work_dir" < "$work_dir/rendered"
+        awk -F'\t' '{ last[$2] = $0; order[$2] = NR } END { for (k in last) print order[k] "\t" last[k] }' \
+            "$work_dir/index" "$work_dir/$INDEX_NAME" | sort -n | cut -f2- > "$index.tmp.$$"
+        mv "$index.tmp.$$" "$index"
+        echo "✅ 已生成 $(wc -l < "$work_dir/rendered" | tr -d ' ') 个 Markdown 文件：$md_path"
+    fi
+    rm -rf "$work_dir"
+}
+
 # 检查是否传入了参数
-if [ -z "$1" ]; then
+if [ -z "${1:-}" ]; then
   echo "请提供JSON文件路径作为参数。例如：$0 filename.json"
   exit 1
 fi
 
-if [ -z "$2" ]; then
+if [ "$1" = "--reindex" ]; then
+  if [ -z "${2:-}" ] || [ -z "${3:-}" ]; then
+    echo "用法：$0 --reindex log_dir 笔记目录 [并发数]"
+    exit 1
+  fi
+  reindex "$2" "$3" "${4:-4}"
+  exit 0
+fi
+
+if [ -z "${2:-}" ]; then
   echo "$1 未提供保存路径，无需创建md文件。"
   exit 1
 fi
@@ -22,88 +149,19 @@ if [ ! -f "$json_file" ]; then
   exit 1
 fi
 
-
-# 提取用户提示词的第一行
-user_prompt=$(jq -r '.request.messages[] | select(.role == "user") | .content' "$json_file" | head -n 1)
-
-# 替换掉可能引起文件名错误的字符（如斜杠、空格等）
-safe_user_prompt=$(echo "$user_prompt" | sed 's/[\\/\:*?"<>|]/_/g' | sed 's/ /_/g')
-
 # 提取时间戳（假设文件名格式是类似 api_response_1749287843.json）
-filename_base=$(basename "$json_file" .json)
-timestamp=$(echo "$filename_base" | grep -oE '[0-9]+$')
-
-# 判断是否有合法时间戳
-if [[ -z "$timestamp" || ${#timestamp} -lt 10 ]]; then
+if ! [[ $(basename "$json_file" .json) =~ [0-9]{10,}$ ]]; then
   echo "错误：无法从文件名 '$json_file' 中提取有效的时间戳。"
   exit 1
 fi
 
-#!/bin/bash
-
-# 获取系统信息
-os_name=$(uname -s)
-
-# 判断平台
-if [[ "$os_name" == "Darwin" ]]; then
-    echo "Platform: macOS"
-    formatted_time=$(date -jf "%s" "$timestamp" +"%Y-%m-%d_%H-%M-%S" 2>/dev/null)
-
-elif [[ "$os_name" == "Linux" ]]; then
-    # 检查是否是 Windows Subsystem for Linux (WSL)
-    if grep -qEi "(Microsoft|WSL)" /proc/version 2>/dev/null; then
-        echo "Platform: Windows (WSL)"
-    else
-        echo "Platform: Linux"
-    fi
-    formatted_time=$(date -jf "%s" "$timestamp" +"%Y-%m-%d_%H-%M-%S" 2>/dev/null)
-
-elif [[ "$os_name" == "CYGWIN"* || "$os_name" == "MINGW"* || "$os_name" == "MSYS"* ]]; then
-    echo "Platform: Windows ($os_name)"
-    formatted_time=$(date --date="@$timestamp" +"%Y-%m-%d_%H-%M-%S" 2>/dev/null)
-else
-    echo "Unknown platform"
-    formatted_time=$(date -jf "%s" "$timestamp" +"%Y-%m-%d_%H-%M-%S" 2>/dev/null)
-fi
-
-
-# 将时间戳转换为标准格式 YYYY-MM-DD_HH-mm-SS
-#formatted_time=$(date -jf "%s" "$timestamp" +"%Y-%m-%d_%H-%M-%S" 2>/dev/null)
-#formatted_time=$(date --date="@$timestamp" +"%Y-%m-%d_%H-%M-%S" 2>/dev/null)
-
-if [ $? -ne 0 ]; then
-  echo "错误：时间戳 '$timestamp' 转换失败，请确认是合法的 Unix 时间戳。"
+# 写入Markdown文件
+mkdir -p "$md_path"
+rendered=$(render_json_files "$md_path" "$json_file")
+if [ -z "$rendered" ]; then
+  echo "错误：'$json_file' 渲染失败。"
   exit 1
 fi
+append_index "$md_path" <<< "$rendered"
 
-# 构造新的Markdown文件名
-new_md_file="${formatted_time}_${safe_user_prompt}.md"
-
-# 写入目录为当前目录或指定日志目录
-output_file="$md_path/$new_md_file"
-
-# 提取其他字段
-model_name=$(jq -r '.request.model' "$json_file")
-
-# 只提取 files[0] 的信息，若无文件则设为“无”
-file_id=$(jq -r 'if .request.files and (.request.files | length > 0) then .request.files[0].id else "无" end' "$json_file")
-filename=$(jq -r 'if .request.files and (.request.files | length > 0) then .request.files[0].filename else "无" end' "$json_file")
-filepath=$(jq -r 'if .request.files and (.request.files | length > 0) then .request.files[0].filepath else "无" end' "$json_file")
-
-response_content=$(jq -r '.response.choices[0].message.content' "$json_file")
-
-# 写入Markdown文件
-mkdir -p "$(dirname "$output_file")"
-cat << EOF > "$output_file"
-# $user_prompt
-
-$response_content
-
-*模型名称：$model_name  
-文件ID：$file_id  
-文件名：$filename  
-文件路径：$filepath*
-
-EOF
-
-echo "✅ Markdown 文件已生成：$output_file"
+echo "✅ Markdown 文件已生成：${rendered%%$'\t'*}"
@@ -0,0 +1,168 @@
+#!/bin/bash
+
+# token 和费用账本
+# 每次调用（对话、qwen-vl、batch 结果里的每一条）的 usage 记一行，按天分文件，只追加：
+#   $LEDGER_DIR/<日期>.tsv   每行: 时间戳 来源 模型 标签 输入 缓存命中 输出 费用 请求标识
+# 日期按北京时间算。来源是 chat / vl / batch，标签由 --tag 指定，没有时为 -；模型没配价格时费用为 -
+# 费用按 config.json 里模型下的 "pricing" 算，单位元/千 tokens：
+#   "pricing": {"input": 0.0005, "cached_input": 0.0002, "output": 0.002, "batch": 0.5}
+# cached_input 没写按 input 算，batch 是 batch 调用的折扣；模型名按前缀匹配，同 exts
+#
+# 索引：每天一个汇总 <日期>.sum，第一行是已汇总到的字节数，其余每行: 模型 标签 来源 次数 输入 缓存命中 输出 费用
+# 账本只追加，汇总时只读新增的部分；--usage 只读汇总文件，几十万次调用也是一眨眼
+
+LEDGER_DIR="$SCRIPT_DIR/usage_ledger.d"
+LEDGER_TAG="${QWEN_TAG:-}"  # --tag 可改
+
+# usage 转成账本行，输入可以是流式的最后一个分片、非流式的响应体或者 batch 结果的一行
+# 输出: 日期<TAB>账本行；没有 usage 的跳过
+LEDGER_ROW_FILTER='
+(.response.body // .) as $b
+| select(($b | type) == "object" and ($b.usage | type) == "object")
+| ($b.model // "unknown" | tostring) as $model
+| ($b.usage.prompt_tokens // $b.usage.input_tokens // 0) as $in
+| ($b.usage.prompt_tokens_details.cached_tokens // 0) as $cached
+| ($b.usage.completion_tokens // $b.usage.output_tokens // 0) as $out
+| ($b.created // now | floor) as $t
+| ($config | model_pick($model; "pricing")) as $p
+| (if $p == null then "-"
+   else (($in - $cached) * ($p.input // 0) + $cached * ($p.cached_input // $p.input // 0) + $out * ($p.output // 0)) / 1000
+        * (if $source == "batch" then ($p.batch // 1) else 1 end)
+   end) as $cost
+| [($t + 28800 | strftime("%Y-%m-%d")), ($t | tostring), $source, ($model | gsub("[\t\r\n]"; " ")),
+   (if $tag == "" then "-" else $tag | gsub("[\t\r\n]"; " ") end),
+   ($in | tostring), ($cached | tostring), ($out | tostring), ($cost | tostring),
+   ($ref + (if .custom_id? != null then ":" + (.custom_id | tostring) else "" end))]
+| join("\t")
+'
+
+# 记账，usage JSON 从 stdin 读，一行一个
+# 参数: 来源 请求标识 [标签，默认 LEDGER_TAG]
+# 记下的账本行同时输出到 stdout，调用者要显示统计可以直接用
+ledger_record() {
+    local source="$1"
+    local ref="$2"
+    local tag="${3:-$LEDGER_TAG}"
+
+    local config="${MODEL_CONFIG:-}"
+    [ -n "$config" ] || config='{}'
+
+    mkdir -p "$LEDGER_DIR"
+    jq -r \
+        --arg source "$source" \
+        --arg ref "$ref" \
+        --arg tag "$tag" \
+        --argjson config "$config" \
+        "$MODEL_PICK_JQ_DEF $LEDGER_ROW_FILTER" 2>/dev/null |
+    awk -F'\t' -v dir="$LEDGER_DIR" '
+        {
+            f = dir "/" $1 ".tsv"
+            sub(/^[^\t]*\t/, "")
+            print >> f
+            print
+        }' || true
+}
+
+# 更新一天的汇总，只读账本里上次汇总之后新增的行
+# 别的进程可能正在追加，最后一行不完整的留到下次
+ledger_index_day() {
+    local tsv="$1"
+    local sum="${tsv%.tsv}.sum"
+
+    local size=$(wc -c < "$tsv" | tr -d ' ')
+    local offset=0
+    [ -f "$sum" ] && read -r offset < "$sum"
+    [[ $offset =~ ^[0-9]+$ ]] || offset=0
+    # 账本比汇总的还短，说明被改过，重新汇总
+    [ "$offset" -le "$size" ] || offset=0
+    [ "$offset" -eq "$size" ] && return 0
+
+    local old="$sum"
+    [ "$offset" -gt 0 ] || old=/dev/null
+    # 常驻进程（serve.sh）里的请求共用同一个 $$，临时文件按子 shell 区分
+    local tmp="$sum.tmp.${BASHPID:-$$}"
+
+    tail -c +$((offset + 1)) "$tsv" | head -c $((size - offset)) |
+    LC_ALL=C awk -F'\t' -v OFS='\t' -v base="$offset" -v len="$((size - offset))" '
+        function take(line,   f, k) {
+            split(line, f, "\t")
+            k = f[3] OFS f[4] OFS f[2]
+            calls[k]++; tin[k] += f[5]; tcached[k] += f[6]; tout[k] += f[7]; cost[k] += f[8]
+        }
+        FILENAME == ARGV[1] {
+            if (FNR > 1) {
+                k = $1 OFS $2 OFS $3
+                calls[k] += $4; tin[k] += $5; tcached[k] += $6; tout[k] += $7; cost[k] += $8
+            }
+            next
+        }
+        # 晚一行处理，读完才知道最后一行有没有换行
+        { if (have) take(prev); prev = $0; have = 1; used += length($0) + 1 }
+        END {
+            if (have) {
+                if (used <= len) take(prev)
+                else used -= length(prev) + 1
+            }
+            print base + used
+            for (k in calls) print k, calls[k], tin[k], tcached[k], tout[k], sprintf("%.8f", cost[k])
+        }' "$old" - > "$tmp" && mv "$tmp" "$sum"
+    rm -f "$tmp"
+}
+
+# 用量报告
+# 参数: 分组（day model tag source 用逗号连起来，默认 day,model） 最近几天（默认 0，全部）
+ledger_report() {
+    local group="${1:-day,model}"
+    local days="${2:-0}"
+
+    if ! [[ $group =~ ^(day|model|tag|source)(,(day|model|tag|source))*$ ]]; then
+        error "错误: 分组只能是 day、model、tag、source，用逗号连起来，例如 day,model"
+        return 1
+    fi
+
+    local since="" yesterday
+    [ "$days" -gt 0 ] && since=$(jq -n -r --argjson d "$days" 'now + 28800 - ($d - 1) * 86400 | strftime("%Y-%m-%d")')
+    yesterday=$(jq -n -r 'now + 28800 - 86400 | strftime("%Y-%m-%d")')
+
+    # 前天以前的账本一般不会再动，汇总比账本新就不用再看；最近两天每次都按字节数核对
+    local -a sums=()
+    local tsv day
+    for tsv in "$LEDGER_DIR"/*.tsv; do
+        [ -f "$tsv" ] || continue
+        day="${tsv##*/}"
+        day="${day%.tsv}"
+        [[ -n "$since" && "$day" < "$since" ]] && continue
+        [[ "$day" < "$yesterday" && "${tsv%.tsv}.sum" -nt "$tsv" ]] || ledger_index_day "$tsv"
+        sums+=("${tsv%.tsv}.sum")
+    done
+
+    if [ ${#sums[@]} -eq 0 ]; then
+        info "账本里还没有记录: $LEDGER_DIR"
+        return 0
+    fi
+
+    local tab=$(printf '\t')
+    LC_ALL=C awk -F'\t' -v OFS='\t' -v group="$group" '
+        BEGIN { n = split(group, g, ",") }
+        FNR == 1 { day = FILENAME; sub(/.*\//, "", day); sub(/\.sum$/, "", day); next }
+        {
+            v["day"] = day; v["model"] = $1; v["tag"] = $2; v["source"] = $3
+            k = v[g[1]]
+            for (i = 2; i <= n; i++) k = k " " v[g[i]]
+            calls[k] += $4; tin[k] += $5; tcached[k] += $6; tout[k] += $7; cost[k] += $8
+        }
+        END { for (k in calls) printf "%s\t%d\t%.0f\t%.0f\t%.0f\t%.8f\n", k, calls[k], tin[k], tcached[k], tout[k], cost[k] }
+    ' "${sums[@]}" | LC_ALL=C sort -t "$tab" -k1,1 |
+    awk -F'\t' -v head="${group//,/ }" '
+        # 中文表头和"合计"一个字占 3 字节、显示 2 列，printf 按字节补齐，宽度要加上字数
+        function row(k, c, i, ca, o, m) {
+            printf "%s %8d %14.0f %14.0f %7s %14.0f %12.4f\n", k, c, i, ca,
+                (i > 0 ? sprintf("%.1f%%", ca * 100 / i) : "-"), o, m
+        }
+        BEGIN { printf "%-40s %10s %16s %18s %10s %16s %15s\n", head, "调用", "输入", "缓存命中", "命中率", "输出", "费用(元)" }
+        {
+            row(sprintf("%-40s", $1), $2, $3, $4, $5, $6)
+            c += $2; i += $3; ca += $4; o += $5; m += $6
+        }
+        END { row(sprintf("%-42s", "合计"), c, i, ca, o, m) }'
+}
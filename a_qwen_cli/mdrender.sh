@@ -0,0 +1,40 @@
+#!/bin/bash
+
+# markdown 笔记渲染的公共部分
+# jq 直接输出一串记录：每条笔记先是一行 "\x1e文件名"，后面是笔记内容；
+# 再由 awk 按记录头切成一个个文件，整个过程都是流式的，不会把所有笔记读进内存
+
+# jq 函数，拼在各个渲染 filter 的前面
+MD_JQ_DEFS='
+# 提示词第一行作为标题
+def md_title: (. // "" | tostring | split("\n") | .[0] // "");
+# 替换掉可能引起文件名错误的字符（如斜杠、空格等）
+def md_safe_name: gsub("[\\\\/:*?\"<>|]"; "_") | gsub(" "; "_");
+# 时间戳转成 YYYY-MM-DD_HH-mm-SS（本地时间）
+def md_time: floor | strflocaltime("%Y-%m-%d_%H-%M-%S");
+# 笔记正文，格式与 json2md.sh 一致
+def md_note($title; $content; $footer):
+    "# \($title)\n\n\($content)\n\n*" + ($footer | join("  \n")) + "*\n";
+# 一条记录：记录头 + 笔记
+def md_record($name; $note): "\u001e" + $name + "\n" + $note;
+def md_record($name; $tag; $note): "\u001e" + $name + "\u001f" + $tag + "\n" + $note;
+'
+
+# 把 jq 输出的记录切成文件，写到第一个参数指定的目录，每写完一个文件输出一行路径
+# 记录头可以是 "\x1e文件名\x1f标记"，这时输出 路径<TAB>标记，方便调用方记录来源
+md_split_records() {
+    local md_dir="$1"
+
+    awk -v dir="$md_dir" '
+    function finish() { if (out != "") { close(out); print out (tag != "" ? "\t" tag : "") } }
+    /^\036/ {
+        finish()
+        head = substr($0, 2)
+        tag = ""
+        if ((p = index(head, "\037")) > 0) { tag = substr(head, p + 1); head = substr(head, 1, p - 1) }
+        out = dir "/" head
+        next
+    }
+    out != "" { print > out }
+    END { finish() }'
+}
@@ -11,6 +11,35 @@ APIKEY_JSON="$SCRIPT_DIR/apikey.json"
 # 添加缓存相关的全局变量
 CACHE_FILE="$SCRIPT_DIR/qwenlong_cache.json"
 
+# 环境变量 QWEN_API_BASE_URL、QWEN_DASHSCOPE_API_URL 可改，比如指向 bench/mock_dashscope.py
+API_BASE_URL="${QWEN_API_BASE_URL:-https://dashscope.aliyuncs.com/compatible-mode/v1}"
+DASHSCOPE_API_URL="${QWEN_DASHSCOPE_API_URL:-https://dashscope.aliyuncs.com/api/v1}"
+
+# 重试和限速，与 qwen 共用同一个令牌桶和并发上限
+MAX_RETRIES=2
+RATE_LIMIT_RPS=10
+RATE_LIMIT_BURST=20
+MAX_INFLIGHT=16
+UPLOAD_JOBS=4  # 同时上传到 OSS 的图片数，-j/--jobs 可改，同 qwen
+
+LOG_ENABLE=true
+LOG_DEBUG=false
+LOG_INFO=true
+LOG_WARN=true
+LOG_ERROR=true
+LOG_FILE=""
+
+source "$SCRIPT_DIR/utils.sh"
+source "$SCRIPT_DIR/trace.sh"
+source "$SCRIPT_DIR/request.sh"
+source "$SCRIPT_DIR/transport.sh"
+source "$SCRIPT_DIR/ledger.sh"
+source "$SCRIPT_DIR/chatapi.sh"
+source "$SCRIPT_DIR/imgprep.sh"
+
+# 模型配置，记账时按里面的 pricing 算费用
+MODEL_CONFIG=$(jq -c . "$CONFIG_JSON" 2>/dev/null || echo '{}')
+
 
 # 全局变量
 upload_host=""
@@ -41,119 +70,30 @@ mkdir -p "$log_dir"
 cache_file="$SCRIPT_DIR/qwenvl_cache.json"
 # mkdir -p "$cache_dir"
 
-# 计算文件的MD5哈希值
-get_file_hash() {
-    local file_path="$1"
-    md5sum "$file_path" | awk '{print $1}'
-}
-
-# 获取文件大小（用于额外验证）
-get_file_size() {
-    local file_path="$1"
-    stat -f%z "$file_path" 2>/dev/null || stat -c%s "$file_path"
-}
-
-# 从缓存中获取OSS URL
-get_cached_url() {
-    local file_hash="$1"
-    local file_size="$2"
-    local current_time=$(date +%s)
-
-    if [ ! -f "$cache_file" ]; then
-        echo "{}" > "$cache_file"
-        return 1
-    fi
-
-    # 读取缓存并检查是否存在且未过期
-    local cached_data=$(jq -r --arg hash "$file_hash" --arg size "$file_size" \
-        '.[$hash] | select(.size == $size and (.timestamp + 172800) > now)' \
-        --argjson now "$current_time" "$cache_file")
-
-    if [ -n "$cached_data" ]; then
-        echo "$cached_data" | jq -r '.url'
-        return 0
-    fi
-    return 1
-}
-
-# 更新缓存
-update_cache() {
-    local file_hash="$1"
-    local file_size="$2"
-    local oss_url="$3"
-    local current_time=$(date +%s)
-
-    # 创建新的缓存条目
-    local new_entry="{\"url\": \"$oss_url\", \"size\": \"$file_size\", \"timestamp\": $current_time}"
-
-    # 更新缓存文件
-    if [ -f "$cache_file" ]; then
-        # 删除过期条目并添加新条目
-        jq --arg hash "$file_hash" --arg entry "$new_entry" \
-            'del(.[] | select(.timestamp + 172800 < now)) * . + {($hash): ($entry|fromjson)}' \
-            --argjson now "$current_time" "$cache_file" > "${cache_file}.tmp" && \
-        mv "${cache_file}.tmp" "$cache_file"
-    else
-        # 创建新的缓存文件
-        echo "{\"$file_hash\": $new_entry}" > "$cache_file"
-    fi
-}
-
-# 修改上传单个文件的函数
-upload_single_file() {
-    local file_path="$1"
-    if [ ! -f "$file_path" ]; then
-        echo "❌ 错误: 文件不存在: $file_path"
-        return 1
-    fi
-
-    local file_hash=$(get_file_hash "$file_path")
-    local file_size=$(get_file_size "$file_path")
-    local cached_url=$(get_cached_url "$file_hash" "$file_size")
-
-    if [ -n "$cached_url" ]; then
-        echo "🔄 使用缓存的文件: $file_path"
-        file_urls_keys[${#file_urls_keys[@]}]="$(basename "$file_path")"
-        file_urls_values[${#file_urls_values[@]}]="$cached_url"
-        return 0
-    fi
-
-    echo "🔄 正在上传新文件: $file_path..."
-    local file_key="${upload_dir}/$(basename "$file_path")"
-
-    local response=$(curl -s -X POST "$upload_host" \
-        -F "OSSAccessKeyId=$oss_access_key_id" \
-        -F "Signature=$signature" \
-        -F "policy=$policy" \
-        -F "key=$file_key" \
-        -F "x-oss-object-acl=$x_oss_object_acl" \
-        -F "x-oss-forbid-overwrite=$x_oss_forbid_overwrite" \
-        -F "success_action_status=200" \
-        -F "file=@$file_path")
-
-    if [ $? -eq 0 ]; then
-        echo "✅ 文件上传成功: $file_path"
-        local oss_url="oss://$file_key"
-        file_urls_keys[${#file_urls_keys[@]}]="$(basename "$file_path")"
-        file_urls_values[${#file_urls_values[@]}]="$oss_url"
-        
-        # 更新缓存
-        update_cache "$file_hash" "$file_size" "$oss_url"
-        return 0
-    else
-        echo "❌ 错误: 文件上传失败: $file_path"
-        return 1
-    fi
+# 上传凭证缓存，按模型一个文件，内容是接口返回的 JSON 加上取到的时间 fetched_at
+# 凭证在 expire_in_seconds 内都能用，离过期不到 POLICY_MARGIN 秒的不再用
+policy_cache_dir="$SCRIPT_DIR/qwenvl_policy.d"
+POLICY_MARGIN=60
+
+# 批量查询OSS URL缓存，stdin 每行: md5<TAB>大小，每行输出一个 URL，没有或过期的输出空行
+get_cached_urls() {
+    [ -f "$cache_file" ] || echo "{}" > "$cache_file"
+    jq -R -r --slurpfile cache "$cache_file" --argjson now "$(date +%s)" '
+        split("\t") as [$hash, $size]
+        | ($cache[0][$hash] // {}) as $e
+        | if $e.size == $size and ($e.timestamp // 0) + 172800 > $now then $e.url else "" end'
 }
 
-# 添加缓存清理函数（可选择性地在脚本启动时调用）
-cleanup_cache() {
-    if [ -f "$cache_file" ]; then
-        local current_time=$(date +%s)
-        jq 'del(.[] | select(.timestamp + 172800 < now))' \
-            --argjson now "$current_time" "$cache_file" > "${cache_file}.tmp" && \
-        mv "${cache_file}.tmp" "$cache_file"
-    fi
+# 批量更新缓存，顺便删掉过期条目，stdin 每行: md5<TAB>大小<TAB>URL
+update_cache_batch() {
+    [ -f "$cache_file" ] || echo "{}" > "$cache_file"
+    local tmp="${cache_file}.tmp.$$"
+    jq -R -s --slurpfile cache "$cache_file" --argjson now "$(date +%s)" '
+        reduce (split("\n")[] | select(length > 0) | split("\t")) as [$hash, $size, $url]
+            ($cache[0] | with_entries(select(.value.timestamp + 172800 >= $now));
+             .[$hash] = {url: $url, size: $size, timestamp: $now})
+    ' > "$tmp" && mv "$tmp" "$cache_file"
+    rm -f "$tmp"
 }
 
 
@@ -164,6 +104,8 @@ show_help() {
     echo "使用方法: $0 [选项] <图片1> [图片2] ... [问题]"
     echo "选项:"
     echo "  -m, --model   指定模型名称 (默认: qwen-vl-max-latest)"
+    echo "  -j, --jobs    同时上传的图片数 (默认: 4)"
+    echo "  --imgprep     上传前缩小压缩图片: 最长边[,质量[,格式]]，如 2048,85,webp；off 关闭"
     echo "  -h, --help    显示此帮助信息"
     echo
     echo "示例:"
@@ -172,109 +114,214 @@ show_help() {
     exit 1
 }
 
-# 1. 获取上传凭证
+# 1. 获取上传凭证，没过期的直接沿用
 get_upload_policy() {
-    echo "🔄 步骤1: 获取上传凭证..."
-    local response=$(curl -s -X GET "https://dashscope.aliyuncs.com/api/v1/uploads?action=getPolicy&model=$model_name" \
-        -H "Authorization: $DASHSCOPE_API_KEY" \
-        -H "Content-Type: application/json")
+    local policy_file="$policy_cache_dir/${model_name//\//_}.json"
+    local now=$(date +%s)
+    local response=""
+
+    if [ -f "$policy_file" ] && jq -e --argjson now "$now" --argjson margin "$POLICY_MARGIN" \
+        '.fetched_at + (.data.expire_in_seconds // 0) - $margin > $now' "$policy_file" > /dev/null 2>&1; then
+        response=$(< "$policy_file")
+        info "✅ 沿用未过期的上传凭证"
+    else
+        info "🔄 步骤1: 获取上传凭证..."
+        local body_file=$(mktemp "${TMPDIR:-/tmp}/qwenvl_policy.XXXXXX")
+        http_request "$body_file" -X GET "$DASHSCOPE_API_URL/uploads?action=getPolicy&model=$model_name" \
+            -H "Authorization: $DASHSCOPE_API_KEY" \
+            -H "Content-Type: application/json" > /dev/null || true
+        response=$(jq -c --argjson now "$now" 'select(.data.policy) | . + {fetched_at: $now}' "$body_file" 2>/dev/null || true)
+        rm -f "$body_file"
+        if [ -n "$response" ]; then
+            mkdir -p "$policy_cache_dir"
+            printf '%s\n' "$response" > "$policy_file.tmp.$$" && mv "$policy_file.tmp.$$" "$policy_file"
+            info "✅ 成功获取上传凭证"
+        fi
+    fi
 
-    # 解析JSON并设置变量
-    upload_host=$(echo "$response" | jq -r '.data.upload_host')
-    upload_dir=$(echo "$response" | jq -r '.data.upload_dir')
-    policy=$(echo "$response" | jq -r '.data.policy')
-    signature=$(echo "$response" | jq -r '.data.signature')
-    oss_access_key_id=$(echo "$response" | jq -r '.data.oss_access_key_id')
-    x_oss_object_acl=$(echo "$response" | jq -r '.data.x_oss_object_acl')
-    x_oss_forbid_overwrite=$(echo "$response" | jq -r '.data.x_oss_forbid_overwrite')
+    # 解析JSON并设置变量，一次 jq 取完
+    IFS=$'\t' read -r upload_host upload_dir policy signature oss_access_key_id x_oss_object_acl x_oss_forbid_overwrite \
+        < <(jq -r '.data | [.upload_host, .upload_dir, .policy, .signature, .oss_access_key_id,
+                            .x_oss_object_acl, .x_oss_forbid_overwrite] | @tsv' <<< "${response:-null}" 2>/dev/null) || true
 
     if [ -z "$policy" ] || [ -z "$upload_host" ]; then
-        echo "❌ 错误: 获取上传凭证失败"
+        error "❌ 错误: 获取上传凭证失败"
         exit 1
     fi
-
-    echo "✅ 成功获取上传凭证"
 }
 
-# 2. 上传单个文件
-
-
-# 3. 上传多个文件
+# 2. 上传多个文件
+# 先一次算完全部 md5 和大小、一次查完缓存；没缓存的才去取上传凭证，整批交给 transport.sh，
+# 一个 curl 并发传到 OSS（最多 UPLOAD_JOBS 个同时传）；内容相同的文件只传一次
 upload_files() {
-    local success=true
     local files=("$@")
-    for file in "${files[@]}"; do
-        upload_single_file "$file" || success=false
+    local -a hashes=() sizes=() urls=() keys=() same_as=() pending=()
+    local line i j
+
+    while IFS= read -r line; do
+        hashes+=("$line")
+    done < <(md5sum -- "${files[@]}" | awk '{ h = $1; sub(/^\\/, "", h); print h }')
+    while IFS= read -r line; do
+        sizes+=("$line")
+    done < <(stat -c%s -- "${files[@]}" 2>/dev/null || stat -f%z -- "${files[@]}")
+    while IFS= read -r line; do
+        urls+=("$line")
+    done < <(for i in "${!files[@]}"; do printf '%s\t%s\n' "${hashes[$i]}" "${sizes[$i]}"; done | get_cached_urls)
+
+    for i in "${!files[@]}"; do
+        if [ -n "${urls[$i]}" ]; then
+            info "🔄 使用缓存的文件: ${files[$i]}"
+            continue
+        fi
+        same_as[$i]=""
+        for j in ${pending[@]+"${pending[@]}"}; do
+            if [ "${hashes[$j]}" = "${hashes[$i]}" ]; then
+                same_as[$i]="$j"
+                break
+            fi
+        done
+        [ -n "${same_as[$i]}" ] || pending+=("$i")
     done
-    
-    if [ "$success" = false ]; then
-        echo "❌ 部分文件上传失败"
-        exit 1
+
+    if [ ${#pending[@]} -gt 0 ]; then
+        get_upload_policy
+        info "🔄 步骤2: 上传 ${#pending[@]} 个新文件..."
+        local batch=$(transport_begin)
+        for i in "${pending[@]}"; do
+            # 凭证会被之后几次运行沿用，upload_dir 不再每次都是新的；
+            # key 里带上 md5，不同内容的同名图片不会撞上 x-oss-forbid-overwrite
+            keys[$i]="${upload_dir}/${hashes[$i]}_$(basename "${files[$i]}")"
+            # OSS 用表单里的签名认证，不带 DashScope 的 API key
+            TRANSPORT_NO_AUTH=1 transport_add "$batch" "$i" POST "$upload_host" \
+                "OSSAccessKeyId=$oss_access_key_id" \
+                "Signature=$signature" \
+                "policy=$policy" \
+                "key=${keys[$i]}" \
+                "x-oss-object-acl=$x_oss_object_acl" \
+                "x-oss-forbid-overwrite=$x_oss_forbid_overwrite" \
+                "success_action_status=200" \
+                "file=@${files[$i]}"
+        done
+        # 传到 OSS 不占 DashScope 的限速令牌，只受并发上限和重试约束
+        RATE_LIMIT_RPS=0 transport_run "$batch" "$UPLOAD_JOBS"
+
+        local status failed=0
+        local new_entries="$batch/new_entries"
+        : > "$new_entries"
+        while IFS=$'\t' read -r i status; do
+            if [[ $status == 2* ]]; then
+                info "✅ 文件上传成功: ${files[$i]}"
+                urls[$i]="oss://${keys[$i]}"
+                printf '%s\t%s\t%s\n' "${hashes[$i]}" "${sizes[$i]}" "${urls[$i]}" >> "$new_entries"
+            else
+                error "❌ 错误: 文件上传失败 (HTTP $status): ${files[$i]}"
+                failed=1
+            fi
+        done < <(transport_statuses "$batch")
+        update_cache_batch < "$new_entries"
+        transport_end "$batch"
+
+        if [ "$failed" -eq 1 ]; then
+            # 可能是凭证不能用了，下次重新取
+            local policy_file="$policy_cache_dir/${model_name//\//_}.json"
+            rm -f "$policy_file"
+            error "❌ 部分文件上传失败"
+            exit 1
+        fi
     fi
+
+    for i in "${!files[@]}"; do
+        [ -n "${same_as[$i]:-}" ] && urls[$i]="${urls[${same_as[$i]}]}"
+        file_urls_keys+=("$(basename "${files[$i]}")")
+        file_urls_values+=("${urls[$i]}")
+    done
 }
 
-# 4. 生成多图片对话JSON
+# 3. 生成多图片对话JSON，流式输出，最后一个分片带 usage
 generate_image_json() {
-    local json_content='{"model": "'"$model_name"'", "messages": [{"role": "user", "content": ['
-    json_content+='{"type": "text", "text": "'"$user_question"'"},'
-    
-    local first=true
-    local i
-    for i in "${!file_urls_values[@]}"; do
-        if [ "$first" = true ]; then
-            first=false
-        else
-            json_content+=","
-        fi
-        json_content+='{"type": "image_url", "image_url": {"url": "'"${file_urls_values[$i]}"'"}}'
-    done
-    
-    json_content+=']}]}'
-    echo "$json_content"
+    jq -n --arg model "$model_name" --arg question "$user_question" '{
+        model: $model,
+        stream: true,
+        stream_options: {include_usage: true},
+        messages: [{role: "user", content: (
+            [{type: "text", text: $question}]
+            + ($ARGS.positional | map({type: "image_url", image_url: {url: .}}))
+        )}]
+    }' --args "${file_urls_values[@]}"
 }
 
-# 5. 调用模型API并处理响应
+# 4. 调用模型API，回答边生成边输出（chatapi.sh 的 stream_chat，与 qwen 相同）
 call_model_api() {
-    echo "🔄 步骤3: 调用模型($model_name)API进行多图对话（非流式输出，请耐心等待几秒）..."
-    local json_data=$(generate_image_json)
+    info "🔄 步骤3: 调用模型($model_name)API进行多图对话..."
+    # 同一秒里的并发运行往后加序号，用 noclobber 占住名字
     local timestamp=$(date +%Y%m%d_%H%M%S)
-    local log_file="$log_dir/chat_${timestamp}.json"
-    
-    # 保存用户输入
-    echo "{\"user_input\": {\"model\": \"$model_name\", \"question\": \"$user_question\", \"images\": [" > "$log_file"
-    local first=true
-    for img in "${file_urls_values[@]}"; do
-        if [ "$first" = true ]; then
-            first=false
-        else
-            echo "," >> "$log_file"
-        fi
-        echo "\"$img\"" >> "$log_file"
+    local base="$log_dir/chat_${timestamp}" n=1
+    while [ -e "$base.json" ] || ! ( set -C; : > "$base.sse" ) 2>/dev/null; do
+        base="$log_dir/chat_${timestamp}_$n"
+        n=$((n + 1))
     done
-    echo "]}, " >> "$log_file"
-    
-    # 调用API并获取响应
-    local response=$(curl -s -X POST "https://dashscope.aliyuncs.com/compatible-mode/v1/chat/completions" \
-        -H "Authorization: $DASHSCOPE_API_KEY" \
-        -H "Content-Type: application/json" \
-        -H "X-DashScope-OssResourceResolve: enable" \
-        -d "$json_data")
-    
-    # 提取并显示content内容
-    local content=$(echo "$response" | jq -r '.choices[0].message.content')
+    local log_file="$base.json"
+    local sse_file="$base.sse"
+    local answer_file="$base.answer"
+    local request_file="$base.request.json"
+    generate_image_json > "$request_file"
+
     echo -e "\n🤖 模型回答："
-    echo "$content"
-    
-    # 保存完整对话记录
-    echo "\"response\": $response}" >> "$log_file"
-    echo "💾 对话记录已保存到: $log_file"
+    stream_chat "$request_file" "$sse_file" "$answer_file" \
+        -X POST "$API_BASE_URL/chat/completions" \
+        -H "Authorization: $DASHSCOPE_API_KEY" \
+        -H "X-DashScope-OssResourceResolve: enable"
+    echo
+    rm -f "$request_file"
+
+    local error_line=$(grep -m 1 -E '^(data: *)?\{"error"' "$sse_file" || true)
+    if [ -n "$error_line" ]; then
+        error "❌ 模型调用失败: $(jq -r '.error.message // .message // .' <<< "${error_line#data: }" 2>/dev/null || echo "${error_line#data: }")"
+        error "原始响应保留在: $sse_file"
+        rm -f "$answer_file"
+        return 1
+    fi
+    if [ "$STREAM_CURL_EXIT" != "0" ]; then
+        error "❌ 请求失败，curl 退出码 $STREAM_CURL_EXIT，原始响应保留在: $sse_file"
+        rm -f "$answer_file"
+        return 1
+    fi
+
+    # usage 记进账本
+    local usage_chunk=$(extract_stream_usage "$sse_file")
+    local row=$(ledger_record vl "${log_file##*/}" <<< "$usage_chunk")
+    if [ -n "$row" ]; then
+        local prompt_tokens cached_tokens completion_tokens cost
+        IFS=$'\t' read -r _ _ _ _ prompt_tokens cached_tokens completion_tokens cost _ <<< "$row"
+        [ "$cost" != "-" ] && cost=$(awk -v cost="$cost" 'BEGIN { printf "%.4f 元", cost }')
+        info "📊 输入 $prompt_tokens 个 tokens（其中缓存 $cached_tokens 个），输出 $completion_tokens 个 tokens，估算费用: $cost"
+    fi
+
+    # 保存完整对话记录，格式和以前的非流式一样：response 里是拼好的完整回答加 usage
+    touch "$answer_file"
+    jq -n \
+        --arg model "$model_name" \
+        --arg question "$user_question" \
+        --arg last "$usage_chunk" \
+        --rawfile content "$answer_file" '{
+            user_input: {model: $model, question: $question, images: $ARGS.positional},
+            response: (($last | fromjson? // {}) | del(.choices)
+                + {choices: [{index: 0, finish_reason: "stop", message: {role: "assistant", content: $content}}]})
+        }' --args "${file_urls_values[@]}" > "$log_file"
+    rm -f "$answer_file" "$sse_file"
+    info "💾 对话记录已保存到: $log_file"
 }
 
 # 解析命令行参数
 parse_args() {
     local files=()
     local parsing_files=false
-    
+
+    # 环境变量 QWEN_IMGPREP 是图片预处理的默认设置，--imgprep 可覆盖，同 qwen
+    if ! imgprep_set "${QWEN_IMGPREP:-off}"; then
+        warn "QWEN_IMGPREP 设置不对，图片不做预处理: $QWEN_IMGPREP"
+    fi
+
     while [[ $# -gt 0 ]]; do
         case $1 in
             -h|--help)
@@ -289,6 +336,29 @@ parse_args() {
                     exit 1
                 fi
                 ;;
+            --tag)
+                LEDGER_TAG="$2"
+                shift 2
+                ;;
+            --imgprep)
+                if ! imgprep_set "$2"; then
+                    error "错误: --imgprep 的格式是 最长边[,质量[,格式]]，质量 1-100，格式 keep/jpg/webp，off 关闭"
+                    exit 1
+                fi
+                shift 2
+                ;;
+            -j|--jobs)
+                if ! [[ $2 =~ ^[1-9][0-9]*$ ]]; then
+                    error "错误: --jobs 需要一个正整数"
+                    exit 1
+                fi
+                UPLOAD_JOBS="$2"
+                shift 2
+                ;;
+            --profile)
+                trace_enable "${QWEN_PROFILE:-$LOG_DIR/profile.jsonl}"
+                shift
+                ;;
 	       -dq)
                 user_question=$(echo "$2" | base64 --decode)
                 shift 2
@@ -328,9 +398,20 @@ parse_args() {
         user_question="这些图片是什么内容？请详细描述。"
     fi
 
-    echo "🤖 使用模型: $model_name"
-    echo "📝 用户问题: $user_question"
+    info "🤖 使用模型: $model_name"
+    info "📝 用户问题: $user_question"
+    # 图片先缩小、压缩（imgprep.sh），上传和上传缓存都用处理后的文件
+    if [ "$IMGPREP_ON" = true ]; then
+        local prepped=() f
+        while IFS= read -r -d '' f; do
+            prepped+=("$f")
+        done < <(printf '%s\0' "${files[@]}" | imgprep_files)
+        files=("${prepped[@]}")
+    fi
+
+    trace_begin upload
     upload_files "${files[@]}"
+    trace_end files="${#files[@]}"
 }
 
 
@@ -344,14 +425,15 @@ main() {
 
     DASHSCOPE_API_KEY=$(jq -r '.api_key' "$APIKEY_JSON"|base64 --decode)
 
-    # 清理过期缓存
-    cleanup_cache
+    # 追踪时退出前打印汇总（trace.sh）
+    [ -n "${QWEN_PROFILE:-}" ] && trace_enable "$QWEN_PROFILE"
+    trap 'trace_finish' EXIT
 
     if [ $# -eq 0 ]; then
         show_help
     fi
 
-    get_upload_policy
+    # 上传凭证在 upload_files 里真要上传时才取；过期的缓存条目在写入时顺便清理
     parse_args "$@"
     call_model_api
 }
@@ -0,0 +1,262 @@
+#!/bin/bash
+
+# 服务器端文件清单的本地镜像
+# 上传缓存只记得 hash -> file_id，文件在服务器上被删了（控制台手动删、别的机器清理）它并不知道，
+# 要等对话请求报错才发现。这里把 GET /files 的结果存一份在本地：
+#   - 用缓存里的 file_id 之前先对一下镜像，服务器上已经没有的当作未命中，重新上传
+#   - 按最后使用时间淘汰（LRU）：上传前估算会不会超过配额，超了就先删最久没用的服务器文件，
+#     而不是 --cleanup 那样把不在本次命令里的文件全部删掉
+# 镜像分页拉取；隔 REMOTE_FULL_SYNC_SECS 全量同步一次（能发现被删掉的文件），
+# 其余时候只拉新文件，拉到一整页都已知就停。自己上传、删除的文件直接改镜像，不用等同步。
+#
+# 文件都在 CACHE_DIR 下，写入时加 cache_lock：
+#   remote_files.tsv   每行: file_id<TAB>字节数<TAB>created_at<TAB>文件名
+#   remote_usage.tsv   每行: file_id<TAB>最后使用时间，只追加，整理缓存时去重
+#   .remote_synced     一行: 上次全量同步时间 上次同步时间
+#   batch_runs.txt     提交过的 .run 文件（绝对路径），一行一个；还没结束的 batch 用到的文件淘汰时不删
+
+REMOTE_MIRROR_FILE="$CACHE_DIR/remote_files.tsv"
+REMOTE_USAGE_FILE="$CACHE_DIR/remote_usage.tsv"
+REMOTE_SYNC_STATE="$CACHE_DIR/.remote_synced"
+REMOTE_PINNED_RUNS="$CACHE_DIR/batch_runs.txt"
+REMOTE_PAGE_SIZE=100
+REMOTE_FULL_SYNC_SECS=86400  # 全量同步间隔
+REMOTE_SYNC_MIN_SECS=300     # 两次增量同步的最短间隔，期间直接信任镜像
+
+# ==================
+# = 同步 =
+# ==================
+
+# 同步镜像
+# 参数: auto（默认，按间隔决定全量、增量或跳过） / full / incremental
+remote_sync() {
+    local mode="${1:-auto}"
+    local now=$(now_epoch)
+    local last_full=0 last=0
+    [ -f "$REMOTE_SYNC_STATE" ] && read -r last_full last < "$REMOTE_SYNC_STATE" || true
+    [[ $last_full =~ ^[0-9]+$ ]] || last_full=0
+    [[ $last =~ ^[0-9]+$ ]] || last=0
+    [ -f "$REMOTE_MIRROR_FILE" ] || last_full=0
+
+    if [ "$mode" = auto ]; then
+        if [ $((now - last_full)) -ge "$REMOTE_FULL_SYNC_SECS" ]; then
+            mode=full
+        elif [ $((now - last)) -ge "$REMOTE_SYNC_MIN_SECS" ]; then
+            mode=incremental
+        else
+            return 0
+        fi
+    fi
+
+    local work_dir=$(mktemp -d "${TMPDIR:-/tmp}/qwen_remote.XXXXXX")
+    local known="$work_dir/known"
+    : > "$work_dir/list"
+    : > "$known"
+    [ "$mode" = incremental ] && cut -f1 "$REMOTE_MIRROR_FILE" > "$known"
+
+    local after="" has_more="" last_id="" fresh pages=0 status
+    while true; do
+        if ! status=$(http_request "$work_dir/page" -X GET \
+            "$API_BASE_URL/files?limit=$REMOTE_PAGE_SIZE${after:+&after=$after}" \
+            -H "Authorization: Bearer $DASHSCOPE_API_KEY"); then
+            error "❌ 获取服务器文件列表失败 (HTTP $status)"
+            rm -rf "$work_dir"
+            return 1
+        fi
+        pages=$((pages + 1))
+
+        # 文件名里的制表符、换行换成空格，保证一行一个文件
+        if ! jq -r '.data[]? | [.id, (.bytes // 0 | tostring), (.created_at // 0 | tostring),
+                (.filename // "" | gsub("[\t\r\n]"; " "))] | @tsv' "$work_dir/page" > "$work_dir/rows"; then
+            error "❌ 服务器文件列表格式错误"
+            rm -rf "$work_dir"
+            return 1
+        fi
+        cat "$work_dir/rows" >> "$work_dir/list"
+        IFS=$'\t' read -r has_more last_id < <(jq -r '[(.has_more // false | tostring), (.data[-1].id? // "")] | @tsv' "$work_dir/page")
+
+        # 增量同步时一整页都是已知的文件就不用往下翻了
+        if [ "$mode" = incremental ]; then
+            fresh=$(awk -F'\t' 'FILENAME == ARGV[1] { k[$1]; next } !($1 in k) { n++ } END { print n + 0 }' \
+                "$known" "$work_dir/rows")
+            [ "$fresh" -gt 0 ] || break
+        fi
+        [ "$has_more" = true ] && [ -n "$last_id" ] || break
+        after="$last_id"
+    done
+
+    cache_lock
+    if [ "$mode" = full ]; then
+        # 同步期间别的进程新上传的文件（created_at 不早于这次同步开始）也留着
+        awk -F'\t' -v since="$now" 'FILENAME == ARGV[1] || $3 >= since' \
+            "$work_dir/list" "${REMOTE_MIRROR_FILE}" 2>/dev/null | awk -F'\t' '!seen[$1]++' > "$REMOTE_MIRROR_FILE.tmp.$$"
+        last_full=$now
+    else
+        # 新拉到的在前，同一个 id 只留一行
+        awk -F'\t' '!seen[$1]++' "$work_dir/list" "$REMOTE_MIRROR_FILE" > "$REMOTE_MIRROR_FILE.tmp.$$"
+    fi
+    mv "$REMOTE_MIRROR_FILE.tmp.$$" "$REMOTE_MIRROR_FILE"
+    echo "$last_full $now" > "$REMOTE_SYNC_STATE"
+    cache_unlock
+
+    debug "服务器文件清单已同步（$mode，$pages 页），共 $(wc -l < "$REMOTE_MIRROR_FILE" | tr -d ' ') 个文件"
+    rm -rf "$work_dir"
+}
+
+# 镜像里加文件，stdin 每行: file_id<TAB>字节数<TAB>created_at<TAB>文件名
+remote_mirror_add() {
+    local rows=$(cat)
+    [ -n "$rows" ] || return 0
+    [ -f "$REMOTE_MIRROR_FILE" ] || return 0
+    cache_lock
+    printf '%s\n' "$rows" >> "$REMOTE_MIRROR_FILE"
+    cache_unlock
+}
+
+# 镜像里删文件，stdin 每行一个 file_id
+remote_mirror_remove() {
+    local ids=$(cat)
+    [ -n "$ids" ] || return 0
+    [ -f "$REMOTE_MIRROR_FILE" ] || return 0
+    cache_lock
+    awk -F'\t' 'NR == FNR { gone[$1]; next } !($1 in gone)' - "$REMOTE_MIRROR_FILE" \
+        <<< "$ids" > "$REMOTE_MIRROR_FILE.tmp.$$"
+    mv "$REMOTE_MIRROR_FILE.tmp.$$" "$REMOTE_MIRROR_FILE"
+    cache_unlock
+}
+
+# 记录文件被用到了，stdin 每行一个 file_id
+remote_touch() {
+    local now=$(now_epoch)
+    local ids=$(cat)
+    [ -n "$ids" ] || return 0
+    awk -v now="$now" 'NF { print $1 "\t" now }' <<< "$ids" >> "$REMOTE_USAGE_FILE"
+}
+
+# 使用记录去重，只留镜像里还有的文件的最后一次
+remote_usage_compact() {
+    [ -f "$REMOTE_USAGE_FILE" ] || return 0
+    cache_lock
+    awk -F'\t' -v OFS='\t' '
+        FILENAME == ARGV[1] { live[$1]; next }
+        ($1 in live) && (!($1 in last) || $2 > last[$1]) { last[$1] = $2 }
+        END { for (id in last) print id, last[id] }
+    ' "${REMOTE_MIRROR_FILE}" "$REMOTE_USAGE_FILE" > "$REMOTE_USAGE_FILE.tmp.$$" 2>/dev/null &&
+        mv "$REMOTE_USAGE_FILE.tmp.$$" "$REMOTE_USAGE_FILE"
+    rm -f "$REMOTE_USAGE_FILE.tmp.$$"
+    cache_unlock
+}
+
+# ==================
+# = 校验 =
+# ==================
+
+# stdin 每行一个 file_id，输出镜像里没有的（服务器上已经删掉的）
+# 镜像还没建立时什么都不输出
+remote_missing_ids() {
+    [ -f "$REMOTE_MIRROR_FILE" ] || { cat > /dev/null; return 0; }
+    awk -F'\t' 'FILENAME == ARGV[1] { live[$1]; next } NF && !($1 in live)' "$REMOTE_MIRROR_FILE" -
+}
+
+# ==================
+# = 按 LRU 淘汰 =
+# ==================
+
+# 选出要删的服务器文件，使 已有 + 即将上传 不超过配额的 (100 - REMOTE_EVICT_HEADROOM)%
+# 参数: 即将上传的文件数 字节数 [不能删的 file_id 列表文件]
+# 输出要删的 file_id，从最久没用的开始；没用过的按上传时间算
+remote_evict_plan() {
+    local need_files="$1"
+    local need_bytes="$2"
+    local keep_file="${3:-/dev/null}"
+
+    [ -f "$REMOTE_MIRROR_FILE" ] || return 0
+    [ -f "$REMOTE_USAGE_FILE" ] || : > "$REMOTE_USAGE_FILE"
+
+    # 第一遍算总量，没超配额就到此为止；超了输出候选: 最后使用时间<TAB>字节数<TAB>file_id
+    local work_dir=$(mktemp -d "${TMPDIR:-/tmp}/qwen_evict.XXXXXX")
+    awk -F'\t' -v OFS='\t' -v target="$work_dir/target" \
+        -v need_files="$need_files" -v need_bytes="$need_bytes" \
+        -v max_files="$REMOTE_QUOTA_FILES" -v max_bytes="$REMOTE_QUOTA_BYTES" \
+        -v headroom="$REMOTE_EVICT_HEADROOM" '
+        FILENAME == ARGV[1] { keep[$1]; next }
+        FILENAME == ARGV[2] { if (!($1 in used) || $2 > used[$1]) used[$1] = $2; next }
+        {
+            files++; bytes += $2
+            if (!($1 in keep)) print (($1 in used) ? used[$1] : $3), $2, $1
+        }
+        END {
+            if (files + need_files <= max_files && bytes + need_bytes <= max_bytes) exit
+            printf "%d %.0f %d %.0f\n", files, bytes,
+                max_files * (100 - headroom) / 100 - need_files,
+                max_bytes * (100 - headroom) / 100 - need_bytes > target
+        }' "$keep_file" "$REMOTE_USAGE_FILE" "$REMOTE_MIRROR_FILE" > "$work_dir/candidates"
+
+    if [ -s "$work_dir/target" ]; then
+        local files bytes max_files max_bytes
+        read -r files bytes max_files max_bytes < "$work_dir/target"
+        sort -t$'\t' -k1,1n "$work_dir/candidates" |
+        awk -F'\t' -v files="$files" -v bytes="$bytes" -v max_files="$max_files" -v max_bytes="$max_bytes" '
+            files <= max_files && bytes <= max_bytes { exit }
+            { print $3; files--; bytes -= $2 }'
+    fi
+    rm -rf "$work_dir"
+}
+
+# 记下提交的 .run 文件，batch 结束前它用到的服务器文件不会被淘汰
+# 参数: .run 文件
+remote_pin_run() {
+    local run_file="$1"
+    [[ $run_file == /* ]] || run_file="$PWD/$run_file"
+    cache_lock
+    printf '%s\n' "$run_file" >> "$REMOTE_PINNED_RUNS"
+    cache_unlock
+}
+
+# 输出还没结束的 batch 用到的 file_id：各分片的 input_file_id，以及 batch 文件里请求引用的 fileid://
+# .run 已经改名（.run.done / .run.failed）或不在了的，顺便从清单里去掉
+remote_pinned_ids() {
+    [ -s "$REMOTE_PINNED_RUNS" ] || return 0
+    local run_file
+    local -a live=()
+    # 读和重写都在锁里，别的进程同时登记的 .run 不会丢
+    cache_lock
+    while IFS= read -r run_file; do
+        [ -f "$run_file" ] && live+=("$run_file")
+    done < "$REMOTE_PINNED_RUNS"
+    if [ ${#live[@]} -gt 0 ]; then
+        printf '%s\n' "${live[@]}" | awk '!seen[$0]++' > "$REMOTE_PINNED_RUNS.tmp.$$"
+    else
+        : > "$REMOTE_PINNED_RUNS.tmp.$$"
+    fi
+    mv "$REMOTE_PINNED_RUNS.tmp.$$" "$REMOTE_PINNED_RUNS"
+    cache_unlock
+
+    [ ${#live[@]} -gt 0 ] || return 0
+    {
+        jq -r '((.shards // [])[].input_file_id), .input_file_id | select(. != null)' "${live[@]}" 2>/dev/null
+        for run_file in "${live[@]}"; do
+            [ -f "${run_file%.run}" ] && grep -o 'fileid://[A-Za-z0-9_-]*' "${run_file%.run}" | cut -c10-
+        done
+    } | sort -u
+    return 0
+}
+
+# 按 LRU 删服务器文件直到低于配额
+# 参数同 remote_evict_plan；删掉的同时从上传缓存和镜像里去掉
+# 超了配额才去读进行中的 batch，把它们用到的文件加进不能删的列表再算一次
+remote_evict() {
+    local plan=$(remote_evict_plan "$@")
+    [ -n "$plan" ] || return 0
+
+    local keep_file=$(mktemp "${TMPDIR:-/tmp}/qwen_keep.XXXXXX")
+    cat "${3:-/dev/null}" > "$keep_file"
+    remote_pinned_ids >> "$keep_file"
+    plan=$(remote_evict_plan "$1" "$2" "$keep_file")
+    rm -f "$keep_file"
+    [ -n "$plan" ] || return 0
+
+    local count=$(wc -l <<< "$plan" | tr -d ' ')
+    warn "服务器文件接近配额（$REMOTE_QUOTA_FILES 个 / $REMOTE_QUOTA_BYTES 字节），删除最久没用的 $count 个"
+    delete_files_by_json_ids "$(jq -R -s -c 'split("\n") | map(select(length > 0))' <<< "$plan")" || true
+}
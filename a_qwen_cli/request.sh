@@ -0,0 +1,288 @@
+#!/bin/bash
+
+# 请求执行器，所有对外的 HTTP 请求都经过这里
+# - 429、5xx 和连接失败自动重试，最多 MAX_RETRIES 次；指数退避加随机抖动，
+#   服务端给了 Retry-After 就至少等这么久
+# - 令牌桶限速：每秒 RATE_LIMIT_RPS 个请求，最多攒 RATE_LIMIT_BURST 个。
+#   桶的状态放在 RATE_LIMIT_DIR，同一台机器上同时跑的多个 qwen 共用一个桶；
+#   收到 429 时整个桶暂停，所有进程一起慢下来，而不是各自重试把限额打满
+# - 全局并发上限 MAX_INFLIGHT，同样跨进程，每个在途请求占一个 slot 目录
+# RATE_LIMIT_RPS 或 MAX_INFLIGHT 设为 0 即关闭对应的限制
+
+RATE_LIMIT_DIR="${RATE_LIMIT_DIR:-${TMPDIR:-/tmp}/qwen_ratelimit.$(id -u)}"
+RETRY_BASE_MS=1000    # 第一次重试前大约等 1 秒，之后每次翻倍
+RETRY_MAX_MS=30000    # 退避上限
+RETRY_AFTER_MAX_MS=300000  # Retry-After 最多等 5 分钟
+
+# 当前毫秒时间戳，bash 5 用 EPOCHREALTIME 不 fork，老版本退回到秒
+now_ms() {
+    if [ -n "${EPOCHREALTIME:-}" ]; then
+        local t="${EPOCHREALTIME//[!0-9]/}"
+        echo $((10#$t / 1000))
+    else
+        echo "$(now_epoch)000"
+    fi
+}
+
+sleep_ms() {
+    local ms="$1"
+    [ "$ms" -gt 0 ] || return 0
+    sleep "$((ms / 1000)).$(printf '%03d' $((ms % 1000)))"
+}
+
+# 状态码是否值得重试，000 表示没连上或超时
+is_retryable_status() {
+    case "$1" in
+        000|429|500|502|503|504) return 0 ;;
+        *) return 1 ;;
+    esac
+}
+
+# ==================
+# = 令牌桶 =
+# ==================
+# 状态文件一行: 剩余令牌(千分之一个为单位) 上次更新时间(ms) 暂停到(ms)
+
+# 锁只保护读写一次状态文件，正常持有几毫秒；持锁进程已经不在了，
+# 或者锁已经放了 RATE_LIMIT_LOCK_STALE 秒以上（进程被挂起、pid 被复用），才当残留锁清掉。
+# 锁的年龄看目录的 mtime，每等 1 秒才查一次，平时不 fork
+RATE_LIMIT_LOCK_STALE=5
+rate_limit_lock() {
+    local lock_dir="$RATE_LIMIT_DIR/.lock"
+    local waited=0 holder mtime stale
+    mkdir -p "$RATE_LIMIT_DIR"
+    until mkdir "$lock_dir" 2>/dev/null; do
+        holder=$(cat "$lock_dir/pid" 2>/dev/null || true)
+        stale=0
+        if [ -n "$holder" ] && ! kill -0 "$holder" 2>/dev/null; then
+            stale=1
+        elif [ "$waited" -ge 100 ]; then
+            waited=0
+            mtime=$(stat -c %Y "$lock_dir" 2>/dev/null || stat -f %m "$lock_dir" 2>/dev/null || true)
+            if [ -n "$mtime" ] && [ $(( $(date +%s) - mtime )) -ge "$RATE_LIMIT_LOCK_STALE" ]; then
+                stale=1
+            fi
+        fi
+        # 清之前再看一眼，锁已经换了主人（别的进程刚清掉并重新拿到）就不动
+        if [ "$stale" = 1 ] && [ "$(cat "$lock_dir/pid" 2>/dev/null || true)" = "$holder" ]; then
+            rm -rf "$lock_dir"
+            waited=0
+            continue
+        fi
+        sleep 0.01
+        waited=$((waited + 1))
+    done
+    echo "${BASHPID:-$$}" > "$lock_dir/pid"
+}
+
+rate_limit_unlock() {
+    rm -rf "$RATE_LIMIT_DIR/.lock"
+}
+
+# 读桶状态到 RL_TOKENS RL_LAST RL_BLOCKED，并按流逝的时间补充令牌
+rate_limit_read() {
+    local now="$1"
+    local burst_milli=$(( ${RATE_LIMIT_BURST:-$RATE_LIMIT_RPS} * 1000 ))
+
+    RL_TOKENS=$burst_milli
+    RL_LAST=$now
+    RL_BLOCKED=0
+    if [ -f "$RATE_LIMIT_DIR/bucket" ]; then
+        read -r RL_TOKENS RL_LAST RL_BLOCKED < "$RATE_LIMIT_DIR/bucket" || true
+    fi
+    [[ $RL_TOKENS =~ ^[0-9]+$ ]] || RL_TOKENS=$burst_milli
+    [[ $RL_LAST =~ ^[0-9]+$ ]] && [ "$RL_LAST" -le "$now" ] || RL_LAST=$now
+    [[ $RL_BLOCKED =~ ^[0-9]+$ ]] || RL_BLOCKED=0
+
+    RL_TOKENS=$(( RL_TOKENS + (now - RL_LAST) * RATE_LIMIT_RPS ))
+    [ "$RL_TOKENS" -gt "$burst_milli" ] && RL_TOKENS=$burst_milli
+    RL_LAST=$now
+}
+
+rate_limit_write() {
+    echo "$RL_TOKENS $RL_LAST $RL_BLOCKED" > "$RATE_LIMIT_DIR/bucket"
+}
+
+# 取 n 个令牌（默认一个），不够就等
+rate_limit_acquire() {
+    local need="${1:-1}"
+    [ "${RATE_LIMIT_RPS:-0}" -gt 0 ] || return 0
+
+    local now wait_ms take
+    while true; do
+        rate_limit_lock
+        now=$(now_ms)
+        rate_limit_read "$now"
+        wait_ms=0
+        if [ "$now" -lt "$RL_BLOCKED" ]; then
+            wait_ms=$((RL_BLOCKED - now))
+        else
+            take=$((RL_TOKENS / 1000))
+            [ "$take" -gt "$need" ] && take=$need
+            RL_TOKENS=$((RL_TOKENS - take * 1000))
+            need=$((need - take))
+            [ "$need" -gt 0 ] && wait_ms=$(( (1000 - RL_TOKENS) / RATE_LIMIT_RPS + 1 ))
+        fi
+        rate_limit_write
+        rate_limit_unlock
+
+        [ "$need" -eq 0 ] && return 0
+        sleep_ms "$wait_ms"
+    done
+}
+
+# 收到 429：整个桶暂停一段时间，令牌清空
+rate_limit_penalize() {
+    local delay_ms="$1"
+    [ "${RATE_LIMIT_RPS:-0}" -gt 0 ] || return 0
+
+    rate_limit_lock
+    local now=$(now_ms)
+    rate_limit_read "$now"
+    RL_TOKENS=0
+    [ $((now + delay_ms)) -gt "$RL_BLOCKED" ] && RL_BLOCKED=$((now + delay_ms))
+    rate_limit_write
+    rate_limit_unlock
+}
+
+# ==================
+# = 并发 slot =
+# ==================
+# 每个在途请求占一个 $RATE_LIMIT_DIR/slot.N 目录，里面记着 pid，进程没了的 slot 自动回收
+# 拿到的 slot 放在 REQUEST_SLOTS 数组里
+
+REQUEST_SLOTS=()
+
+# 最多拿 n 个 slot，至少拿到一个才返回
+request_slots_acquire() {
+    local want="${1:-1}"
+    REQUEST_SLOTS=()
+    [ "${MAX_INFLIGHT:-0}" -gt 0 ] || return 0
+    [ "$want" -gt "$MAX_INFLIGHT" ] && want=$MAX_INFLIGHT
+
+    local i slot holder
+    mkdir -p "$RATE_LIMIT_DIR"
+    while true; do
+        for ((i = 1; i <= MAX_INFLIGHT && ${#REQUEST_SLOTS[@]} < want; i++)); do
+            slot="$RATE_LIMIT_DIR/slot.$i"
+            if mkdir "$slot" 2>/dev/null; then
+                echo "${BASHPID:-$$}" > "$slot/pid"
+                REQUEST_SLOTS+=("$slot")
+            else
+                holder=$(cat "$slot/pid" 2>/dev/null || true)
+                if [ -n "$holder" ] && ! kill -0 "$holder" 2>/dev/null; then
+                    rm -rf "$slot"
+                fi
+            fi
+        done
+        [ "${#REQUEST_SLOTS[@]}" -gt 0 ] && return 0
+        sleep 0.05
+    done
+}
+
+request_slots_release() {
+    [ "${#REQUEST_SLOTS[@]}" -gt 0 ] && rm -rf "${REQUEST_SLOTS[@]}"
+    REQUEST_SLOTS=()
+}
+
+# ==================
+# = 重试 =
+# ==================
+
+# 响应头里的 Retry-After 换成毫秒，支持秒数和 HTTP 日期两种写法，没有输出 0
+retry_after_ms() {
+    local headers_file="${1:-}"
+    local line value=""
+    [ -f "$headers_file" ] || { echo 0; return; }
+    while IFS= read -r line; do
+        line="${line%$'\r'}"
+        case "$line" in
+            [Rr][Ee][Tt][Rr][Yy]-[Aa][Ff][Tt][Ee][Rr]:*)
+                value="${line#*:}"
+                value="${value# }"
+                ;;
+        esac
+    done < "$headers_file"
+
+    local ms=0
+    if [[ $value =~ ^[0-9]+$ ]]; then
+        ms=$((value * 1000))
+    elif [ -n "$value" ]; then
+        local at=$(jq -rn --arg d "$value" '$d | strptime("%a, %d %b %Y %H:%M:%S GMT") | mktime' 2>/dev/null || true)
+        [[ $at =~ ^[0-9]+$ ]] && ms=$((at * 1000 - $(now_ms)))
+    fi
+    [ "$ms" -lt 0 ] && ms=0
+    [ "$ms" -gt "$RETRY_AFTER_MAX_MS" ] && ms=$RETRY_AFTER_MAX_MS
+    echo "$ms"
+}
+
+# 第 attempt 次重试（从 0 开始）前要等多久
+# 先等退避时间的一半，再加上随机的另一半，避免多个进程同时醒来一起重试
+retry_delay_ms() {
+    local attempt="$1"
+    local headers_file="${2:-}"
+
+    local backoff=$((RETRY_BASE_MS << attempt))
+    [ "$backoff" -gt "$RETRY_MAX_MS" ] && backoff=$RETRY_MAX_MS
+    local delay=$(( backoff / 2 + (RANDOM * 32768 + RANDOM) % (backoff / 2 + 1) ))
+    local retry_after=$(retry_after_ms "$headers_file")
+    [ "$retry_after" -gt "$delay" ] && delay=$retry_after
+    echo "$delay"
+}
+
+# 响应头文件里最后一个状态码（重定向、100-continue 之后的那个）
+http_status_from_headers() {
+    local headers_file="$1"
+    local line status="000"
+    [ -f "$headers_file" ] || { echo "$status"; return; }
+    while IFS= read -r line; do
+        case "$line" in
+            HTTP/*) line="${line#* }"; status="${line%% *}"; status="${status%$'\r'}" ;;
+        esac
+    done < "$headers_file"
+    echo "$status"
+}
+
+# 发一个请求，失败按上面的规则重试
+# 参数: 响应体文件 curl 参数...（方法、url、header、数据都由调用方给）
+# 输出 HTTP 状态码，000 表示没连上；2xx 返回 0，否则返回 1
+http_request() {
+    local body_file="$1"
+    shift
+
+    local headers_file="$body_file.headers"
+    local attempt=0 status delay
+    # 追踪时 curl 在状态码后面再输出分段耗时（trace.sh）
+    local write_out='%{http_code}'
+    [ -n "$TRACE_FILE" ] && write_out="%{http_code}\\t$TRACE_CURL_FORMAT"
+    while true; do
+        rate_limit_acquire
+        request_slots_acquire 1
+        trace_begin http
+        status=$(curl -sS -o "$body_file" -D "$headers_file" -w "$write_out" "$@") || true
+        request_slots_release
+        trace_end_raw "${status#*$'\t'}" attempt="$attempt"
+        status="${status%%$'\t'*}"
+        [[ $status =~ ^[0-9]{3}$ ]] || status=000
+
+        case "$status" in
+            2*)
+                rm -f "$headers_file"
+                echo "$status"
+                return 0
+                ;;
+        esac
+
+        if ! is_retryable_status "$status" || [ "$attempt" -ge "${MAX_RETRIES:-0}" ]; then
+            rm -f "$headers_file"
+            echo "$status"
+            return 1
+        fi
+
+        delay=$(retry_delay_ms "$attempt" "$headers_file")
+        [ "$status" = 429 ] && rate_limit_penalize "$delay"
+        attempt=$((attempt + 1))
+        warn "请求失败 (HTTP $status)，${delay}ms 后第 $attempt 次重试"
+        sleep_ms "$delay"
+    done
+}
@@ -0,0 +1,244 @@
+#!/bin/bash
+
+# 常驻进程（qwen serve）
+# 每次运行 qwen 都要加载十几个脚本、检查依赖和 xxhash、解码 apikey.json、读 config.json、
+# 初始化缓存、探测 curl 支持的参数，GUI 每点一次都要重来一遍。
+# qwen serve 把这些做完后常驻，之后的 qwen 只是一个薄客户端：把参数、当前目录和输入输出交给它，
+# 由常驻进程 fork 一个子 shell 执行（已加载的函数和配置直接继承），输出原样流回来。
+# 没有常驻进程，或者设了 QWEN_NO_SERVE=1 时，照旧自己从头跑。
+#
+# bash 不能监听 unix socket，这里用命名管道（mkfifo）代替，目录只有自己能访问：
+#   $QWEN_SERVE_DIR/ctl         常驻进程读的请求管道，一行一个请求目录
+#   $QWEN_SERVE_DIR/pid         常驻进程的 pid
+#   $QWEN_SERVE_DIR/script_dir  对应的安装目录，不是同一份 qwen 的不转发
+# 目录的位置是固定的，别的用户可能抢先建好，客户端只认自己拥有、权限 700 的目录和管道。
+# 每个请求一个目录 req.XXXXXX，客户端写好:
+#   args（以 \0 分隔）cwd env tty（stdin 是终端时的设备名）
+#   in out err 三个管道（stdin 不是终端时才有 in），done 管道返回退出码
+# 常驻进程和客户端谁先在请求目录里 mkdir claimed 谁执行：常驻进程已经退出或者
+# SERVE_CLAIM_TIMEOUT 秒内没接手，客户端自己占住并在本进程里照常运行，不会两边都跑。
+# 子 shell 各自一个进程组，客户端 Ctrl-C 时整组结束。
+# curl 的连接没法跨进程保留，每个请求仍然自己建连接。
+
+QWEN_SERVE_DIR="${QWEN_SERVE_DIR:-${TMPDIR:-/tmp}/qwen_serve.$UID}"
+# 随请求带过去的环境变量，执行时以客户端的为准，客户端没设的也不用常驻进程启动时的
+QWEN_SERVE_ENV="QWEN_TAG QWEN_PROFILE QWEN_IMGPREP QWEN_API_BASE_URL QWEN_DASHSCOPE_API_URL"
+SERVE_CLAIM_TIMEOUT=5  # 常驻进程活着但这么多秒还没接手请求，就自己跑
+SERVE_PID=""
+
+# 常驻进程是否在跑，而且是这份 qwen 的，pid 记在 SERVE_PID
+# 目录、管道和 pid 文件都必须是自己的，目录权限必须是 700，否则当作没有，免得把输入交给别人；
+# 没有常驻进程时只用内建命令，不 fork；这时 utils.sh 还没加载，提示直接写 stderr
+serve_running() {
+    [ -z "${QWEN_NO_SERVE:-}" ] || return 1
+    local ctl="$QWEN_SERVE_DIR/ctl"
+    [ -d "$QWEN_SERVE_DIR" ] && [ ! -L "$QWEN_SERVE_DIR" ] && [ -O "$QWEN_SERVE_DIR" ] || return 1
+    [ -p "$ctl" ] && [ ! -L "$ctl" ] && [ -O "$ctl" ] && [ -O "$QWEN_SERVE_DIR/pid" ] || return 1
+    local mode=$(stat -c %a "$QWEN_SERVE_DIR" 2>/dev/null || stat -f %Lp "$QWEN_SERVE_DIR" 2>/dev/null)
+    if [ "$mode" != 700 ]; then
+        echo "⚠️ $QWEN_SERVE_DIR 的权限是 $mode 不是 700，不转发给常驻进程" >&2
+        return 1
+    fi
+    local pid="" dir=""
+    read -r pid < "$QWEN_SERVE_DIR/pid" 2>/dev/null || return 1
+    read -r dir < "$QWEN_SERVE_DIR/script_dir" 2>/dev/null || return 1
+    [ "$dir" = "$SCRIPT_DIR" ] && kill -0 "$pid" 2>/dev/null || return 1
+    SERVE_PID="$pid"
+}
+
+# ==================
+# = 客户端 =
+# ==================
+
+# 把这次运行交给常驻进程，退出码和它一致，不返回；
+# 常驻进程没接手（已经退出或卡住）时清理掉请求后返回，由调用方照常自己跑
+serve_forward() {
+    local req=$(mktemp -d "$QWEN_SERVE_DIR/req.XXXXXX") || return 0
+    local name
+
+    printf '%s\0' "$@" > "$req/args"
+    printf '%s\0' "$PWD" > "$req/cwd"
+    : > "$req/env"
+    for name in $QWEN_SERVE_ENV; do
+        [ -n "${!name:-}" ] && printf '%s=%s\0' "$name" "${!name}" >> "$req/env"
+    done
+
+    local -a pids=()
+    local in_pid=""
+    mkfifo "$req/out" "$req/err" "$req/done"
+    if [ -t 0 ]; then
+        # 终端直接交给常驻进程打开，交互的 read -p 照常能用
+        tty > "$req/tty" 2>/dev/null || true
+    else
+        # 后台命令的 stdin 会被换成 /dev/null，先复制一份
+        mkfifo "$req/in"
+        exec 4<&0
+        cat <&4 > "$req/in" &
+        in_pid=$!
+    fi
+    cat "$req/out" &
+    pids+=($!)
+    cat "$req/err" >&2 &
+    pids+=($!)
+
+    # Ctrl-C 时结束常驻进程里对应的整个进程组
+    trap 'serve_cancel "$req"; exit 130' INT TERM
+
+    # 两个管道都用读写方式打开，对面不在时 open 不会卡住；等结果时每秒看一次对面还在不在
+    exec 5<> "$QWEN_SERVE_DIR/ctl"
+    printf '%s\n' "$req" >&5
+    exec 5>&-
+    exec 6<> "$req/done"
+
+    local rc="" handler="" waited=0
+    while ! IFS= read -r -t 1 rc <&6; do
+        if [ -z "$handler" ]; then
+            read -r handler < "$req/pid" 2>/dev/null || handler=""
+            [ -n "$handler" ] && continue
+            waited=$((waited + 1))
+            if ! kill -0 "$SERVE_PID" 2>/dev/null || [ "$waited" -ge "$SERVE_CLAIM_TIMEOUT" ]; then
+                if mkdir "$req/claimed" 2>/dev/null; then
+                    echo "⚠️ 常驻进程没有响应，改为直接运行" >&2
+                    exec 6>&-
+                    kill "${pids[@]}" $in_pid 2>/dev/null || true
+                    wait "${pids[@]}" $in_pid 2>/dev/null || true
+                    rm -rf "$req"
+                    trap - INT TERM
+                    return 0
+                fi
+                # 常驻进程刚好接手了，等它把 pid 写出来
+            fi
+        elif ! kill -0 "$handler" 2>/dev/null; then
+            # 处理进程没了：刚写完结果就退出的再读一次，否则是被杀掉了
+            IFS= read -r -t 1 rc <&6 && break
+            echo "❌ 常驻进程里处理这次请求的进程意外退出" >&2
+            # 输出管道可能一直没人打开，读的 cat 不会自己结束
+            kill "${pids[@]}" 2>/dev/null || true
+            rc=1
+            break
+        fi
+    done
+    exec 6>&-
+
+    # 输出读完为止；stdin 没读完的（比如一直开着的管道）不再等
+    wait "${pids[@]}" 2>/dev/null || true
+    [ -n "$in_pid" ] && kill "$in_pid" 2>/dev/null || true
+    rm -rf "$req"
+    exit "$rc"
+}
+
+serve_cancel() {
+    local req="$1"
+    local pgid=""
+    read -r pgid < "$req/pid" 2>/dev/null && kill -TERM -- "-$pgid" 2>/dev/null
+    kill $(jobs -p) 2>/dev/null
+    rm -rf "$req"
+}
+
+# ==================
+# = 常驻进程 =
+# ==================
+
+# config.json、apikey.json 改了就重新读，其余状态保持
+serve_reload_config() {
+    local stamp="$QWEN_SERVE_DIR/loaded"
+    if [ "$CONFIG_JSON" -nt "$stamp" ] || [ "$APIKEY_JSON" -nt "$stamp" ]; then
+        MODEL_CONFIG=$(jq -c . "$CONFIG_JSON")
+        DASHSCOPE_API_KEY=$(jq -r '.api_key' "$APIKEY_JSON" | base64 --decode)
+        : > "$stamp"
+        info "🔄 已重新读取 config.json 和 apikey.json"
+    fi
+}
+
+# 在子 shell 里执行一个请求，和独立运行的 qwen 一样走 main
+serve_handle() {
+    local req="$1"
+    local -a args=()
+    local arg cwd="" kv
+    while IFS= read -r -d '' arg; do
+        args+=("$arg")
+    done < "$req/args"
+    IFS= read -r -d '' cwd < "$req/cwd" || true
+    unset $QWEN_SERVE_ENV
+    while IFS= read -r -d '' kv; do
+        case " $QWEN_SERVE_ENV " in
+            *" ${kv%%=*} "*) export "$kv" ;;
+        esac
+    done < "$req/env"
+
+    cd "$cwd" || exit 1
+    LEDGER_TAG="${QWEN_TAG:-}"
+    API_BASE_URL="${QWEN_API_BASE_URL:-$DEFAULT_API_BASE_URL}"
+
+    # 追踪从收到请求算起，startup 基本为 0
+    TRACE_FILE=""
+    trace_now
+    TRACE_T0=$TRACE_NOW
+    [ -n "${QWEN_PROFILE:-}" ] && trace_enable "$QWEN_PROFILE"
+
+    RUN_DIR=$(mktemp -d "${TMPDIR:-/tmp}/qwen_run.XXXXXX")
+    trap 'trace_finish; rm -rf "$RUN_DIR"' EXIT
+
+    main ${args[@]+"${args[@]}"}
+}
+
+serve_main() {
+    if serve_running; then
+        error "❌ 已经有常驻进程在跑: $QWEN_SERVE_DIR"
+        exit 1
+    fi
+    rm -rf "$QWEN_SERVE_DIR"
+    mkdir -m 700 "$QWEN_SERVE_DIR" || exit 1
+    mkfifo "$QWEN_SERVE_DIR/ctl"
+    printf '%s\n' "$SCRIPT_DIR" > "$QWEN_SERVE_DIR/script_dir"
+    : > "$QWEN_SERVE_DIR/loaded"
+    echo "$$" > "$QWEN_SERVE_DIR/pid"
+
+    # 以后每个请求都用得上的探测先做掉
+    transport_can_parallel || true
+
+    trap 'rm -rf "$QWEN_SERVE_DIR" "$RUN_DIR"; exit 0' INT TERM
+    trap 'rm -rf "$QWEN_SERVE_DIR" "$RUN_DIR"' EXIT
+
+    # 每个请求放进自己的进程组，取消时可以整组结束
+    set -m
+    # 读写方式打开，没有客户端时 read 阻塞而不是读到 EOF
+    exec 3<> "$QWEN_SERVE_DIR/ctl"
+    info "✅ 常驻进程已启动 (pid $$)，请求管道: $QWEN_SERVE_DIR/ctl"
+
+    local req stdin_src tty
+    while IFS= read -r req <&3; do
+        [[ $req == "$QWEN_SERVE_DIR"/req.* && -f "$req/args" ]] || continue
+        # 客户端等不及时会自己占住请求，谁先建 claimed 谁执行
+        mkdir "$req/claimed" 2>/dev/null || continue
+        serve_reload_config
+
+        stdin_src=/dev/null
+        if [ -p "$req/in" ]; then
+            stdin_src="$req/in"
+        elif [ -s "$req/tty" ]; then
+            read -r tty < "$req/tty"
+            [ -r "$tty" ] && [ -w "$tty" ] && stdin_src="$tty"
+        fi
+
+        {
+            rc=0
+            ( serve_handle "$req" ) < "$stdin_src" > "$req/out" 2> "$req/err" || rc=$?
+            echo "$rc" > "$req/done"
+        } &
+        echo "$!" > "$req/pid"
+        debug "请求 $req 由进程组 $! 处理"
+    done
+}
+
+# 停掉常驻进程
+serve_stop() {
+    local pid=""
+    if ! read -r pid < "$QWEN_SERVE_DIR/pid" 2>/dev/null || ! kill -0 "$pid" 2>/dev/null; then
+        warn "没有在跑的常驻进程"
+        rm -rf "$QWEN_SERVE_DIR"
+        return 0
+    fi
+    kill -TERM "$pid"
+    info "✅ 已停止常驻进程 (pid $pid)"
+}
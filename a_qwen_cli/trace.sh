@@ -0,0 +1,182 @@
+#!/bin/bash
+
+# 性能追踪（--profile 或环境变量 QWEN_PROFILE=文件）
+# 打开后每个阶段（span）往 TRACE_FILE 追加一行 JSON：
+#   {"run":本次运行开始时间,"pid":进程号,"span":"upload","t_us":相对开始的时间,"dur_us":耗时,...附加字段}
+# 阶段有 startup（依赖检查、缓存初始化）、expand、hash、remote_check、upload、build_request、
+# chat、ttft（发出请求到第一个字）、stream（第一个字到结束）、render、total；
+# 每个 HTTP 请求一个 http span，带 curl 的分段耗时（从请求开始算起的累计秒数，同 curl -w）：
+#   dns_s connect_s tls_s ttfb_s total_s，以及 up_bytes down_bytes status url
+# 退出时按 span 汇总打印一张表。
+# 关着的时候每个埋点只是一次字符串判断；开着时取时间用 bash 5 的 EPOCHREALTIME，不 fork，
+# 写一行是一次 printf >>，所以可以一直开着，多次运行追加到同一个文件，按 run 区分。
+# bash 拿不到单调时钟（要 fork 外部命令），这里的时间是墙上时间，微秒精度；bash 3.2 没有 EPOCHREALTIME，只有秒
+
+TRACE_FILE=""
+TRACE_NOW=0
+TRACE_NAMES=()
+TRACE_STARTS=()
+TRACE_FIELDS=""
+TRACE_OFFSET=0  # 打开追踪时文件的大小，汇总只读这之后的
+
+# curl -w 的格式，输出一段 JSON 字段（不带花括号）
+TRACE_CURL_FORMAT='"status":"%{http_code}","url":"%{url_effective}","dns_s":%{time_namelookup},"connect_s":%{time_connect},"tls_s":%{time_appconnect},"ttfb_s":%{time_starttransfer},"total_s":%{time_total},"up_bytes":%{size_upload},"down_bytes":%{size_download}'
+
+# 当前时间（微秒）写进 TRACE_NOW，不走命令替换
+trace_now() {
+    if [ -n "${EPOCHREALTIME:-}" ]; then
+        local t="${EPOCHREALTIME//[!0-9]/}"
+        TRACE_NOW=$((10#$t))
+    elif [ -n "$TRACE_FILE" ]; then
+        TRACE_NOW=$(( $(date +%s) * 1000000 ))
+    fi
+}
+
+trace_now
+TRACE_T0=$TRACE_NOW
+
+# 打开追踪，startup span 从加载本文件算到现在
+trace_enable() {
+    [ -z "$TRACE_FILE" ] || return 0
+    TRACE_FILE="$1"
+    mkdir -p "$(dirname "$TRACE_FILE")"
+    [ -f "$TRACE_FILE" ] && TRACE_OFFSET=$(wc -c < "$TRACE_FILE" | tr -d ' ')
+    trace_now
+    [ "$TRACE_T0" -gt 0 ] || TRACE_T0=$TRACE_NOW
+    trace_emit startup "$TRACE_T0" "$TRACE_NOW"
+}
+
+# 附加字段 key=value... 转成 JSON 片段，写进 TRACE_FIELDS；数字原样，其余按字符串转义
+trace_fields() {
+    local kv key value
+    TRACE_FIELDS=""
+    for kv; do
+        key="${kv%%=*}"
+        value="${kv#*=}"
+        if ! [[ $value =~ ^-?[0-9]+(\.[0-9]+)?$ ]]; then
+            value="${value//\\/\\\\}"
+            value="${value//\"/\\\"}"
+            value="${value//$'\t'/\\t}"
+            value="\"${value//$'\n'/\\n}\""
+        fi
+        TRACE_FIELDS="$TRACE_FIELDS,\"$key\":$value"
+    done
+}
+
+# 写一个 span
+# 参数: 名字 开始时间 结束时间 [JSON 片段，不带花括号和开头的逗号]
+trace_emit() {
+    printf '{"run":%s,"pid":%s,"span":"%s","t_us":%s,"dur_us":%s%s}\n' \
+        "$TRACE_T0" "$$" "$1" $(($2 - TRACE_T0)) $(($3 - $2)) "${4:+,$4}" >> "$TRACE_FILE"
+}
+
+trace_begin() {
+    [ -n "$TRACE_FILE" ] || return 0
+    trace_now
+    TRACE_NAMES+=("$1")
+    TRACE_STARTS+=("$TRACE_NOW")
+}
+
+# 结束最近一个 trace_begin 的 span
+# 参数: [curl -w 输出的 JSON 片段] [key=value...]，片段可以为空
+trace_end_raw() {
+    [ -n "$TRACE_FILE" ] || return 0
+    local n=$((${#TRACE_NAMES[@]} - 1))
+    [ "$n" -ge 0 ] || return 0
+    local raw="$1"
+    shift
+    trace_now
+    trace_fields "$@"
+    TRACE_FIELDS="${TRACE_FIELDS#,}"
+    [ -n "$raw" ] && TRACE_FIELDS="$raw${TRACE_FIELDS:+,$TRACE_FIELDS}"
+    trace_emit "${TRACE_NAMES[$n]}" "${TRACE_STARTS[$n]}" "$TRACE_NOW" "$TRACE_FIELDS"
+    unset "TRACE_NAMES[$n]" "TRACE_STARTS[$n]"
+}
+
+# 参数: [key=value...]
+trace_end() {
+    [ -n "$TRACE_FILE" ] || return 0
+    trace_end_raw "" "$@"
+}
+
+# 从 curl 的输出里取出 TRACE_CURL_FORMAT 写的行，每行一个 http span
+# 行的格式是 标识<TAB>...<TAB>JSON 片段（最后一列）；并发请求各自的开始时间拿不到，都记成这一批的开始时间
+# 参数: 文件 开始时间
+trace_curl_spans() {
+    [ -n "$TRACE_FILE" ] || return 0
+    awk -F'\t' -v run="$TRACE_T0" -v pid="$$" -v t="$(($2 - TRACE_T0))" '
+        $NF ~ /^"status":/ {
+            total = 0
+            if (match($NF, /"total_s":[0-9.]+/)) total = substr($NF, RSTART + 10, RLENGTH - 10)
+            key = $1; gsub(/["\\]/, "", key)
+            printf "{\"run\":%s,\"pid\":%s,\"span\":\"http\",\"t_us\":%d,\"dur_us\":%d,\"key\":\"%s\",%s}\n",
+                run, pid, t, total * 1000000, key, $NF
+        }' "$1" >> "$TRACE_FILE"
+}
+
+# 同 tee，追踪时把 stdin 第一个字符到达的时间记成 ttft，之后到结束记成 stream
+# 参数: 文件 请求发出的时间
+trace_tee() {
+    local file="$1"
+    local sent_at="$2"
+
+    if [ -z "$TRACE_FILE" ]; then
+        tee "$file"
+        return
+    fi
+
+    local c first
+    if IFS= read -r -n 1 -d '' c; then
+        trace_now
+        first=$TRACE_NOW
+        trace_emit ttft "$sent_at" "$first"
+        { printf '%s' "$c"; cat; } | tee "$file"
+        trace_now
+        trace_emit stream "$first" "$TRACE_NOW"
+    else
+        : > "$file"
+    fi
+}
+
+# 退出时写 total 并打印本次运行的汇总
+trace_finish() {
+    [ -n "$TRACE_FILE" ] || return 0
+    trace_now
+    trace_emit total "$TRACE_T0" "$TRACE_NOW"
+    [ "$LOG_ENABLE" = true ] && [ "$LOG_INFO" = true ] || return 0
+
+    tail -c +$((TRACE_OFFSET + 1)) "$TRACE_FILE" |
+    awk -v run="\"run\":$TRACE_T0," -v file="$TRACE_FILE" '
+        function num(line, key) {
+            if (!match(line, "\"" key "\":[0-9.]+")) return 0
+            return substr(line, RSTART + length(key) + 3, RLENGTH - length(key) - 3) + 0
+        }
+        index($0, run) == 0 { next }
+        {
+            if (!match($0, /"span":"[^"]*"/)) next
+            s = substr($0, RSTART + 8, RLENGTH - 9)
+            if (!(s in count)) order[++n] = s
+            d = num($0, "dur_us") / 1000
+            count[s]++; total[s] += d
+            if (d > max[s]) max[s] = d
+            up[s] += num($0, "up_bytes"); down[s] += num($0, "down_bytes")
+            if (s == "http") {
+                dns += num($0, "dns_s"); conn += num($0, "connect_s")
+                tls += num($0, "tls_s"); ttfb += num($0, "ttfb_s")
+            }
+        }
+        END {
+            if (n == 0) exit
+            printf "\n⏱  性能追踪（%s）\n", file
+            printf "%-14s %6s %12s %10s %10s %12s %12s\n", "span", "count", "total_ms", "avg_ms", "max_ms", "up_bytes", "down_bytes"
+            for (i = 1; i <= n; i++) {
+                s = order[i]
+                printf "%-14s %6d %12.1f %10.1f %10.1f %12.0f %12.0f\n", s, count[s], total[s], total[s] / count[s], max[s], up[s], down[s]
+            }
+            if (count["http"] > 0) {
+                c = count["http"]
+                printf "http 平均（从请求开始累计，ms）: dns %.1f  connect %.1f  tls %.1f  ttfb %.1f\n",
+                    dns * 1000 / c, conn * 1000 / c, tls * 1000 / c, ttfb * 1000 / c
+            }
+        }' >&2
+}
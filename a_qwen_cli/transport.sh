@@ -0,0 +1,231 @@
+#!/bin/bash
+
+# 批量请求的传输层
+# 一个 curl 进程跑完一整批请求：同一主机的请求复用同一个 keep-alive 连接，
+# curl 支持 --parallel 时并发发送，HTTP/2 下在一个连接上多路复用。
+# 每个请求的响应体单独存一个文件，调用方照旧逐个解析。
+#
+# 用法：
+#   local batch=$(transport_begin)
+#   transport_add "$batch" 0 DELETE "$API_BASE_URL/files/$id"
+#   transport_add "$batch" 1 POST "$API_BASE_URL/files" "file=@$path" "purpose=file-extract"
+#   transport_add_json "$batch" 2 POST "$API_BASE_URL/batches" "$body_file"
+#   transport_run "$batch" 8
+#   transport_status "$batch" 0      # HTTP 状态码，000 表示没连上
+#   transport_body "$batch" 1        # 响应体文件路径
+#   transport_end "$batch"
+
+# curl 是否支持 --parallel（7.66+），只检测一次
+# 并发模式下 -s 关不掉汇总进度条，支持的话再加 --no-progress-meter（7.67+）
+TRANSPORT_PARALLEL=""
+TRANSPORT_PARALLEL_ARGS=()
+transport_can_parallel() {
+    if [ -z "$TRANSPORT_PARALLEL" ]; then
+        local curl_help=$(curl --help all 2>/dev/null)
+        if grep -q -- '--parallel-max' <<< "$curl_help"; then
+            TRANSPORT_PARALLEL=yes
+            TRANSPORT_PARALLEL_ARGS=(--parallel --parallel-immediate)
+            if grep -q -- '--no-progress-meter' <<< "$curl_help"; then
+                TRANSPORT_PARALLEL_ARGS+=(--no-progress-meter)
+            fi
+        else
+            TRANSPORT_PARALLEL=no
+        fi
+    fi
+    [ "$TRANSPORT_PARALLEL" = yes ]
+}
+
+# curl 配置文件里的字符串要加引号并转义，结果写进第二个参数指定的变量（不 fork）
+transport_quote() {
+    local value="$1"
+    value="${value//\\/\\\\}"
+    value="${value//\"/\\\"}"
+    printf -v "$2" '"%s"' "$value"
+}
+
+# 新建一批请求，输出批次目录（mktemp -d 建的目录只有自己能读，配置里的 API key 不会泄露）
+transport_begin() {
+    local batch_dir=$(mktemp -d "${TMPDIR:-/tmp}/qwen_transport.XXXXXX")
+    : > "$batch_dir/keys"
+    echo "$batch_dir"
+}
+
+# 往批次里加一个请求，每个请求单独一段 curl 配置，重试时只重发失败的那几段
+# 参数: 批次目录 key 方法 url [form 字段...]
+# 设了 TRANSPORT_NO_AUTH 时不带 DashScope 的 Authorization 头（比如直传 OSS）
+transport_add() {
+    local batch_dir="$1"
+    local key="$2"
+    local method="$3"
+    local url="$4"
+    shift 4
+
+    local q_url q_method q_auth q_output q_headers q_format q_field
+    transport_quote "$url" q_url
+    transport_quote "$method" q_method
+    transport_quote "Authorization: Bearer $DASHSCOPE_API_KEY" q_auth
+    transport_quote "$batch_dir/$key.body" q_output
+    transport_quote "$batch_dir/$key.headers" q_headers
+    # 追踪时状态码后面再带上分段耗时（trace.sh），取状态码的只看第二列
+    if [ -n "$TRACE_FILE" ]; then
+        transport_quote "$key\\t%{http_code}\\t$TRACE_CURL_FORMAT\\n" q_format
+    else
+        transport_quote "$key\\t%{http_code}\\n" q_format
+    fi
+    {
+        echo "url = $q_url"
+        echo "request = $q_method"
+        [ -n "${TRANSPORT_NO_AUTH:-}" ] || echo "header = $q_auth"
+        echo "output = $q_output"
+        echo "dump-header = $q_headers"
+        echo "write-out = $q_format"
+        echo "max-time = ${TRANSPORT_MAX_TIME:-300}"
+        local field
+        for field in "$@"; do
+            transport_quote "$field" q_field
+            echo "form = $q_field"
+        done
+    } > "$batch_dir/$key.conf"
+    echo "$key" >> "$batch_dir/keys"
+}
+
+# 往批次里加一个 JSON 请求体的请求，请求体从文件读
+# 参数: 批次目录 key 方法 url 请求体文件
+transport_add_json() {
+    local batch_dir="$1"
+    local key="$2"
+    local method="$3"
+    local url="$4"
+    local body_file="$5"
+
+    transport_add "$batch_dir" "$key" "$method" "$url"
+    local q_data
+    transport_quote "@$body_file" q_data
+    {
+        echo 'header = "Content-Type: application/json"'
+        echo "data-binary = $q_data"
+    } >> "$batch_dir/$key.conf"
+}
+
+# 执行整批请求，走 request.sh 的限速、并发上限和重试规则
+# 限速打开时按 RATE_LIMIT_BURST 分段发，每段先从令牌桶拿够令牌；
+# 并发数取 最大并发 和 能拿到的全局 slot 数 中较小的；
+# 一轮跑完后，429、5xx、连不上的请求退避后单独重发，最多 MAX_RETRIES 轮
+# 参数: 批次目录 [最大并发]
+transport_run() {
+    local batch_dir="$1"
+    local parallel_max="${2:-1}"
+
+    [ -s "$batch_dir/keys" ] || return 0
+
+    local chunk_size=0
+    if [ "${RATE_LIMIT_RPS:-0}" -gt 0 ]; then
+        chunk_size="${RATE_LIMIT_BURST:-$RATE_LIMIT_RPS}"
+    fi
+
+    local -a keys=() files=() args=()
+    local key attempt=0 start n i slots delay retry_count requests=0
+    trace_begin transport
+    cp "$batch_dir/keys" "$batch_dir/pending"
+    : > "$batch_dir/status"
+    while true; do
+        keys=()
+        while IFS= read -r key; do
+            keys+=("$key")
+        done < "$batch_dir/pending"
+        [ "$attempt" -gt 0 ] || requests=${#keys[@]}
+
+        debug "transport: ${#keys[@]} 个请求，并发 $parallel_max"
+        start=0
+        while [ "$start" -lt "${#keys[@]}" ]; do
+            n=$(( ${#keys[@]} - start ))
+            [ "$chunk_size" -gt 0 ] && [ "$n" -gt "$chunk_size" ] && n=$chunk_size
+
+            files=()
+            for ((i = start; i < start + n; i++)); do
+                files+=("$batch_dir/${keys[$i]}.conf")
+            done
+            awk 'FNR == 1 && NR > 1 { print "next" } { print }' "${files[@]}" > "$batch_dir/run.conf"
+
+            rate_limit_acquire "$n"
+            slots=$parallel_max
+            [ "$slots" -gt "$n" ] && slots=$n
+            request_slots_acquire "$slots"
+            [ "${#REQUEST_SLOTS[@]}" -gt 0 ] && slots=${#REQUEST_SLOTS[@]}
+
+            args=(-sS -K "$batch_dir/run.conf")
+            if [ "$slots" -gt 1 ] && transport_can_parallel; then
+                args+=("${TRANSPORT_PARALLEL_ARGS[@]}" --parallel-max "$slots")
+            fi
+            if [ -n "$TRACE_FILE" ]; then
+                trace_now
+                local sent_at=$TRACE_NOW
+                curl "${args[@]}" > "$batch_dir/out" 2>> "$batch_dir/curl_error.log" || true
+                cat "$batch_dir/out" >> "$batch_dir/status"
+                trace_curl_spans "$batch_dir/out" "$sent_at"
+            else
+                curl "${args[@]}" >> "$batch_dir/status" 2>> "$batch_dir/curl_error.log" || true
+            fi
+            request_slots_release
+
+            start=$((start + n))
+        done
+
+        # 每个请求取最后一次的状态，该重试的留下
+        awk -F'\t' '
+            FILENAME == ARGV[1] { code[$1] = $2; next }
+            {
+                c = ($0 in code) ? code[$0] : "000"
+                if (c == "000" || c == "429" || c == "500" || c == "502" || c == "503" || c == "504") print $0 "\t" c
+            }' "$batch_dir/status" "$batch_dir/pending" > "$batch_dir/retry"
+
+        retry_count=$(wc -l < "$batch_dir/retry" | tr -d ' ')
+        [ "$retry_count" -gt 0 ] || break
+        [ "$attempt" -lt "${MAX_RETRIES:-0}" ] || break
+
+        # 等最久的那个 Retry-After；有 429 就让整个令牌桶暂停
+        delay=0
+        local d code has_429=""
+        while IFS=$'\t' read -r key code; do
+            d=$(retry_delay_ms "$attempt" "$batch_dir/$key.headers")
+            [ "$d" -gt "$delay" ] && delay=$d
+            [ "$code" = 429 ] && has_429=1
+        done < "$batch_dir/retry"
+        [ -n "$has_429" ] && rate_limit_penalize "$delay"
+
+        attempt=$((attempt + 1))
+        warn "$retry_count 个请求失败，${delay}ms 后第 $attempt 次重试"
+        sleep_ms "$delay"
+        cut -f1 "$batch_dir/retry" > "$batch_dir/pending"
+    done
+    trace_end requests="$requests" retries="$attempt"
+}
+
+# 某个请求的 HTTP 状态码
+transport_status() {
+    local batch_dir="$1"
+    local key="$2"
+    local status=$(awk -F'\t' -v key="$key" '$1 == key { code = $2 } END { print code }' "$batch_dir/status" 2>/dev/null)
+    echo "${status:-000}"
+}
+
+# 全部状态，每行: key<TAB>状态码，按加入的顺序，重试过的取最后一次
+transport_statuses() {
+    local batch_dir="$1"
+    awk -F'\t' '
+        FILENAME == ARGV[1] { code[$1] = $2; next }
+        { print $0 "\t" (($0 in code) ? code[$0] : "000") }
+    ' "$batch_dir/status" "$batch_dir/keys" 2>/dev/null || true
+}
+
+# 某个请求的响应体文件
+transport_body() {
+    local batch_dir="$1"
+    local key="$2"
+    echo "$batch_dir/$key.body"
+}
+
+transport_end() {
+    local batch_dir="$1"
+    [ -n "$batch_dir" ] && rm -rf "$batch_dir"
+}
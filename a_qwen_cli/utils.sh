@@ -9,6 +9,25 @@ validate_json() {
     return $?
 }
 
+# 当前时间戳，bash 4.2+ 不需要 fork date
+now_epoch() {
+    local now
+    if printf -v now '%(%s)T' -1 2>/dev/null && [ -n "$now" ]; then
+        echo "$now"
+    else
+        date +%s
+    fi
+}
+
+# config.json 里按模型名前缀取配置项，最长的匹配生效，例如 qwen-turbo-latest 会用到 qwen-turbo 的项
+# 用法: $config | model_pick($model; "exts")，没有时为 null
+MODEL_PICK_JQ_DEF='
+def model_pick($model; $k):
+    [to_entries[]
+     | select((.value | type) == "object" and .value[$k] != null and (.key as $key | $model | startswith($key)))]
+    | max_by(.key | length) | .value[$k] // null;
+'
+
 # 依赖检查
 check_dependencies() {
     for cmd in curl jq; do
@@ -185,7 +204,7 @@ find_with_exts() {
     #echo "Running: find ${find_args[*]}"
     #FIND="/usr/bin/find"
     # 安全执行 find
-    find "${find_args[@]}" | jq -Rs 'split("\u0000")[:-1]'
+    find "${find_args[@]}" | jq -Rs 'split("\u0000") | map(select(length > 0))'
   else
     error "❌ 未提供有效的扩展名"
   fi  
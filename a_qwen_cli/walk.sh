@@ -0,0 +1,187 @@
+#!/bin/bash
+
+# 目录遍历：把目录参数展开成要发给模型的文件清单
+# - 一个 find 走完整棵树，结果逐行流给一个 awk 过滤，不会每个文件起一次 jq，十万个文件也只是几秒
+# - 隐藏文件和隐藏目录（.git 之类）不进去
+# - 忽略规则写在 .qwenignore 里，写法同 .gitignore：# 注释、! 取反、结尾 / 只匹配目录、
+#   开头或中间有 / 的相对 .qwenignore 所在目录、* ? [] ** 通配。
+#   目录树里任何一层都可以放，管它所在的目录；脚本目录下的 .qwenignore 对所有目录生效
+# - 超过大小上限的文件跳过（qwen-long 单个文件最大 150M）
+# - 扩展名按模型取，config.json 里模型下的 "exts" 优先，没有就用 LONG_FILE_EXTS
+# walk_dir 输出以 \0 分隔的路径，expand_file_refs 再合成 JSON 数组；跳过了多少个写到 stderr
+
+QWEN_IGNORE_NAME=".qwenignore"
+
+# 模型的遍历配置：扩展名列表<TAB>单个文件大小上限
+# config.json 里按模型名前缀找（model_pick），例如 qwen-turbo-latest 会用到 qwen-turbo 的 exts
+model_walk_config() {
+    local model="$1"
+
+    local config="${MODEL_CONFIG:-}"
+    [ -n "$config" ] || config='{}'
+
+    jq -r --arg model "$model" \
+        --arg exts "$LONG_FILE_EXTS" \
+        --arg max "$MAX_FILE_BYTES" "$MODEL_PICK_JQ_DEF"'
+        [ (model_pick($model; "exts") | if . == null then $exts else join(" ") end),
+          (model_pick($model; "max_file_bytes") // $max | tostring) ] | @tsv
+    ' <<< "$config"
+}
+
+# .qwenignore 转成规则，每行: 所在目录<TAB>取反<TAB>只匹配目录<TAB>是否带路径<TAB>正则
+# 规则文件从 stdin 读，每行 "所在目录<TAB>规则文件"
+walk_ignore_rules() {
+    local base file
+    while IFS=$'\t' read -r base file; do
+        awk -v base="$base" -v OFS='\t' '
+            function glob2re(p,   re, i, j, c, n) {
+                re = ""
+                n = length(p)
+                for (i = 1; i <= n; i++) {
+                    c = substr(p, i, 1)
+                    if (c == "*") {
+                        if (substr(p, i + 1, 1) == "*") {
+                            # **/ 匹配零层或多层目录，其余的 ** 匹配任意字符
+                            if (substr(p, i + 2, 1) == "/") { re = re "(.*/)?"; i += 2 }
+                            else { re = re ".*"; i++ }
+                        } else re = re "[^/]*"
+                    } else if (c == "?") re = re "[^/]"
+                    else if (c == "[") {
+                        j = index(substr(p, i), "]")
+                        if (j > 2) {
+                            # [!abc] 是 glob 的取反写法
+                            c = substr(p, i + 1, j - 2)
+                            if (substr(c, 1, 1) == "!") c = "^" substr(c, 2)
+                            re = re "[" c "]"
+                            i += j - 1
+                        }
+                        else re = re "\\["
+                    } else if (c == "\\" && i < n) { i++; re = re "\\" substr(p, i, 1) }
+                    else if (index(".+()^$|{}", c)) re = re "\\" c
+                    else re = re c
+                }
+                return "^" re "$"
+            }
+            {
+                sub(/\r$/, "")
+                sub(/[ \t]+$/, "")
+                if ($0 == "" || substr($0, 1, 1) == "#") next
+                p = $0
+                neg = 0
+                if (substr(p, 1, 1) == "!") { neg = 1; p = substr(p, 2) }
+                else if (substr(p, 1, 2) == "\\!" || substr(p, 1, 2) == "\\#") p = substr(p, 2)
+                dironly = 0
+                if (substr(p, length(p), 1) == "/") { dironly = 1; p = substr(p, 1, length(p) - 1) }
+                anchored = (index(p, "/") > 0)
+                if (substr(p, 1, 1) == "/") p = substr(p, 2)
+                if (p == "") next
+                print base, neg, dironly, anchored, glob2re(p)
+            }' "$file"
+    done
+}
+
+# 展开一个目录
+# 参数: 目录 单个文件大小上限(字节，0 不限) 扩展名...
+walk_dir() {
+    local dir="$1"
+    local max_bytes="$2"
+    shift 2
+
+    if [ $# -eq 0 ]; then
+        error "❌ 未提供有效的扩展名"
+        return 1
+    fi
+    [ "$dir" != / ] && dir="${dir%/}"
+
+    local ext
+    local -a ext_conds=()
+    for ext; do
+        [ ${#ext_conds[@]} -gt 0 ] && ext_conds+=(-o)
+        ext_conds+=(-iname "*.$ext")
+    done
+
+    local nl=$'\n'
+    local work_dir=$(mktemp -d "${TMPDIR:-/tmp}/qwen_walk.XXXXXX")
+
+    # 忽略规则：脚本目录下的对整个目录生效，目录树里的管各自所在的目录；浅的在前，深的可以覆盖
+    {
+        [ -f "$SCRIPT_DIR/$QWEN_IGNORE_NAME" ] && printf '%s\t%s\n' "$dir" "$SCRIPT_DIR/$QWEN_IGNORE_NAME"
+        find "$dir" -mindepth 1 \( -type d -name '.*' -prune \) -o \( -name "*$nl*" -prune \) -o \
+            \( -type f -name "$QWEN_IGNORE_NAME" -print \) 2>/dev/null |
+            awk '{ d = $0; sub(/\/[^\/]*$/, "", d); print gsub(/\//, "/", d) "\t" d "\t" $0 }' |
+            sort -n -s -k1,1 | cut -f2-
+    } | walk_ignore_rules > "$work_dir/rules"
+
+    # 隐藏目录和带换行的路径直接剪掉；超过大小上限的文件前面加 \x1f 标记，由 awk 计数后丢掉
+    local -a size_action=(-print)
+    if [ "${max_bytes:-0}" -gt 0 ]; then
+        size_action=( \( -size +"${max_bytes}"c -exec printf '\037%s\n' {} + \) -o -print )
+    fi
+    find "$dir" -mindepth 1 \( -type d -name '.*' -prune \) -o \
+        \( -name "*$nl*" -prune \) -o \
+        \( -type f ! -name '.*' \( "${ext_conds[@]}" \) \( "${size_action[@]}" \) \) 2>/dev/null |
+    awk -F'\t' -v stats="$work_dir/stats" -v root="$dir" '
+        FILENAME == ARGV[1] {
+            n++; base[n] = $1; neg[n] = $2; dironly[n] = $3; anchored[n] = $4; re[n] = $5
+            next
+        }
+        # 最后一条匹配的规则说了算，返回 1 忽略 / 0 保留 / -1 没有规则匹配
+        function decide(path, isdir,   i, rel, name, r) {
+            r = -1
+            name = path; sub(/.*\//, "", name)
+            for (i = 1; i <= n; i++) {
+                if (substr(path, 1, length(base[i]) + 1) != base[i] "/") continue
+                if (dironly[i] && !isdir) continue
+                rel = anchored[i] ? substr(path, length(base[i]) + 2) : name
+                if (rel ~ re[i]) r = neg[i] ? 0 : 1
+            }
+            return r
+        }
+        # 目录是否被忽略，每个目录只算一次；上层目录被忽略的，下面的都忽略
+        function dir_ignored(d,   parent) {
+            if (d in dcache) return dcache[d]
+            parent = d; sub(/\/[^\/]*$/, "", parent)
+            if (parent == d || parent == "" || length(d) <= length(root)) return dcache[d] = 0
+            if (dir_ignored(parent)) return dcache[d] = 1
+            return dcache[d] = (decide(d, 1) == 1)
+        }
+        /^\037/ { big++; next }
+        {
+            if (n > 0) {
+                d = $0; sub(/\/[^\/]*$/, "", d)
+                if ((d != $0 && dir_ignored(d)) || decide($0, 0) == 1) { ignored++; next }
+            }
+            print
+        }
+        END { print ignored + 0, big + 0 > stats }
+    ' "$work_dir/rules" - | tr '\n' '\0'
+
+    local ignored=0 big=0
+    [ -f "$work_dir/stats" ] && read -r ignored big < "$work_dir/stats"
+    [ "$ignored" -gt 0 ] && info "$dir: 按 $QWEN_IGNORE_NAME 忽略了 $ignored 个文件"
+    [ "$big" -gt 0 ] && warn "$dir: $big 个文件超过 $max_bytes 字节，已跳过"
+    rm -rf "$work_dir"
+    return 0
+}
+
+# 把文件和目录参数展开成文件清单
+# 参数: 模型，引用（文件或目录）以 \0 分隔从 stdin 读入
+# 输出 JSON 数组，同一路径只留第一次出现的
+expand_file_refs() {
+    local model="$1"
+
+    local exts max_bytes ref
+    IFS=$'\t' read -r exts max_bytes < <(model_walk_config "$model")
+    debug "$model 读目录时收的扩展名: $exts，大小上限: $max_bytes"
+
+    while IFS= read -r -d '' ref; do
+        if [ -d "$ref" ]; then
+            walk_dir "$ref" "$max_bytes" $exts
+        else
+            # 不存在的文件也留着，由 upload_files 报错
+            printf '%s\0' "$ref"
+        fi
+    done | jq -c -R -s '
+        split("\u0000") | map(select(length > 0))
+        | to_entries | group_by(.value) | map(.[0]) | sort_by(.key) | map(.value)'
+}
@@ -1,17 +1,24 @@
+import time
+STARTUP_T0 = time.perf_counter()  # 启动计时的起点
 import os
+import re
 import sys
 import json
-import subprocess
+import codecs
+import signal
 import base64
-import markdown
+# markdown 只有帮助和预览用得到，用到时才导入
 
 from PySide6.QtWidgets import (QApplication, QMainWindow, QVBoxLayout, QHBoxLayout, 
                                QWidget, QTabWidget, QPushButton, QLineEdit, QComboBox,
                                QTextEdit, QLabel, QFrame, QScrollArea, QGridLayout,
                                QDialog, QDialogButtonBox, QMessageBox, QFileDialog,
-                               QSplitter)
-from PySide6.QtCore import Qt, Signal, QProcess, QThread
-from PySide6.QtGui import QFont, QTextCursor
+                               QSplitter, QPlainTextEdit, QTextBrowser, QSpinBox, QTableWidget,
+                               QTableWidgetItem, QAbstractItemView, QHeaderView)
+from PySide6.QtCore import (Qt, Signal, QProcess, QThread, QObject, QTimer, QElapsedTimer, QUrl,
+                            QItemSelectionModel)
+from PySide6.QtGui import (QFont, QTextCursor, QDesktopServices, QTextBlockFormat, QTextCharFormat,
+                           QColor)
 import pathlib
 
 # 默认模型选项
@@ -29,9 +36,71 @@ DEFAULT_ROW_TYPES = ["开关", "开关", "文件", "目录", "文本"]
 # 配置文件路径
 CONFIG_FILE = "helper_gui.json"
 
+# 输出控制台
+CONSOLE_MAX_LINES = 5000         # 控制台最多保留的行数，更早的只在日志文件里
+CONSOLE_FLUSH_MS = 50            # 输出先攒着，最多这么久刷新一次界面
+RUN_LOG_DIR = "helper_gui_logs"  # 每次执行的完整输出
+RUN_LOG_KEEP = 200               # 日志文件最多留多少个，多了删最旧的
+
+# 任务队列
+JOB_MAX_CONCURRENT = 2    # 默认最多同时运行几条命令，任务窗口里可以改，随配置保存
+JOB_HISTORY_KEEP = 200    # 已结束的任务最多留多少条
+JOB_KILL_GRACE_MS = 3000  # 停止时先发 SIGTERM 让脚本清理临时文件，过了这么久还没退出就 SIGKILL
+
+JOB_QUEUED = "排队中"
+JOB_RUNNING = "运行中"
+JOB_DONE = "完成"
+JOB_FAILED = "失败"
+JOB_STOPPED = "已停止"
+JOB_CANCELED = "已取消"
+
+# 选好文件、目录后在后台预取（qwen --prefetch），点执行时 hash 已经算好，文件也可以先传好
+PREFETCH_DELAY_MS = 800  # 路径改完停这么久才开始，边打字边改时不会一直重跑
+
+# 终端颜色等控制序列，控制台里不显示
+ANSI_ESCAPE_RE = re.compile(r'\x1b\[[0-9;?]*[A-Za-z]')
+
+# markdown 实时预览
+PREVIEW_SPLIT_LINES = 40  # 没有空行的长块（比如很长的列表、表格）超过这么多行，就在下一个条目、标题或表格行处切开
+PREVIEW_PLAIN_CHARS = 8000  # 还没结束的块超过这么多字（比如没有换行的长段落），结束前先按纯文本显示
+PREVIEW_FENCE_RE = re.compile(r'^ {0,3}(`{3,}|~{3,})')
+PREVIEW_BLOCK_START_RE = re.compile(r'^ {0,3}([-*+] |(\d+)[.)] |#{1,6} |>)')
+PREVIEW_TABLE_DELIM_RE = re.compile(r'^ {0,3}\|?\s*:?-+:?\s*(\|\s*:?-+:?\s*)*\|?\s*$')
+
+# 启动计时，带 --profile 运行时在 stderr 打印各阶段用时，之后打开 tab 时也打印构建用时
+STARTUP_PROFILE = "--profile" in sys.argv
+startup_marks = []  # (阶段, 结束时间)
+startup_reported = False
+
+
+def startup_mark(name, started=None):
+    """记下一个阶段结束；启动报告已经打印过的，直接打印这一步从 started 算起的用时"""
+    if not STARTUP_PROFILE:
+        return
+    now = time.perf_counter()
+    if startup_reported:
+        print(f"⏱ {name}: {(now - (started or now)) * 1000:.1f} ms", file=sys.stderr)
+    else:
+        startup_marks.append((name, now))
+
+
+def startup_report():
+    global startup_reported
+    startup_mark("进入事件循环")
+    startup_reported = True
+    print("⏱ 启动用时（本阶段 / 累计）:", file=sys.stderr)
+    last = STARTUP_T0
+    for name, t in startup_marks:
+        print(f"  {(t - last) * 1000:8.1f} ms {(t - STARTUP_T0) * 1000:8.1f} ms  {name}", file=sys.stderr)
+        last = t
+
+
+startup_mark("导入模块")
+
 
 class ParamRow(QWidget):
     row_changed = Signal()
+    value_changed = Signal()  # key 或值改了
 
     def __init__(self, app, index):
         super().__init__()
@@ -55,6 +124,7 @@ class ParamRow(QWidget):
         # Key 输入框
         self.key_entry = QLineEdit()
         self.key_entry.setMaximumWidth(100)
+        self.key_entry.textChanged.connect(self.value_changed)
         layout.addWidget(self.key_entry)
 
         # 值区域容器
@@ -67,6 +137,7 @@ class ParamRow(QWidget):
         self.value_combo = QComboBox()
         self.value_combo.setMinimumWidth(300)
         self.value_combo.setEditable(True)  # 允许编辑
+        self.value_combo.editTextChanged.connect(self.value_changed)
 
         # 多行值输入框（用于文本）
         self.value_text = QTextEdit()
@@ -185,14 +256,630 @@ class ParamRow(QWidget):
         self.on_type_change()
 
 
+def format_bytes(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def run_log_path(tab_name, job_id):
+    """建好这次执行的日志文件并返回路径，顺便清理太旧的日志
+
+    文件名带任务编号，同一秒启动的任务、同时开着的几个界面也不会写进同一个文件；
+    用 'xb' 独占创建，万一还是重名就加序号再试
+    """
+    os.makedirs(RUN_LOG_DIR, exist_ok=True)
+    logs = sorted(f for f in os.listdir(RUN_LOG_DIR) if f.endswith(".log"))
+    for name in logs[:max(0, len(logs) - RUN_LOG_KEEP + 1)]:
+        try:
+            os.remove(os.path.join(RUN_LOG_DIR, name))
+        except OSError:
+            pass
+    safe_name = re.sub(r'[\\/:*?"<>|\s]+', '_', tab_name)
+    base = os.path.join(RUN_LOG_DIR, f"{time.strftime('%Y%m%d_%H%M%S')}_{job_id}_{safe_name}")
+    suffix = 0
+    while True:
+        path = f"{base}.log" if suffix == 0 else f"{base}_{suffix}.log"
+        try:
+            with open(path, 'xb'):
+                return path
+        except FileExistsError:
+            suffix += 1
+
+
+class CommandRunner(QObject):
+    """用 QProcess 执行一条命令，输出按块解码后发出，同时原样写进日志文件"""
+    output = Signal(str, bool)  # 文本, 是否来自 stderr
+    finished = Signal(int)      # 退出码，没启动成功或被杀掉时为 -1
+
+    def __init__(self, command, work_dir, log_path, parent=None):
+        super().__init__(parent)
+        self.command = command
+        self.work_dir = work_dir
+        self.log_path = log_path
+        self.log_file = None
+        self.own_group = False
+        self.elapsed = QElapsedTimer()
+        # 一个多字节字符可能被拆在两块里，每个通道一个增量解码器
+        self.decoders = {
+            False: codecs.getincrementaldecoder('utf-8')('replace'),
+            True: codecs.getincrementaldecoder('utf-8')('replace'),
+        }
+        self.process = QProcess(self)
+        self.process.readyReadStandardOutput.connect(lambda: self.read_channel(False))
+        self.process.readyReadStandardError.connect(lambda: self.read_channel(True))
+        self.process.finished.connect(self.on_finished)
+        self.process.errorOccurred.connect(self.on_error)
+
+    def start(self):
+        self.log_file = open(self.log_path, 'ab')
+        header = ""
+        if self.work_dir:
+            header += f'> cd "{self.work_dir}"\n'
+            self.process.setWorkingDirectory(os.path.abspath(self.work_dir))
+        header += f'> {self.command}\n'
+        self.log_file.write(header.encode('utf-8'))
+        # 命令回显算在 stderr 一边，不混进回答
+        self.output.emit(header, True)
+
+        if sys.platform == "win32":
+            self.process.setProgram("cmd.exe")
+            self.process.setNativeArguments(f'/c "{self.command}"')
+        else:
+            self.process.setProgram("/bin/sh")
+            self.process.setArguments(["-c", self.command])
+            # 命令放进自己的会话（进程组），停止时连同 bash、curl 等子进程一起结束
+            if hasattr(self.process, "setUnixProcessParameters"):
+                self.process.setUnixProcessParameters(QProcess.UnixProcessFlag.CreateNewSession)
+                self.own_group = True
+        self.elapsed.start()
+        self.process.start()
+        # 没有交互输入，stdin 直接给 EOF
+        self.process.closeWriteChannel()
+
+    def is_running(self):
+        return self.process.state() != QProcess.ProcessState.NotRunning
+
+    def kill(self, force=False):
+        """结束命令和它启动的子进程，force 时不等脚本清理"""
+        if not self.is_running():
+            return
+        pid = self.process.processId()
+        if sys.platform == "win32":
+            if QProcess.execute("taskkill", ["/T", "/F", "/PID", str(pid)]) != 0:
+                self.process.kill()
+        elif self.own_group and pid > 0:
+            if force:
+                self.kill_group(signal.SIGKILL)
+            else:
+                self.kill_group(signal.SIGTERM)
+                QTimer.singleShot(JOB_KILL_GRACE_MS, self, lambda: self.kill(force=True))
+        else:
+            self.process.kill()
+
+    def kill_group(self, sig):
+        try:
+            os.killpg(self.process.processId(), sig)
+        except OSError:
+            self.process.kill()
+
+    def read_channel(self, is_err):
+        data = bytes(self.process.readAllStandardError() if is_err else self.process.readAllStandardOutput())
+        if not data:
+            return
+        if self.log_file:
+            self.log_file.write(data)
+        text = self.decoders[is_err].decode(data)
+        if text:
+            self.output.emit(text, is_err)
+
+    def on_finished(self, exit_code, exit_status):
+        for is_err in (False, True):
+            self.read_channel(is_err)
+            tail = self.decoders[is_err].decode(b"", final=True)
+            if tail:
+                self.output.emit(tail, is_err)
+        if exit_status == QProcess.ExitStatus.CrashExit:
+            exit_code = -1
+        self.close_log()
+        self.finished.emit(exit_code)
+
+    def on_error(self, error):
+        # 其余错误之后还会有 finished，只有没启动成功的要自己收尾
+        if error != QProcess.ProcessError.FailedToStart:
+            return
+        message = f"无法启动命令：{self.process.errorString()}\n"
+        if self.log_file:
+            self.log_file.write(message.encode('utf-8'))
+        self.output.emit(message, True)
+        self.close_log()
+        self.finished.emit(-1)
+
+    def close_log(self):
+        if self.log_file:
+            self.log_file.close()
+            self.log_file = None
+
+    def elapsed_seconds(self):
+        return self.elapsed.elapsed() / 1000 if self.elapsed.isValid() else 0
+
+
+class OutputConsole(QWidget):
+    """命令输出控制台
+    输出先攒在内存里，定时合并成一次插入，模型快速吐字时界面也不会卡；
+    只保留最近 CONSOLE_MAX_LINES 行，完整输出在日志文件里"""
+    stop_requested = Signal()
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.pending = []
+        self.log_path = None
+        self.setup_ui()
+
+        self.flush_timer = QTimer(self)
+        self.flush_timer.setSingleShot(True)
+        self.flush_timer.setInterval(CONSOLE_FLUSH_MS)
+        self.flush_timer.timeout.connect(self.flush)
+
+    def setup_ui(self):
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.setSpacing(2)
+
+        toolbar = QHBoxLayout()
+        self.status_label = QLabel("输出:")
+        toolbar.addWidget(self.status_label)
+        toolbar.addStretch()
+
+        self.stop_btn = QPushButton("停止")
+        self.stop_btn.setEnabled(False)
+        self.stop_btn.clicked.connect(self.stop_requested)
+        toolbar.addWidget(self.stop_btn)
+
+        clear_btn = QPushButton("清空")
+        clear_btn.clicked.connect(self.clear)
+        toolbar.addWidget(clear_btn)
+
+        self.log_btn = QPushButton("完整日志")
+        self.log_btn.setEnabled(False)
+        self.log_btn.clicked.connect(self.open_log)
+        toolbar.addWidget(self.log_btn)
+        layout.addLayout(toolbar)
+
+        self.view = QPlainTextEdit()
+        self.view.setReadOnly(True)
+        self.view.setUndoRedoEnabled(False)
+        self.view.setMaximumBlockCount(CONSOLE_MAX_LINES)
+        self.view.setFont(QFont("Courier New", 10))
+        layout.addWidget(self.view)
+
+    def begin_run(self, log_path):
+        self.log_path = log_path
+        self.log_btn.setEnabled(True)
+        self.stop_btn.setEnabled(True)
+        self.status_label.setText("输出: 运行中…")
+        if self.view.document().characterCount() > 1:
+            self.append("\n", False)
+
+    def end_run(self, exit_code, seconds):
+        self.stop_btn.setEnabled(False)
+        self.append(f"\n[退出码 {exit_code}，用时 {seconds:.1f} 秒]\n", False)
+        self.flush()
+        self.status_label.setText(f"输出: 退出码 {exit_code}，用时 {seconds:.1f} 秒")
+
+    def set_status(self, text):
+        self.status_label.setText(text)
+
+    def set_stoppable(self, stoppable):
+        self.stop_btn.setEnabled(stoppable)
+
+    def append(self, text, is_err=False):
+        self.pending.append(text)
+        if not self.flush_timer.isActive():
+            self.flush_timer.start()
+
+    def flush(self):
+        self.flush_timer.stop()
+        if not self.pending:
+            return
+        text = ANSI_ESCAPE_RE.sub('', ''.join(self.pending).replace('\r\n', '\n'))
+        self.pending.clear()
+        # 一次来得太多时只插最后 CONSOLE_MAX_LINES 行，多的插进去也会马上被挤掉
+        if text.count('\n') > CONSOLE_MAX_LINES:
+            text = '\n'.join(text.rsplit('\n', CONSOLE_MAX_LINES)[1:])
+
+        # 用户往上翻着看的时候不跟着滚
+        bar = self.view.verticalScrollBar()
+        at_bottom = bar.value() >= bar.maximum() - 4
+        cursor = QTextCursor(self.view.document())
+        cursor.movePosition(QTextCursor.MoveOperation.End)
+        cursor.insertText(text)
+        if at_bottom:
+            bar.setValue(bar.maximum())
+
+    def clear(self):
+        self.pending.clear()
+        self.view.clear()
+
+    def open_log(self):
+        if self.log_path and os.path.exists(self.log_path):
+            QDesktopServices.openUrl(QUrl.fromLocalFile(os.path.abspath(self.log_path)))
+
+
+class MarkdownPreview(QTextBrowser):
+    """流式回答的 markdown 实时预览
+    已经结束的块（空行分隔的段落、代码块里完整的行）只转换一次，插进文档后不再改动，
+    每次刷新只删掉并重新转换最后那个还没结束的块；刷新不超过屏幕刷新率，看不见时不刷新。
+    回答再长，每次刷新的开销也只和最后一块的大小有关；长表格按行切开，每块重复表头，
+    太长的块结束前按纯文本追加显示，结束时才转换一次"""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setOpenExternalLinks(True)
+        self.md = None  # 第一次转换时才创建
+
+        self.code_block_format = QTextBlockFormat()
+        self.code_block_format.setBackground(QColor("#f2f2f2"))
+        self.code_char_format = QTextCharFormat()
+        self.code_char_format.setFontFamilies(["Courier New"])
+        self.code_char_format.setFontFixedPitch(True)
+
+        screen = QApplication.primaryScreen()
+        rate = screen.refreshRate() if screen else 0
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.setSingleShot(True)
+        self.refresh_timer.setInterval(max(8, int(1000 / (rate or 60))))
+        self.refresh_timer.timeout.connect(self.refresh)
+        self.reset()
+
+    def reset(self):
+        self.refresh_timer.stop()
+        self.clear()
+        self.pending = ""      # 收到了但还没切行的文本，最后一行可能不完整
+        self.block_lines = []  # 还没结束的块里的完整行
+        self.fence = None      # 在代码块里时是围栏标记
+        self.stable_end = 0    # 文档里定稿部分的结束位置，之后是尾巴
+        self.closing = False   # 输出已经结束，下次刷新把最后一块也定稿
+        self.reset_plain()
+
+    def reset_plain(self):
+        # 尾巴按纯文本显示时：plain_end 之前是已经显示的完整行，之后是 pending 的前 plain_pending 个字
+        self.plain_end = None
+        self.plain_lines = 0
+        self.plain_pending = 0
+
+    def append(self, text):
+        self.pending += ANSI_ESCAPE_RE.sub('', text)
+        if not self.refresh_timer.isActive():
+            self.refresh_timer.start()
+
+    def finish(self):
+        """输出结束，最后那块不会再有后续，按 markdown 定稿（之前可能按纯文本显示）"""
+        self.pending += '\n'
+        self.closing = True
+        if not self.refresh_timer.isActive():
+            self.refresh_timer.start()
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        if self.pending or self.block_lines or self.closing:
+            self.refresh_timer.start()
+
+    def refresh(self):
+        if not self.isVisible():
+            return
+        bar = self.verticalScrollBar()
+        at_bottom = bar.value() >= bar.maximum() - 4
+        if '\n' in self.pending:
+            done, self.pending = self.pending.rsplit('\n', 1)
+            for line in done.split('\n'):
+                self.feed_line(line.rstrip('\r'))
+        if self.closing:
+            self.closing = False
+            self.commit_block()
+        self.render_tail()
+        if at_bottom:
+            bar.setValue(bar.maximum())
+
+    def feed_line(self, line):
+        if self.fence:
+            if line.strip().startswith(self.fence):
+                self.fence = None
+            else:
+                self.commit_code_line(line)
+            return
+
+        match = PREVIEW_FENCE_RE.match(line)
+        if match:
+            self.commit_block()
+            self.fence = match.group(1)
+            return
+        if not line.strip():
+            # 空行先记着，下一行不缩进才说明这一块结束了（缩进的是列表项的后续段落）
+            if self.block_lines:
+                self.block_lines.append("")
+            return
+        if self.block_lines and not self.block_lines[-1] and not line[:1].isspace():
+            self.commit_block()
+        elif len(self.block_lines) >= PREVIEW_SPLIT_LINES:
+            head = self.table_head()
+            if head and '|' in line:
+                # 表格在行之间切开，下一块重复表头和分隔行，单独转换也还是表格
+                self.commit_block()
+                self.block_lines = head
+            elif PREVIEW_BLOCK_START_RE.match(line):
+                self.commit_block()
+        self.block_lines.append(line)
+
+    def table_head(self):
+        """还没结束的块是表格时返回表头和分隔行"""
+        if len(self.block_lines) >= 2 and '|' in self.block_lines[0] \
+                and PREVIEW_TABLE_DELIM_RE.match(self.block_lines[1]):
+            return self.block_lines[:2]
+        return None
+
+    def end_cursor(self):
+        cursor = QTextCursor(self.document())
+        cursor.movePosition(QTextCursor.MoveOperation.End)
+        return cursor
+
+    def new_block(self, cursor, block_format, char_format):
+        if self.document().isEmpty():
+            cursor.setBlockFormat(block_format)
+            cursor.setCharFormat(char_format)
+        else:
+            cursor.insertBlock(block_format, char_format)
+
+    def clear_tail(self, start=None):
+        cursor = QTextCursor(self.document())
+        cursor.setPosition(self.stable_end if start is None else start)
+        cursor.movePosition(QTextCursor.MoveOperation.End, QTextCursor.MoveMode.KeepAnchor)
+        cursor.removeSelectedText()
+        if start is None:
+            self.reset_plain()
+
+    def insert_markdown(self, lines):
+        if self.md is None:
+            import markdown
+            self.md = markdown.Markdown(extensions=['fenced_code', 'tables'])
+        html = self.md.reset().convert('\n'.join(lines))
+        # 块是切开转换的，后面几块的有序列表要接着原来的编号
+        match = PREVIEW_BLOCK_START_RE.match(lines[0])
+        if match and match.group(2) and match.group(2) != "1":
+            html = html.replace('<ol>', f'<ol start="{match.group(2)}">', 1)
+        cursor = self.end_cursor()
+        self.new_block(cursor, QTextBlockFormat(), QTextCharFormat())
+        cursor.insertHtml(html)
+
+    def commit_block(self):
+        lines = self.block_lines
+        self.block_lines = []
+        while lines and not lines[-1]:
+            lines.pop()
+        if not lines:
+            return
+        self.clear_tail()
+        self.insert_markdown(lines)
+        self.stable_end = self.document().characterCount() - 1
+
+    def commit_code_line(self, line):
+        # 代码块的行不用转换，直接按代码格式插入
+        self.clear_tail()
+        cursor = self.end_cursor()
+        self.new_block(cursor, self.code_block_format, self.code_char_format)
+        cursor.insertText(line, self.code_char_format)
+        self.stable_end = self.document().characterCount() - 1
+
+    def render_tail(self):
+        if not self.fence and (self.plain_end is not None
+                               or sum(map(len, self.block_lines)) + len(self.pending) > PREVIEW_PLAIN_CHARS):
+            self.render_plain_tail()
+            return
+        self.clear_tail()
+        if self.fence:
+            if self.pending:
+                cursor = self.end_cursor()
+                self.new_block(cursor, self.code_block_format, self.code_char_format)
+                cursor.insertText(self.pending, self.code_char_format)
+            return
+        lines = self.block_lines + ([self.pending] if self.pending else [])
+        if any(line.strip() for line in lines):
+            self.insert_markdown(lines)
+
+    def render_plain_tail(self):
+        # 只追加新来的行和字，不重新转换，块结束时 commit_block 再整块转换一次
+        if self.plain_end is None:
+            self.clear_tail()
+            self.plain_end = self.stable_end
+        if self.plain_lines < len(self.block_lines):
+            self.clear_tail(self.plain_end)
+            cursor = self.end_cursor()
+            for line in self.block_lines[self.plain_lines:]:
+                self.new_block(cursor, QTextBlockFormat(), QTextCharFormat())
+                cursor.insertText(line)
+            self.plain_end = self.document().characterCount() - 1
+            self.plain_lines = len(self.block_lines)
+            self.plain_pending = 0
+        if len(self.pending) < self.plain_pending:
+            self.clear_tail(self.plain_end)
+            self.plain_pending = 0
+        if len(self.pending) > self.plain_pending:
+            cursor = self.end_cursor()
+            if self.plain_pending == 0:
+                self.new_block(cursor, QTextBlockFormat(), QTextCharFormat())
+            cursor.insertText(self.pending[self.plain_pending:])
+            self.plain_pending = len(self.pending)
+
+
+class Job:
+    """任务队列里的一次执行"""
+    def __init__(self, job_id, tab, command, work_dir):
+        self.job_id = job_id
+        self.tab = tab  # 发起的 tab，tab 被删掉后为 None，输出只进日志
+        self.tab_name = tab.tab_name if tab else ""
+        self.command = command
+        self.work_dir = work_dir
+        self.state = JOB_QUEUED
+        self.exit_code = None
+        self.seconds = 0
+        self.log_path = None
+        self.runner = None
+
+    def is_active(self):
+        return self.state in (JOB_QUEUED, JOB_RUNNING)
+
+    def elapsed_seconds(self):
+        return self.runner.elapsed_seconds() if self.runner else self.seconds
+
+
+class JobManager(QObject):
+    """全局任务队列
+    各个 tab 点"执行命令"都先进队列，最多同时运行 max_concurrent 条，其余按提交顺序等着，
+    避免一下子起一堆 qwen 抢缓存文件和 API 限流。输出交给发起的 tab 显示，完整输出在日志文件里。"""
+    changed = Signal()  # 任务增减或状态变化
+
+    def __init__(self, max_concurrent=JOB_MAX_CONCURRENT, parent=None):
+        super().__init__(parent)
+        self.jobs = []
+        self.next_id = 1
+        self.max_concurrent = max_concurrent
+
+    def submit(self, tab, command, work_dir):
+        job = Job(self.next_id, tab, command, work_dir)
+        self.next_id += 1
+        self.jobs.append(job)
+        self.schedule()
+        self.changed.emit()
+        return job
+
+    def count(self, state):
+        return sum(1 for job in self.jobs if job.state == state)
+
+    def set_max_concurrent(self, value):
+        self.max_concurrent = max(1, int(value))
+        self.schedule()
+
+    def schedule(self):
+        """有空位就按顺序启动排队的任务"""
+        while self.count(JOB_RUNNING) < self.max_concurrent:
+            job = next((job for job in self.jobs if job.state == JOB_QUEUED), None)
+            if job is None:
+                break
+            self.start_job(job)
+
+    def start_job(self, job):
+        job.state = JOB_RUNNING
+        job.log_path = run_log_path(job.tab_name, job.job_id)
+        job.runner = CommandRunner(job.command, job.work_dir, job.log_path, self)
+        job.runner.output.connect(lambda text, is_err, job=job: self.on_output(job, text, is_err))
+        job.runner.finished.connect(lambda exit_code, job=job: self.on_finished(job, exit_code))
+        if job.tab:
+            job.tab.on_job_started(job)
+        job.runner.start()
+        self.changed.emit()
+
+    def on_output(self, job, text, is_err):
+        if job.tab:
+            job.tab.on_job_output(job, text, is_err)
+
+    def on_finished(self, job, exit_code):
+        runner = job.runner
+        job.runner = None
+        job.exit_code = exit_code
+        job.seconds = runner.elapsed_seconds()
+        if job.state == JOB_RUNNING:
+            job.state = JOB_DONE if exit_code == 0 else JOB_FAILED
+        runner.deleteLater()
+        if job.tab:
+            job.tab.on_job_finished(job)
+        self.prune()
+        self.schedule()
+        self.changed.emit()
+
+    def cancel(self, job):
+        """排队的直接取消，运行中的停止"""
+        if job.state == JOB_QUEUED:
+            job.state = JOB_CANCELED
+            if job.tab:
+                job.tab.on_job_finished(job)
+            self.changed.emit()
+        elif job.state == JOB_RUNNING:
+            job.state = JOB_STOPPED
+            job.runner.kill()
+            self.changed.emit()
+
+    def cancel_tab(self, tab):
+        for job in self.jobs:
+            if job.tab is tab and job.is_active():
+                self.cancel(job)
+
+    def release_tab(self, tab):
+        """tab 要删掉了：它的任务全部停掉，之后的输出只进日志"""
+        self.cancel_tab(tab)
+        for job in self.jobs:
+            if job.tab is tab:
+                job.tab = None
+
+    def rerun(self, job):
+        return self.submit(job.tab, job.command, job.work_dir)
+
+    def clear_finished(self):
+        self.jobs = [job for job in self.jobs if job.is_active()]
+        self.changed.emit()
+
+    def prune(self):
+        finished = [job for job in self.jobs if not job.is_active()]
+        drop = set(id(job) for job in finished[:max(0, len(finished) - JOB_HISTORY_KEEP)])
+        if drop:
+            self.jobs = [job for job in self.jobs if id(job) not in drop]
+
+    def kill_all(self):
+        """退出时用，不等脚本清理；先把排队的取消掉，免得前面的一结束又启动新的"""
+        for job in self.jobs:
+            if job.state == JOB_QUEUED:
+                job.state = JOB_CANCELED
+        for job in list(self.jobs):
+            if job.state == JOB_RUNNING:
+                job.state = JOB_STOPPED
+                runner = job.runner
+                runner.kill(force=True)
+                runner.process.waitForFinished(1000)
+
+
 class TabPage(QWidget):
-    def __init__(self, parent_app, tab_name):
+    """一个 tab 页
+    界面在第一次显示时才创建，之前只存着配置：几十个 tab 的配置启动时只建当前那一个，
+    没打开过的 tab 保存时原样写回"""
+    def __init__(self, parent_app, tab_name, config=None):
         super().__init__()
         self.parent_app = parent_app
         self.tab_name = tab_name
         self.param_rows = []
+        self.current_job = None  # 输出区正在显示的任务
+        self.prefetch_runner = None
+        self.prefetch_again = None  # 预取正在跑时又有改动，跑完用这个模式再来一次
+        self.built = False
+        self.pending_config = config  # 还没创建界面时的配置，None 为默认配置
+
+    def showEvent(self, event):
+        self.ensure_built()
+        super().showEvent(event)
+
+    def ensure_built(self):
+        if self.built:
+            return
+        self.built = True
+        started = time.perf_counter()
         self.setup_ui()
-        self.init_default_rows()
+        config = self.pending_config
+        self.pending_config = None
+        if config is None:
+            self.init_default_rows()
+        else:
+            self.set_config(config)
+        self.schedule_prefetch()
+        startup_mark(f"创建 Tab '{self.tab_name}'（{len(self.param_rows)} 行）", started)
 
     def setup_ui(self):
         layout = QVBoxLayout(self)
@@ -212,6 +899,7 @@ class TabPage(QWidget):
         default_dir = r"a_qwen_cli"
         self.work_dir.setText(default_dir)
         self.work_dir.setPlaceholderText("如果不为空，将先切换到此目录")
+        self.work_dir.textChanged.connect(self.schedule_prefetch)
         work_dir_layout.addWidget(self.work_dir)
         
         # 主目录浏览按钮
@@ -228,11 +916,24 @@ class TabPage(QWidget):
         #default_cmd = r"c:\cygwin64\bin\bash.exe c:\cygwin64\opt\qwencli\qwencli" if sys.platform == "win32" else r"bash qwen"
         default_cmd = r"bash qwen"
         self.main_cmd.setText(default_cmd)
+        self.main_cmd.textChanged.connect(self.schedule_prefetch)
         cmd_layout.addWidget(self.main_cmd)
         header_layout.addLayout(cmd_layout)
 
-        # 参数列表标签
-        header_layout.addWidget(QLabel("参数列表:"))
+        # 参数列表标签，右边是文件预取的状态
+        params_label_layout = QHBoxLayout()
+        params_label_layout.addWidget(QLabel("参数列表:"))
+        params_label_layout.addStretch()
+        self.prefetch_badge = QLabel()
+        self.prefetch_badge.linkActivated.connect(lambda link: self.run_prefetch("upload"))
+        self.prefetch_badge.hide()
+        params_label_layout.addWidget(self.prefetch_badge)
+        header_layout.addLayout(params_label_layout)
+
+        self.prefetch_timer = QTimer(self)
+        self.prefetch_timer.setSingleShot(True)
+        self.prefetch_timer.setInterval(PREFETCH_DELAY_MS)
+        self.prefetch_timer.timeout.connect(lambda: self.run_prefetch())
         layout.addWidget(header_frame)
 
         # 可滚动的参数区域
@@ -248,7 +949,20 @@ class TabPage(QWidget):
         self.param_layout.addStretch()  # 添加弹性空间
 
         scroll_area.setWidget(self.param_container)
-        layout.addWidget(scroll_area, 1)  # 占用剩余空间
+
+        # 参数区域和输出区上下分开，可拖动；输出区是控制台和 markdown 预览两页
+        self.console = OutputConsole()
+        self.console.stop_requested.connect(self.stop_command)
+        self.preview = MarkdownPreview()
+        self.output_tabs = QTabWidget()
+        self.output_tabs.addTab(self.console, "输出")
+        self.output_tabs.addTab(self.preview, "预览")
+        splitter = QSplitter(Qt.Orientation.Vertical)
+        splitter.addWidget(scroll_area)
+        splitter.addWidget(self.output_tabs)
+        splitter.setStretchFactor(0, 1)
+        splitter.setStretchFactor(1, 1)
+        layout.addWidget(splitter, 1)  # 占用剩余空间
 
         # 底部按钮区域（固定高度）
         self.create_button_area(layout)
@@ -289,6 +1003,7 @@ class TabPage(QWidget):
         parent_layout.addWidget(button_frame)
     def show_help(self):
         """显示帮助文件"""
+        import markdown
         work_dir = self.work_dir.text().strip()
         if not work_dir:
             QMessageBox.warning(self, "警告", "请先设置主目录")
@@ -331,6 +1046,8 @@ class TabPage(QWidget):
             new_row.on_type_change()
         
         new_row.row_changed.connect(self.update_layout)
+        new_row.row_changed.connect(self.schedule_prefetch)
+        new_row.value_changed.connect(self.schedule_prefetch)
         self.param_rows.insert(index, new_row)
         self.relayout_rows()
         self.update_layout()
@@ -341,6 +1058,7 @@ class TabPage(QWidget):
             row.setParent(None)
             self.relayout_rows()
             self.update_layout()
+            self.schedule_prefetch()
 
     def relayout_rows(self):
         # 清除布局中的所有行
@@ -464,49 +1182,141 @@ class TabPage(QWidget):
 
 
     def execute_command(self):
-        """在当前终端中以非阻塞方式执行命令"""
+        """把命令加入任务队列，轮到时在输出控制台里以非阻塞方式执行"""
         try:
-            # 获取命令和工作目录
+            # 获取命令和工作目录，工作目录交给 QProcess 切换
             command = self.build_command_to_exec()
             work_dir = self.work_dir.text().strip()
+            job = self.parent_app.jobs.submit(self, command, work_dir)
+            if job.state == JOB_QUEUED:
+                self.console.set_status(f"输出: 任务 #{job.job_id} 排队中…")
+                self.console.set_stoppable(True)
 
-            # 构建完整的命令脚本
-            if work_dir:
-                if sys.platform == "win32":
-                    # Windows 系统
-                    script_content = f'cd /d "{work_dir}" && {command}'
-                    print(f'> cd /d "{work_dir}"')
-                    print(f'> {command}')
-                    
-                    # 使用 start /B cmd /c 实现非阻塞执行
-                    full_command = f'start /B cmd /c "{script_content}"'
-                else:
-                    # Unix/Linux/macOS 系统
-                    script_content = f'cd "{work_dir}" && {command}'
-                    print(f'> cd "{work_dir}"')
-                    print(f'> {command}')
-                    
-                    # 直接使用 subprocess.Popen
-                    full_command = script_content
-            else:
-                script_content = command
-                print(f'> {command}')
-                
-                if sys.platform == "win32":
-                    # Windows 系统
-                    full_command = f'start /B cmd /c "{script_content}"'
-                else:
-                    # Unix/Linux/macOS 系统
-                    full_command = script_content
-
-            # 在后台执行命令（非阻塞）
-            process = subprocess.Popen(full_command, shell=True)
-            print("命令已启动（后台运行）")
-            
         except Exception as e:
             QMessageBox.critical(self, "执行失败", str(e))
 
+    def on_job_started(self, job):
+        # 同一个 tab 有几条同时在跑时，输出区跟着最新启动的那条，其余的看任务窗口里的日志
+        self.current_job = job
+        self.console.begin_run(job.log_path)
+        self.preview.reset()
+
+    def on_job_output(self, job, text, is_err):
+        if job is self.current_job:
+            self.on_command_output(text, is_err)
+
+    def on_job_finished(self, job):
+        if job is self.current_job:
+            self.current_job = None
+            self.console.end_run(job.exit_code, job.seconds)
+            self.preview.finish()
+        elif job.state == JOB_CANCELED and self.current_job is None:
+            self.console.set_status(f"输出: 任务 #{job.job_id} 已取消")
+        self.console.set_stoppable(any(
+            j.tab is self and j.is_active() for j in self.parent_app.jobs.jobs))
+        # 执行时可能上传了文件，重新看一下缓存
+        self.schedule_prefetch()
+
+    def schedule_prefetch(self):
+        if self.built:
+            self.prefetch_timer.start()
+
+    def build_prefetch_command(self, mode):
+        """只对 qwen 的 tab 预取：主命令加 --prefetch、-m 和没有 key 的文件、目录行；
+        qwen-vl 的图片走 qwenvl.sh，不预取"""
+        main_cmd = self.main_cmd.text().strip()
+        if not any(os.path.basename(word) == "qwen" for word in main_cmd.split()):
+            return None
+        params = []
+        paths = []
+        for row in self.param_rows:
+            row_type = row.param_type.currentText()
+            key = row.key_entry.text().strip()
+            value = row.value_combo.currentText().strip()
+            if row_type == "开关" and key in ("-m", "--model") and value:
+                if value.startswith("qwen-vl"):
+                    return None
+                params.append(f"{key} {value}")
+            elif row_type in ["文件", "目录"] and not key and value:
+                paths.append(f"'{value}'")
+        if not paths:
+            return None
+        return ' '.join([main_cmd, "--prefetch", mode] + params + paths)
+
+    def run_prefetch(self, mode=None):
+        """后台跑一次 qwen --prefetch，不占任务队列；结果显示在参数列表右边"""
+        mode = mode or ("upload" if self.parent_app.prefetch_upload else "check")
+        if self.prefetch_runner is not None:
+            # 上传到一半停掉的话，传上去的文件不会进缓存，等这次跑完再来
+            if self.prefetch_again != "upload":
+                self.prefetch_again = mode
+            return
+        command = self.build_prefetch_command(mode)
+        if command is None:
+            self.prefetch_badge.hide()
+            return
 
+        self.prefetch_stdout = ""
+        self.prefetch_stderr = ""
+        self.prefetch_badge.setText("⏫ 正在上传文件…" if mode == "upload" else "⏳ 正在检查文件…")
+        self.prefetch_badge.show()
+        self.prefetch_runner = CommandRunner(command, self.work_dir.text().strip(), os.devnull, self)
+        self.prefetch_runner.output.connect(self.on_prefetch_output)
+        self.prefetch_runner.finished.connect(self.on_prefetch_finished)
+        self.prefetch_runner.start()
+
+    def on_prefetch_output(self, text, is_err):
+        if is_err:
+            self.prefetch_stderr = (self.prefetch_stderr + text)[-2000:]
+        else:
+            self.prefetch_stdout += text
+
+    def on_prefetch_finished(self, exit_code):
+        self.prefetch_runner.deleteLater()
+        self.prefetch_runner = None
+        lines = self.prefetch_stdout.strip().splitlines()
+        try:
+            stats = json.loads(lines[-1]) if exit_code == 0 and lines else None
+        except ValueError:
+            stats = None
+        if stats is None:
+            self.prefetch_badge.setText("⚠️ 预取失败")
+            self.prefetch_badge.setToolTip(ANSI_ESCAPE_RE.sub('', self.prefetch_stderr).strip())
+        else:
+            total = stats['cached_bytes'] + stats['pending_bytes'] + stats['uploaded_bytes']
+            text = (f"文件 {stats['files']} 个 {format_bytes(total)}："
+                    f"已缓存 {stats['cached']}，待上传 {stats['pending']}")
+            if stats['uploaded']:
+                text += f"，刚上传 {stats['uploaded']}"
+            if stats['failed']:
+                text += f"，失败 {stats['failed']}"
+            if stats['pending']:
+                text += f" <a href=\"upload\">现在上传</a>"
+            self.prefetch_badge.setText(text)
+            self.prefetch_badge.setToolTip(
+                f"已缓存 {format_bytes(stats['cached_bytes'])}，待上传 {format_bytes(stats['pending_bytes'])}，"
+                f"刚上传 {format_bytes(stats['uploaded_bytes'])}")
+        if self.prefetch_again:
+            mode = self.prefetch_again
+            self.prefetch_again = None
+            self.run_prefetch(mode)
+
+    def stop_prefetch(self):
+        if self.built:
+            self.prefetch_timer.stop()
+        self.prefetch_again = None
+        if self.prefetch_runner is not None:
+            self.prefetch_runner.kill(force=True)
+
+    def on_command_output(self, text, is_err):
+        self.console.append(text, is_err)
+        # 回答在 stdout，日志和统计在 stderr，预览只看 stdout
+        if not is_err:
+            self.preview.append(text)
+
+    def stop_command(self):
+        """停止这个 tab 正在运行的命令，并取消它还在排队的"""
+        self.parent_app.jobs.cancel_tab(self)
 
     def reset_current_tab(self):
         # 清空现有行
@@ -526,6 +1336,10 @@ class TabPage(QWidget):
         self.init_default_rows()
     def get_config(self):
         """获取当前页的配置"""
+        if not self.built:
+            if self.pending_config is not None:
+                return self.pending_config
+            self.ensure_built()
         return {
             'work_dir': self.work_dir.text(),
             'main_cmd': self.main_cmd.text(),
@@ -534,6 +1348,9 @@ class TabPage(QWidget):
 
     def set_config(self, config):
         """设置页面配置"""
+        if not self.built:
+            self.pending_config = config
+            return
         # 设置主目录和主命令
         self.work_dir.setText(config.get('work_dir', ''))
         self.main_cmd.setText(config.get('main_cmd', ''))
@@ -549,6 +1366,8 @@ class TabPage(QWidget):
             new_row = ParamRow(self, i)
             new_row.set_config(row_config)
             new_row.row_changed.connect(self.update_layout)
+            new_row.row_changed.connect(self.schedule_prefetch)
+            new_row.value_changed.connect(self.schedule_prefetch)
             self.param_rows.append(new_row)
             self.param_layout.insertWidget(i, new_row)
 
@@ -578,10 +1397,137 @@ class NameDialog(QDialog):
         return self.name_edit.text().strip()
 
 
+class JobDialog(QDialog):
+    """任务窗口：所有 tab 提交的命令，可以改并发数、停止、重新运行、看日志"""
+    COLUMNS = ["#", "Tab", "状态", "用时", "退出码", "命令"]
+
+    def __init__(self, parent, jobs):
+        super().__init__(parent)
+        self.jobs = jobs
+        self.setWindowTitle("任务")
+        self.resize(760, 400)
+        self.setup_ui()
+        self.jobs.changed.connect(self.refresh)
+
+        # 运行中的用时每秒更新一次
+        self.tick_timer = QTimer(self)
+        self.tick_timer.setInterval(1000)
+        self.tick_timer.timeout.connect(self.refresh)
+        self.refresh()
+
+    def setup_ui(self):
+        layout = QVBoxLayout(self)
+
+        top_layout = QHBoxLayout()
+        self.summary_label = QLabel()
+        top_layout.addWidget(self.summary_label)
+        top_layout.addStretch()
+        top_layout.addWidget(QLabel("同时运行:"))
+        self.concurrency_spin = QSpinBox()
+        self.concurrency_spin.setRange(1, 16)
+        self.concurrency_spin.setValue(self.jobs.max_concurrent)
+        self.concurrency_spin.valueChanged.connect(self.jobs.set_max_concurrent)
+        top_layout.addWidget(self.concurrency_spin)
+        layout.addLayout(top_layout)
+
+        self.table = QTableWidget(0, len(self.COLUMNS))
+        self.table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.table.verticalHeader().setVisible(False)
+        self.table.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
+        self.table.setSelectionMode(QAbstractItemView.SelectionMode.ExtendedSelection)
+        header = self.table.horizontalHeader()
+        for column in range(len(self.COLUMNS) - 1):
+            header.setSectionResizeMode(column, QHeaderView.ResizeMode.ResizeToContents)
+        header.setStretchLastSection(True)
+        self.table.itemDoubleClicked.connect(lambda item: self.open_log())
+        layout.addWidget(self.table)
+
+        button_layout = QHBoxLayout()
+        buttons = [
+            ("停止/取消", self.cancel_selected),
+            ("重新运行", self.rerun_selected),
+            ("打开日志", self.open_log),
+            ("清除已结束", self.jobs.clear_finished),
+        ]
+        for text, slot in buttons:
+            btn = QPushButton(text)
+            btn.clicked.connect(slot)
+            button_layout.addWidget(btn)
+        button_layout.addStretch()
+        close_btn = QPushButton("关闭")
+        close_btn.clicked.connect(self.hide)
+        button_layout.addWidget(close_btn)
+        layout.addLayout(button_layout)
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        self.concurrency_spin.setValue(self.jobs.max_concurrent)
+        self.refresh()
+
+    def selected_jobs(self):
+        rows = sorted(set(index.row() for index in self.table.selectedIndexes()))
+        by_id = {job.job_id: job for job in self.jobs.jobs}
+        selected = []
+        for row in rows:
+            job = by_id.get(self.table.item(row, 0).data(Qt.ItemDataRole.UserRole))
+            if job:
+                selected.append(job)
+        return selected
+
+    def refresh(self):
+        running = self.jobs.count(JOB_RUNNING)
+        if running:
+            self.tick_timer.start()
+        else:
+            self.tick_timer.stop()
+        if not self.isVisible():
+            return
+        self.summary_label.setText(f"运行中 {running}，排队 {self.jobs.count(JOB_QUEUED)}")
+
+        selected_ids = set(job.job_id for job in self.selected_jobs())
+        self.table.clearSelection()
+        self.table.setRowCount(len(self.jobs.jobs))
+        # 新的在上面
+        for row, job in enumerate(reversed(self.jobs.jobs)):
+            exit_code = "" if job.exit_code is None else str(job.exit_code)
+            seconds = f"{job.elapsed_seconds():.1f}s" if job.log_path else ""
+            values = [str(job.job_id), job.tab_name, job.state, seconds, exit_code, job.command]
+            for column, value in enumerate(values):
+                item = self.table.item(row, column)
+                if item is None:
+                    item = QTableWidgetItem()
+                    self.table.setItem(row, column, item)
+                item.setText(value)
+            self.table.item(row, 0).setData(Qt.ItemDataRole.UserRole, job.job_id)
+            self.table.item(row, 5).setToolTip(job.command)
+            if job.job_id in selected_ids:
+                self.table.selectionModel().select(
+                    self.table.model().index(row, 0),
+                    QItemSelectionModel.SelectionFlag.Select | QItemSelectionModel.SelectionFlag.Rows)
+
+    def cancel_selected(self):
+        for job in self.selected_jobs():
+            self.jobs.cancel(job)
+
+    def rerun_selected(self):
+        for job in self.selected_jobs():
+            self.jobs.rerun(job)
+
+    def open_log(self):
+        for job in self.selected_jobs()[:1]:
+            if job.log_path and os.path.exists(job.log_path):
+                QDesktopServices.openUrl(QUrl.fromLocalFile(os.path.abspath(job.log_path)))
+
+
 class MainWindow(QMainWindow):
     def __init__(self):
         super().__init__()
         self.tabs = []
+        self.jobs = JobManager(parent=self)
+        self.jobs.changed.connect(self.update_jobs_button)
+        self.job_dialog = None
+        self.prefetch_upload = False  # 预取时顺便上传没缓存的文件，配置里的 prefetch_upload
         self.setup_ui()
         self.load_config()
 
@@ -635,6 +1581,7 @@ class MainWindow(QMainWindow):
             ("删除Tab", self.remove_current_tab),
             ("改名Tab", self.rename_tab_dialog),
             ("复制Tab", self.copy_current_tab),  # 新增复制Tab按钮
+            ("任务", self.show_jobs),
             ("保存", self.save_config),
             ("重置", self.reset_all),
             ("README", self.show_readme),
@@ -645,6 +1592,8 @@ class MainWindow(QMainWindow):
             btn = QPushButton(text)
             btn.clicked.connect(slot)
             center_layout.addWidget(btn)
+            if slot == self.show_jobs:
+                self.jobs_btn = btn
 
         button_layout.addStretch()
         button_layout.addWidget(center_widget)
@@ -652,6 +1601,19 @@ class MainWindow(QMainWindow):
 
         parent_layout.addWidget(button_frame)
 
+    def show_jobs(self):
+        if self.job_dialog is None:
+            self.job_dialog = JobDialog(self, self.jobs)
+        self.job_dialog.show()
+        self.job_dialog.raise_()
+        self.job_dialog.activateWindow()
+
+    def update_jobs_button(self):
+        """按钮上显示运行中/排队的数量"""
+        running = self.jobs.count(JOB_RUNNING)
+        queued = self.jobs.count(JOB_QUEUED)
+        self.jobs_btn.setText(f"任务 {running}/{queued}" if running or queued else "任务")
+
     def add_tab(self, tab_name=None):
         if tab_name is None:
             tab_name = f"Tab {len(self.tabs) + 1}"
@@ -689,8 +1651,7 @@ class MainWindow(QMainWindow):
             'name': new_name,
             'config': current_tab.get_config()
         }
-        new_tab_page = TabPage(self, tab_config['name'])
-        new_tab_page.set_config(tab_config['config'])
+        new_tab_page = TabPage(self, tab_config['name'], tab_config['config'])
         self.tabs.append(new_tab_page)
         self.tab_widget.addTab(new_tab_page, tab_config['name'])
         # 选择新创建的Tab
@@ -711,6 +1672,13 @@ class MainWindow(QMainWindow):
         if reply == QMessageBox.StandardButton.Yes:
             self.tabs.pop(current_index)
             self.tab_widget.removeTab(current_index)
+            self.discard_tab(current_tab)
+
+    def discard_tab(self, tab):
+        """已经从界面上拿掉的 tab：停掉它的任务和预取，释放控件"""
+        self.jobs.release_tab(tab)
+        tab.stop_prefetch()
+        tab.deleteLater()
 
     def rename_tab_dialog(self):
         current_index = self.tab_widget.currentIndex()
@@ -734,8 +1702,10 @@ class MainWindow(QMainWindow):
                 QMessageBox.information(self, "成功", "已从 helper_gui.json.example 重置配置")
             else:
                 # 如果示例文件不存在，创建默认tab
-                self.tabs.clear()
                 self.tab_widget.clear()
+                for tab in self.tabs:
+                    self.discard_tab(tab)
+                self.tabs.clear()
                 self.add_tab("Tab 1")
                 QMessageBox.warning(self, "警告", "未找到 helper_gui.json.example，已创建默认Tab")
 
@@ -745,7 +1715,9 @@ class MainWindow(QMainWindow):
             #config = {'tabs': []}
             config = {
                 'tabs': [],
-                'last_selected_tab': self.tab_widget.currentIndex()
+                'last_selected_tab': self.tab_widget.currentIndex(),
+                'max_jobs': self.jobs.max_concurrent,
+                'prefetch_upload': self.prefetch_upload
             }            
             # 按照 QTabWidget 的当前顺序保存
             for i in range(self.tab_widget.count()):
@@ -779,9 +1751,14 @@ class MainWindow(QMainWindow):
                 return
             with open(config_file, 'r', encoding='utf-8') as f:
                 config = json.load(f)
+            startup_mark("读取配置")
+            self.jobs.set_max_concurrent(config.get('max_jobs', JOB_MAX_CONCURRENT))
+            self.prefetch_upload = bool(config.get('prefetch_upload', False))
             # 清空现有tabs
-            self.tabs.clear()
             self.tab_widget.clear()
+            for tab in self.tabs:
+                self.discard_tab(tab)
+            self.tabs.clear()
             # 根据配置重建tabs
             tabs_config = config.get('tabs', [])
             if not tabs_config:
@@ -789,10 +1766,10 @@ class MainWindow(QMainWindow):
                 return
             for tab_config in tabs_config:
                 tab_name = tab_config.get('name', 'Tab')
-                tab_page = TabPage(self, tab_name)
-                tab_page.set_config(tab_config.get('config', {}))
+                tab_page = TabPage(self, tab_name, tab_config.get('config', {}))
                 self.tabs.append(tab_page)
                 self.tab_widget.addTab(tab_page, tab_name)
+            startup_mark(f"登记 {len(tabs_config)} 个 Tab")
             # 恢复最后选中的Tab
             last_selected_tab = config.get('last_selected_tab', 0)
             if 0 <= last_selected_tab < len(self.tabs):
@@ -835,16 +1812,25 @@ class MainWindow(QMainWindow):
     def closeEvent(self, event):
         """窗口关闭时自动保存配置"""
         #self.save_config()
+        # 还在跑的命令一起结束，不留孤儿进程
+        self.jobs.kill_all()
+        for tab in self.tabs:
+            tab.stop_prefetch()
         event.accept()
 
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
+    startup_mark("创建 QApplication")
     
     # 设置应用程序样式
     app.setStyle('Fusion')
     
     window = MainWindow()
+    startup_mark("创建主窗口")
     window.show()
+    startup_mark("显示窗口")
+    if STARTUP_PROFILE:
+        QTimer.singleShot(0, startup_report)
     
     sys.exit(app.exec())